@@ -17,6 +17,7 @@ from operator import itemgetter
 from copy import deepcopy
 from math import log,sqrt
 import itertools
+import os
 import numpy as np
 
 
@@ -63,83 +64,56 @@ class Alignment(object):
         self.P = P
         self.Product = list(itertools.product(*P.values()))
 
-    def get_rmsd(self):
+    def _get_coordinates(self):
+        """Get the template and query coordinates as flat arrays, and a
+           _CopyAssignment to match up the copies of each protein"""
+        proteins = sorted(self.template.keys())
+        offsets = {}
+        nparticles = 0
+        for p in proteins:
+            n = len(self.template[p])
+            offsets[p] = np.arange(nparticles, nparticles + n)
+            nparticles += n
+
+        def get_array(coords):
+            xyz = np.zeros((nparticles, 3))
+            for p in proteins:
+                if len(coords[p]) != len(offsets[p]):
+                    raise ValueError('''the number of coordinates
+                               in template and query does not match!''')
+                if len(offsets[p]) > 0:
+                    xyz[offsets[p]] = [tuple(c) for c in coords[p]]
+            return xyz
+        weights = None
+        if self.weights is not None:
+            weights = np.zeros(nparticles)
+            for p in proteins:
+                weights[offsets[p]] = self.weights[p]
+        return (get_array(self.template), get_array(self.query),
+                offsets, weights)
 
-        self.permute()
-
-        template_xyz = []
-        weights = []
-        torder = sum([list(i) for i in self.Product[0]], [])
-        for t in torder:
-            template_xyz += [IMP.algebra.Vector3D(i) for i in self.template[t]]
-            if self.weights is not None:
-                weights += [i for i in self.weights[t]]
-        #template_xyz = np.array(template_xyz)
-
-        self.rmsd = 10000000000.
-        for comb in self.Product:
-
-            order = sum([list(i) for i in comb], [])
-            query_xyz = []
-            for p in order:
-                query_xyz += [IMP.algebra.Vector3D(i) for i in self.query[p]]
-            #query_xyz = np.array(query_xyz)
-            #if len(template_xyz) != len(query_xyz):
-            #    print '''Alignment.get_rmsd: ERROR: the number of coordinates
-            #                   in template and query does not match!'''
-            #    exit()
-
-            if self.weights is not None:
-                dist=IMP.algebra.get_weighted_rmsd(template_xyz, query_xyz, weights)
-            else:
-                dist=IMP.algebra.get_rmsd(template_xyz, query_xyz)
-            #dist = sqrt(
-            #    sum(np.diagonal(cdist(template_xyz, query_xyz) ** 2)) / len(template_xyz))
-            if dist < self.rmsd:
-                self.rmsd = dist
+    def get_rmsd(self):
+        """Get the RMSD between template and query (without alignment),
+           for the best assignment of protein copies"""
+        template, query, offsets, weights = self._get_coordinates()
+        assignment = _CopyAssignment(offsets, weights)
+        rmsds, perms = assignment.get_rmsds(template, query[np.newaxis])
+        self.rmsd = float(rmsds[0])
         return self.rmsd
 
     def align(self):
-        from scipy.spatial.distance import cdist
-
-        self.permute()
-
-        # create flat coordinate list from template in standard order
-        # then loop through the permutations and try to align and get RMSD
-        # should allow you to try all mappings within each protein
-        template_xyz = []
-        torder = sum([list(i) for i in self.Product[0]], [])
-        for t in torder:
-            template_xyz += [IMP.algebra.Vector3D(i) for i in self.template[t]]
-        # template_xyz = np.array(template_xyz)
-        self.rmsd, Transformation = 10000000000., ''
-
-        # then for each permutation, get flat list of coords and get RMSD
-        for comb in self.Product:
-            order = sum([list(i) for i in comb], [])
-            query_xyz = []
-            for p in order:
-                query_xyz += [IMP.algebra.Vector3D(i) for i in self.query[p]]
-            #query_xyz = np.array(query_xyz)
-
-            if len(template_xyz) != len(query_xyz):
-                raise ValueError('''the number of coordinates
-                               in template and query does not match!''')
-
-            transformation = IMP.algebra.get_transformation_aligning_first_to_second(
-                query_xyz,
-                template_xyz)
-            query_xyz_tr = [transformation.get_transformed(n)
-                            for n in query_xyz]
-
-            dist = sqrt(
-                sum(np.diagonal(cdist(template_xyz, query_xyz_tr) ** 2)) / len(template_xyz))
-            if dist < self.rmsd:
-                self.rmsd = dist
-                Transformation = transformation
-
-        # return the transformation
-        return (self.rmsd, Transformation)
+        """Align the query onto the template. The copies of each protein
+           are assigned and the structures superposed in turn, until the
+           assignment no longer changes.
+           @return the RMSD after alignment and the
+                   IMP.algebra.Transformation3D aligning query to template
+        """
+        template, query, offsets, weights = self._get_coordinates()
+        rmsds, rotations, translations = _get_best_alignments(
+                 _CopyAssignment(offsets), template, query[np.newaxis])
+        self.rmsd = float(rmsds[0])
+        return (self.rmsd, _get_transformation_3d(rotations[0],
+                                                  translations[0]))
 
 
 # TEST for the alignment ###
@@ -160,6 +134,590 @@ else: print 'ERROR!'; exit()
 """
 
 
+def _get_superpositions(template, queries):
+    """Get the rigid transformations that best fit each query to the
+       template (Kabsch algorithm, for a whole batch of queries at once).
+       @param template (n,3) array
+       @param queries (b,n,3) array
+       @return (b,3,3) rotation matrices and (b,3) translations, such that
+               R.q + t is the best fit of each query point q
+    """
+    tc = template.mean(axis=0)
+    qc = queries.mean(axis=1)
+    h = np.einsum('bni,nj->bij', queries - qc[:, np.newaxis, :],
+                  template - tc)
+    u, s, vt = np.linalg.svd(h)
+    # correct for reflections, so that we always get a proper rotation
+    d = np.where(np.linalg.det(np.matmul(u, vt)) < 0., -1., 1.)
+    vt[:, 2, :] *= d[:, np.newaxis]
+    rotations = np.matmul(vt.transpose(0, 2, 1), u.transpose(0, 2, 1))
+    translations = tc - np.einsum('bij,bj->bi', rotations, qc)
+    return rotations, translations
+
+
+def _get_transformed(rotations, translations, coords):
+    """Apply a batch of transformations to a batch of (b,n,3) coordinates"""
+    return (np.einsum('bij,bnj->bni', rotations, coords)
+            + translations[:, np.newaxis, :])
+
+
+class _CopyAssignment(object):
+    """Assign the copies of proteins in multiple copies (named nameA..1,
+       nameA..2) in a batch of query models to those in a template model,
+       so as to give the smallest RMSD.
+
+       Rather than trying every permutation of the copies, the cost of
+       matching each template copy to each query copy is calculated once
+       and the assignment solved exactly (with the Hungarian algorithm for
+       more than a few copies). Only copies with the same number of
+       particles can be swapped.
+    """
+
+    # with up to this many copies, simply try every permutation
+    _max_enumerated_copies = 4
+
+    def __init__(self, offsets, weights=None):
+        """Constructor.
+           @param offsets {protein name: indexes of its particles}
+           @param weights optional weight of each particle (indexed by
+                  particle index)
+        """
+        groups = {}
+        for p in sorted(offsets.keys()):
+            key = (p.split('..')[0], len(offsets[p]))
+            groups.setdefault(key, []).append(
+                                   np.asarray(offsets[p], dtype=int))
+        groups = [groups[k] for k in sorted(groups.keys())]
+        # particles of proteins in a single copy
+        self.fixed_indexes = np.concatenate(
+                     [g[0] for g in groups if len(g) == 1]
+                     + [np.zeros(0, dtype=int)])
+        # (copies, particles) array of particle indexes for each group
+        self._groups = [np.array(g) for g in groups if len(g) > 1]
+        self.template_indexes = np.concatenate(
+                     [self.fixed_indexes] + [g.flatten() for g in self._groups])
+        nparticles = len(self.template_indexes)
+        self._weights = np.zeros(np.max(self.template_indexes) + 1
+                                 if nparticles > 0 else 0)
+        if weights is None:
+            self._weights[self.template_indexes] = 1.
+        else:
+            self._weights[self.template_indexes] = np.asarray(
+                                        weights)[self.template_indexes]
+        if nparticles > 0:
+            self._weights /= np.sum(self._weights)
+        self.copy_invariant_weights = all(
+                 np.all(self._weights[g] == self._weights[g[0]])
+                 for g in self._groups)
+
+    def get_weights(self, nparticles):
+        """Get the normalized weight of each of nparticles particles"""
+        weights = np.zeros(nparticles)
+        weights[:len(self._weights)] = self._weights
+        return weights
+
+    def get_identity(self, nmodels):
+        """Get the assignment that leaves every copy in place"""
+        return [np.tile(np.arange(len(g)), (nmodels, 1))
+                for g in self._groups]
+
+    def get_assignment(self, template, queries):
+        """Get the best assignment of copies for each query model.
+           @param template (n,3) coordinates
+           @param queries (b,n,3) coordinates
+           @return a list, for each group of copies, of (b,copies) arrays
+                   giving the query copy matched to each template copy
+        """
+        perms = []
+        for g in self._groups:
+            t = template[g]
+            q = queries[:, g]
+            w = self._weights[g]
+            # weighted squared distance of each template copy to each
+            # query copy, as (b,template copy,query copy)
+            tw = w[:, :, np.newaxis] * t
+            costs = (np.sum(tw * t, axis=(1, 2))[np.newaxis, :, np.newaxis]
+                     + np.einsum('tl,bqlx->btq', w, q * q)
+                     - 2. * np.einsum('tlx,bqlx->btq', tw, q))
+            perms.append(self._solve(costs))
+        return perms
+
+    def _solve(self, costs):
+        """Solve a batch of (b,n,n) assignment problems"""
+        ncopies = costs.shape[1]
+        if ncopies <= self._max_enumerated_copies:
+            orders = np.array(list(itertools.permutations(range(ncopies))))
+            totals = np.sum(costs[:, np.arange(ncopies), orders], axis=2)
+            return orders[np.argmin(totals, axis=1)]
+        return np.array([IMP.pmi.tools.get_best_assignment(c)
+                         for c in costs], dtype=int).reshape(-1, ncopies)
+
+    def get_query_indexes(self, perms, nmodels):
+        """Get the (b,n) indexes of the query particles that match the
+           template particles (in the order of template_indexes)"""
+        return np.hstack(
+                [np.tile(self.fixed_indexes, (nmodels, 1))]
+                + [g[p].reshape(nmodels, -1)
+                   for g, p in zip(self._groups, perms)])
+
+    def get_rmsds(self, template, queries, perms=None):
+        """Get the RMSD of each query model from the template.
+           @param perms the assignment of copies to use (by default,
+                  the best one)
+           @return the RMSDs and the assignment of copies
+        """
+        if perms is None:
+            perms = self.get_assignment(template, queries)
+        qi = self.get_query_indexes(perms, len(queries))
+        t = template[self.template_indexes]
+        q = queries[np.arange(len(queries))[:, np.newaxis], qi]
+        sq = np.sum((q - t) ** 2, axis=2)
+        return (np.sqrt(np.dot(sq, self._weights[self.template_indexes])),
+                perms)
+
+
+def _get_best_alignments(assignment, template, queries, max_iterations=100):
+    """Align a batch of query models onto a template model, alternately
+       superposing the models and reassigning copies until the assignment
+       no longer changes. This is started from the original order of
+       copies, from the best assignment without alignment, and (if there
+       are enough of them) from superposing only the proteins in a single
+       copy; the best result is kept.
+       @param assignment a _CopyAssignment for the particles to align
+       @param template (n,3) coordinates
+       @param queries (b,n,3) coordinates
+       @return (b,) RMSDs, (b,3,3) rotation matrices and (b,3) translations
+    """
+    t = template[assignment.template_indexes]
+    rows = np.arange(len(queries))[:, np.newaxis]
+    starts = [assignment.get_identity(len(queries)),
+              assignment.get_assignment(template, queries)]
+    fixed = assignment.fixed_indexes
+    if len(fixed) >= 3 and len(fixed) < len(t):
+        rotations, translations = _get_superpositions(template[fixed],
+                                                       queries[:, fixed])
+        starts.append(assignment.get_assignment(template,
+                       _get_transformed(rotations, translations, queries)))
+    best = None
+    for perms in starts:
+        for i in range(max_iterations):
+            q = queries[rows,
+                        assignment.get_query_indexes(perms, len(queries))]
+            rotations, translations = _get_superpositions(t, q)
+            aligned = _get_transformed(rotations, translations, queries)
+            new_perms = assignment.get_assignment(template, aligned)
+            if all(np.array_equal(p, n) for p, n in zip(perms, new_perms)):
+                break
+            perms = new_perms
+        rmsds = assignment.get_rmsds(template, aligned, new_perms)[0]
+        if best is None:
+            best = rmsds, rotations, translations
+        else:
+            better = rmsds < best[0]
+            best[0][better] = rmsds[better]
+            best[1][better] = rotations[better]
+            best[2][better] = translations[better]
+    return best
+
+
+class ModelCoordinates(object):
+    """Coordinates of many models, stored as one (n_models, n_particles, 3)
+       array, for fast calculation of RMSDs between models.
+
+       RMSDs are calculated for a whole block of models at once, with or
+       without first aligning the models, and give the same results as
+       Alignment.get_rmsd() and Alignment.align(). As for Alignment,
+       proteins in multiple copies should be named nameA..1, nameA..2
+       and the copies are matched up by solving the assignment problem.
+    """
+
+    def __init__(self, all_coords, model_names=None, weights=None,
+                 alignment_protein_names=None):
+        """Constructor.
+           @param all_coords {model name: {'p1':coords(L,3), ...}}
+           @param model_names the order of the models (by default, the
+                  order of all_coords)
+           @param weights optional weights for each set of coordinates
+                  {'p1':weights(L), ...}
+           @param alignment_protein_names if given, models are aligned on
+                  these proteins before the RMSD is calculated
+        """
+        if model_names is None:
+            model_names = list(all_coords.keys())
+        self.model_names = list(model_names)
+        proteins = sorted(all_coords[self.model_names[0]].keys())
+        offsets = {}
+        nparticles = 0
+        for p in proteins:
+            n = len(all_coords[self.model_names[0]][p])
+            offsets[p] = np.arange(nparticles, nparticles + n)
+            nparticles += n
+        self.coords = np.empty((len(self.model_names), nparticles, 3))
+        for i, name in enumerate(self.model_names):
+            for p in proteins:
+                if len(offsets[p]) > 0:
+                    self.coords[i, offsets[p]] = np.asarray(
+                                        [tuple(c) for c in all_coords[name][p]],
+                                        dtype=float)
+
+        self._weights = None
+        if weights:
+            self._weights = np.zeros(nparticles)
+            for p in proteins:
+                self._weights[offsets[p]] = weights[p]
+        self._assignment = _CopyAssignment(offsets, self._weights)
+
+        self.alignment_protein_names = alignment_protein_names
+        if alignment_protein_names is not None:
+            self._align_assignment = _CopyAssignment(
+                dict((p, offsets[p]) for p in alignment_protein_names))
+
+        # the centroid and radius of gyration of each model give a cheap
+        # lower bound on the RMSD, as long as they do not depend on the
+        # assignment of copies
+        self._has_bounds = self._assignment.copy_invariant_weights
+        if self._has_bounds:
+            w = self._assignment.get_weights(nparticles)
+            self._centroids = np.einsum('i,nix->nx', w, self.coords)
+            sq = (np.einsum('i,ni->n', w, np.sum(self.coords ** 2, axis=2))
+                  - np.sum(self._centroids ** 2, axis=1))
+            self._radii = np.sqrt(np.maximum(sq, 0.))
+
+    def __len__(self):
+        return len(self.coords)
+
+    def get_checksum(self):
+        """Get a string identifying the coordinates, weights and alignment
+           used, so that stored RMSDs can be checked against them"""
+        import hashlib
+        h = hashlib.sha1(np.ascontiguousarray(self.coords).tobytes())
+        if self._weights is not None:
+            h.update(self._weights.tobytes())
+        if self.alignment_protein_names is not None:
+            h.update(repr(sorted(self.alignment_protein_names)).encode())
+        return h.hexdigest()
+
+    def get_rmsd_lower_bounds(self, model_index, model_indexes):
+        """Get a lower bound on the RMSD between one model and other
+           models, that is much cheaper to calculate than the RMSD itself.
+           This is the difference in radius of gyration (plus, if the
+           models are not aligned, the distance between their centroids),
+           less a small tolerance for rounding error. If weights are given
+           that differ between copies of a protein, no bound is available
+           and zero is returned.
+        """
+        model_indexes = np.asarray(model_indexes, dtype=int)
+        if not self._has_bounds:
+            return np.zeros(len(model_indexes))
+        sq = (self._radii[model_indexes] - self._radii[model_index]) ** 2
+        if self.alignment_protein_names is None:
+            sq += np.sum((self._centroids[model_indexes]
+                          - self._centroids[model_index]) ** 2, axis=1)
+        return np.maximum(np.sqrt(sq) - 1e-6, 0.)
+
+    def get_rmsds(self, model_index, model_indexes):
+        """Get the RMSD between one model and a block of other models.
+           @param model_index the index of the model used as the template
+           @param model_indexes the indexes of the other models
+           @return an array of RMSDs. If the models are aligned, also
+                   return the (b,3,3) rotation matrices and (b,3)
+                   translations that align each of the other models to
+                   the template model; otherwise these are None.
+        """
+        template = self.coords[model_index]
+        queries = self.coords[np.asarray(model_indexes, dtype=int)]
+        if self.alignment_protein_names is None:
+            return self._assignment.get_rmsds(template, queries)[0], None, None
+        rmsds, rotations, translations = _get_best_alignments(
+                            self._align_assignment, template, queries)
+        queries = _get_transformed(rotations, translations, queries)
+        return (self._assignment.get_rmsds(template, queries)[0],
+                rotations, translations)
+
+    def get_rmsd_matrix(self, block_size=1024):
+        """Get the RMSD between every pair of models, as a
+           (n_models, n_models) array. Models are handled in blocks of
+           block_size, to limit the memory used."""
+        n = len(self)
+        matrix = np.zeros((n, n))
+        for i in range(n):
+            for start in range(i + 1, n, block_size):
+                js = np.arange(start, min(start + block_size, n))
+                rmsds = self.get_rmsds(i, js)[0]
+                matrix[i, js] = rmsds
+                matrix[js, i] = rmsds
+        return matrix
+
+
+def _get_transformation_3d(rotation, translation):
+    """Make an IMP.algebra.Transformation3D from a rotation matrix and
+       translation vector"""
+    rot = IMP.algebra.get_rotation_from_matrix(*rotation.flatten())
+    return IMP.algebra.Transformation3D(rot,
+                                        IMP.algebra.Vector3D(*translation))
+
+
+def _get_quaternions(rotations):
+    """Convert a batch of (b,3,3) rotation matrices to (b,4) unit
+       quaternions (w,x,y,z), in the form used by IMP.algebra.Rotation3D"""
+    m = np.asarray(rotations, dtype=float).reshape(-1, 3, 3)
+    diagonal = np.array([1. + m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2],
+                         1. + m[:, 0, 0] - m[:, 1, 1] - m[:, 2, 2],
+                         1. - m[:, 0, 0] + m[:, 1, 1] - m[:, 2, 2],
+                         1. - m[:, 0, 0] - m[:, 1, 1] + m[:, 2, 2]]).T
+    # work from the largest component, for numerical stability
+    largest = np.argmax(diagonal, axis=1)
+    # 4 times the product of each pair of components
+    offdiagonal = [m[:, 2, 1] - m[:, 1, 2], m[:, 0, 2] - m[:, 2, 0],
+                   m[:, 1, 0] - m[:, 0, 1], m[:, 0, 1] + m[:, 1, 0],
+                   m[:, 0, 2] + m[:, 2, 0], m[:, 1, 2] + m[:, 2, 1]]
+    products = {(0, 1): 0, (0, 2): 1, (0, 3): 2, (1, 2): 3, (1, 3): 4,
+                (2, 3): 5}
+    q = np.empty((len(m), 4))
+    for k in range(4):
+        mask = largest == k
+        if not np.any(mask):
+            continue
+        qk = 0.5 * np.sqrt(diagonal[mask, k])
+        q[mask, k] = qk
+        for other in range(4):
+            if other != k:
+                pair = products[(min(k, other), max(k, other))]
+                q[mask, other] = offdiagonal[pair][mask] / (4. * qk)
+    q /= np.linalg.norm(q, axis=1)[:, np.newaxis]
+    q[q[:, 0] < 0.] *= -1.
+    return q
+
+
+def _get_condensed_indexes(n, i, j):
+    """Get the position of the (i,j) pairs, with i < j, in a condensed
+       distance matrix of n models"""
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+class DistanceMatrix(object):
+    """Distances between every pair of models, stored as a condensed
+       upper-triangular array (as used by scipy.spatial.distance).
+       For aligned models, the transformation that aligns the second model
+       of each pair to the first is also stored, as quaternion and
+       translation arrays.
+
+       If a file name is given, the arrays are memory-mapped .npy files
+       (file_name.npy, file_name.quaternions.npy,
+       file_name.translations.npy) rather than being held in memory. Each
+       row of the matrix is marked as complete (in file_name.rows.npy) once
+       it has been written to disk, and the models are described in
+       file_name.json, so that an interrupted calculation can be resumed.
+    """
+
+    def __init__(self, model_names=None, file_name=None, aligned=False,
+                 checksum=None):
+        """Constructor.
+           @param model_names the names of the models. If not given, an
+                  existing matrix is read (read-only) from file_name.
+           @param file_name prefix for the files holding the matrix. If not
+                  given, the matrix is kept in memory.
+           @param aligned whether to store the transformations that align
+                  the models
+           @param checksum a string identifying the model coordinates. The
+                  calculation is only resumed from existing files if the
+                  model names, aligned flag and checksum all match.
+        """
+        self.file_name = file_name
+        self._unflushed_rows = []
+        # incremented whenever distances are set, so that users can tell
+        # when copies of the matrix are out of date
+        self.version = 0
+        if model_names is None:
+            metadata = self._read_metadata()
+            self._set_metadata(metadata)
+            self._open_arrays('r')
+            return
+        self._set_metadata({'model_names': list(model_names),
+                            'aligned': aligned, 'checksum': checksum,
+                            'cluster_ids': None})
+        if file_name is None:
+            npairs = self._get_number_of_pairs()
+            self.distances = np.zeros(npairs)
+            self.completed_rows = np.zeros(len(self), dtype=np.uint8)
+            if self.aligned:
+                self.quaternions = np.zeros((npairs, 4))
+                self.quaternions[:, 0] = 1.
+                self.translations = np.zeros((npairs, 3))
+            return
+        metadata = None
+        if os.path.exists(file_name + ".json"):
+            metadata = self._read_metadata()
+        if (metadata is not None
+                and metadata['model_names'] == self.model_names
+                and metadata['aligned'] == self.aligned
+                and metadata['checksum'] == self.checksum):
+            self._open_arrays('r+')
+        else:
+            self._open_arrays('w+')
+            if self.aligned:
+                self.quaternions[:, 0] = 1.
+            self.flush()
+            self._write_metadata()
+
+    def _set_metadata(self, metadata):
+        self.model_names = metadata['model_names']
+        self.aligned = metadata['aligned']
+        self.checksum = metadata['checksum']
+        self.cluster_ids = metadata['cluster_ids']
+
+    def _read_metadata(self):
+        import json
+        with open(self.file_name + ".json") as fh:
+            return json.load(fh)
+
+    def _write_metadata(self):
+        import json
+        cluster_ids = self.cluster_ids
+        if cluster_ids is not None:
+            cluster_ids = [int(c) for c in cluster_ids]
+        with open(self.file_name + ".json", 'w') as fh:
+            json.dump({'model_names': self.model_names,
+                       'aligned': self.aligned, 'checksum': self.checksum,
+                       'cluster_ids': cluster_ids}, fh)
+
+    def _open_arrays(self, mode):
+        from numpy.lib.format import open_memmap
+        npairs = self._get_number_of_pairs()
+
+        def open_array(suffix, shape, dtype=np.float64):
+            return open_memmap(self.file_name + suffix, mode=mode,
+                               dtype=dtype, shape=shape)
+        self.distances = open_array(".npy", (npairs,))
+        self.completed_rows = open_array(".rows.npy", (len(self),),
+                                         np.uint8)
+        if self.aligned:
+            self.quaternions = open_array(".quaternions.npy", (npairs, 4))
+            self.translations = open_array(".translations.npy",
+                                           (npairs, 3))
+
+    def _get_number_of_pairs(self):
+        return len(self) * (len(self) - 1) // 2
+
+    def __len__(self):
+        return len(self.model_names)
+
+    def get_incomplete_rows(self):
+        """Get the indexes of the rows that have not been calculated yet"""
+        return [int(i) for i in np.flatnonzero(self.completed_rows[:-1] == 0)]
+
+    def set_row(self, i, distances, quaternions=None, translations=None):
+        """Set the distances between model i and every model j > i
+           (and the transformations that align each model j to model i).
+           The row is only marked as complete once flush() is called."""
+        start = _get_condensed_indexes(len(self), i, i + 1)
+        end = start + len(self) - i - 1
+        self.distances[start:end] = distances
+        self.version += 1
+        if self.aligned:
+            self.quaternions[start:end] = quaternions
+            self.translations[start:end] = translations
+        self._unflushed_rows.append(i)
+
+    def flush(self):
+        """Write all data to disk, and mark the rows set since the last
+           flush as complete"""
+        arrays = [self.distances]
+        if self.aligned:
+            arrays += [self.quaternions, self.translations]
+        for a in arrays:
+            if isinstance(a, np.memmap) and a.flags.writeable:
+                a.flush()
+        if self._unflushed_rows:
+            self.completed_rows[self._unflushed_rows] = 1
+            if isinstance(self.completed_rows, np.memmap):
+                self.completed_rows.flush()
+        self._unflushed_rows = []
+
+    def set_matrix(self, matrix):
+        """Set all distances from a full (n_models, n_models) matrix"""
+        n = len(self)
+        for i in range(n - 1):
+            start = _get_condensed_indexes(n, i, i + 1)
+            self.distances[start:start + n - i - 1] = matrix[i, i + 1:]
+        self.completed_rows[:] = 1
+        self.version += 1
+
+    def get_distance(self, i, j):
+        """Get the distance between models i and j"""
+        if i == j:
+            return 0.
+        i, j = min(i, j), max(i, j)
+        return float(self.distances[_get_condensed_indexes(len(self), i, j)])
+
+    def get_row(self, i):
+        """Get the distances between model i and every model"""
+        n = len(self)
+        row = np.zeros(n)
+        js = np.arange(i)
+        row[:i] = self.distances[_get_condensed_indexes(n, js, i)]
+        start = _get_condensed_indexes(n, i, i + 1)
+        row[i + 1:] = self.distances[start:start + n - i - 1]
+        return row
+
+    def get_submatrix(self, indexes):
+        """Get the (square) matrix of distances between the given models"""
+        indexes = np.asarray(indexes, dtype=int)
+        matrix = np.zeros((len(indexes), len(indexes)))
+        for k, i in enumerate(indexes):
+            js = indexes[k + 1:]
+            low, high = np.minimum(i, js), np.maximum(i, js)
+            d = self.distances[_get_condensed_indexes(len(self), low, high)]
+            matrix[k, k + 1:] = d
+            matrix[k + 1:, k] = d
+        return matrix
+
+    def get_medoid(self, indexes):
+        """Get the model, of those given, with the smallest total distance
+           to the others"""
+        indexes = np.asarray(indexes, dtype=int)
+        totals = [np.sum(self.get_row(i)[indexes]) for i in indexes]
+        return int(indexes[np.argmin(totals)])
+
+    def get_matrix(self):
+        """Get the full (n_models, n_models) matrix of distances"""
+        n = len(self)
+        matrix = np.zeros((n, n))
+        for i in range(n - 1):
+            start = _get_condensed_indexes(n, i, i + 1)
+            d = self.distances[start:start + n - i - 1]
+            matrix[i, i + 1:] = d
+            matrix[i + 1:, i] = d
+        return matrix
+
+    def get_transformation(self, i, j):
+        """Get the IMP.algebra.Transformation3D that aligns models i and j
+           (the identity if the models were not aligned)"""
+        if not self.aligned or i == j:
+            return IMP.algebra.get_identity_transformation_3d()
+        k = _get_condensed_indexes(len(self), min(i, j), max(i, j))
+        rot = IMP.algebra.Rotation3D(
+                     IMP.algebra.Vector4D(*self.quaternions[k]))
+        return IMP.algebra.Transformation3D(
+                     rot, IMP.algebra.Vector3D(*self.translations[k]))
+
+    def save(self, file_name):
+        """Save the matrix to files with the given prefix, as .npy arrays
+           and a JSON description of the models (see DistanceMatrix)"""
+        self.flush()
+        if file_name != self.file_name:
+            np.save(file_name + ".npy", self.distances)
+            np.save(file_name + ".rows.npy", self.completed_rows)
+            if self.aligned:
+                np.save(file_name + ".quaternions.npy", self.quaternions)
+                np.save(file_name + ".translations.npy", self.translations)
+        old_file_name, self.file_name = self.file_name, file_name
+        try:
+            self._write_metadata()
+        finally:
+            self.file_name = old_file_name
+
+
 # ----------------------------------
 class Violations(object):
 
@@ -210,6 +768,7 @@ class Clustering(object):
             self.number_of_processes = 1
             self.rank = 0
         self.all_coords = {}
+        self.distance_matrix = None
         self.structure_cluster_ids = None
         self.tmpl_coords = None
         self.rmsd_weights=rmsd_weights
@@ -223,46 +782,127 @@ class Clustering(object):
 
         self.all_coords[frame] = Coords
 
-    def dist_matrix(self):
+    def dist_matrix(self, file_name=None, block_size=1024,
+                    flush_size=10000000):
+        """Calculate the RMSD between every pair of models.
+           The RMSDs (and the transformations aligning the models, if a
+           template was set) are stored row by row in a condensed
+           DistanceMatrix, available as self.distance_matrix.
+           @param file_name if given, store the matrix in memory-mapped
+                  files with this prefix rather than in memory. If these
+                  files already hold a partial calculation for the same
+                  models, it is resumed.
+           @param block_size the number of models compared at once
+           @param flush_size the number of RMSDs calculated between writes
+                  to disk (when using a file)
+        """
+        coords = self._get_model_coordinates()
+        aligned = coords.alignment_protein_names is not None
+
+        # rank 0 owns the matrix; other processes calculate rows for it
+        self.distance_matrix = None
+        rows = None
+        if self.rank == 0:
+            self.distance_matrix = DistanceMatrix(
+                        self.model_list_names, file_name, aligned,
+                        coords.get_checksum())
+            rows = self.distance_matrix.get_incomplete_rows()
+        if self.number_of_processes > 1:
+            rows = self.comm.bcast(rows, root=0)
+
+        print("process %s calculating %s of %s rows"
+              % (str(self.rank),
+                 str(len(rows[self.rank::self.number_of_processes])),
+                 str(len(rows))))
+
+        unflushed = 0
+        for start in range(0, len(rows), self.number_of_processes):
+            batch = rows[start:start + self.number_of_processes]
+            result = None
+            if self.rank < len(batch):
+                result = self._get_distance_matrix_row(
+                                    coords, batch[self.rank], block_size)
+            if self.number_of_processes > 1:
+                results = self.comm.gather(result, root=0)
+            else:
+                results = [result]
+            if self.rank == 0:
+                for i, row in zip(batch, results):
+                    self.distance_matrix.set_row(i, *row)
+                    unflushed += len(row[0])
+                if unflushed >= flush_size:
+                    self.distance_matrix.flush()
+                    unflushed = 0
+        if self.rank == 0:
+            self.distance_matrix.flush()
+
+        if self.number_of_processes > 1:
+            if file_name is None:
+                self.distance_matrix = self.comm.bcast(self.distance_matrix,
+                                                       root=0)
+            else:
+                self.comm.Barrier()
+                if self.rank != 0:
+                    self.distance_matrix = DistanceMatrix(file_name=file_name)
 
+    def _get_model_coordinates(self):
+        """Get a ModelCoordinates object for all models"""
         self.model_list_names = list(self.all_coords.keys())
         self.model_indexes = list(range(len(self.model_list_names)))
         self.model_indexes_dict = dict(
             list(zip(self.model_list_names, self.model_indexes)))
-        model_indexes_unique_pairs = list(itertools.combinations(self.model_indexes, 2))
-
-        my_model_indexes_unique_pairs = IMP.pmi.tools.chunk_list_into_segments(
-            model_indexes_unique_pairs,
-            self.number_of_processes)[self.rank]
-
-        print("process %s assigned with %s pairs" % (str(self.rank), str(len(my_model_indexes_unique_pairs))))
-
-        (raw_distance_dict, self.transformation_distance_dict) = self.matrix_calculation(self.all_coords,
-                                                                                         self.tmpl_coords,
-                                                                                         my_model_indexes_unique_pairs)
-
-        if self.number_of_processes > 1:
-            raw_distance_dict = IMP.pmi.tools.scatter_and_gather(
-                raw_distance_dict)
-            pickable_transformations = self.get_pickable_transformation_distance_dict(
-            )
-            pickable_transformations = IMP.pmi.tools.scatter_and_gather(
-                pickable_transformations)
-            self.set_transformation_distance_dict_from_pickable(
-                pickable_transformations)
-
-        self.raw_distance_matrix = np.zeros(
-            (len(self.model_list_names), len(self.model_list_names)))
-        for item in raw_distance_dict:
-            (f1, f2) = item
-            self.raw_distance_matrix[f1, f2] = raw_distance_dict[item]
-            self.raw_distance_matrix[f2, f1] = raw_distance_dict[item]
+        if self.tmpl_coords is None:
+            alignment_protein_names = None
+        else:
+            alignment_protein_names = list(self.tmpl_coords.keys())
+        return ModelCoordinates(self.all_coords, self.model_list_names,
+                                self.rmsd_weights, alignment_protein_names)
+
+    def _get_distance_matrix_row(self, coords, i, block_size):
+        """Get the RMSDs (and alignments, as quaternions and translations)
+           between model i and every model j > i"""
+        n = len(coords)
+        distances = np.empty(n - i - 1)
+        quaternions = translations = None
+        if coords.alignment_protein_names is not None:
+            quaternions = np.empty((n - i - 1, 4))
+            translations = np.empty((n - i - 1, 3))
+        for start in range(i + 1, n, block_size):
+            js = np.arange(start, min(start + block_size, n))
+            rmsds, rotations, trans = coords.get_rmsds(i, js)
+            distances[js - i - 1] = rmsds
+            if quaternions is not None:
+                quaternions[js - i - 1] = _get_quaternions(rotations)
+                translations[js - i - 1] = trans
+        return distances, quaternions, translations
+
+    @property
+    def raw_distance_matrix(self):
+        """The full matrix of RMSDs, built from self.distance_matrix when
+           first needed and kept until the distances change"""
+        dm = self.distance_matrix
+        cache = getattr(self, '_raw_distance_matrix_cache', None)
+        if cache is None or cache[0] is not dm or cache[1] != dm.version:
+            cache = (dm, dm.version, dm.get_matrix())
+            self._raw_distance_matrix_cache = cache
+        return cache[2]
+
+    @property
+    def transformation_distance_dict(self):
+        """The IMP.algebra.Transformation3D aligning each pair of models,
+           keyed by (model index, model index). This is built on demand
+           from self.distance_matrix and is read-only; prefer
+           self.distance_matrix.get_transformation()."""
+        dm = self.distance_matrix
+        return dict(((i, j), dm.get_transformation(i, j))
+                    for i, j in itertools.permutations(range(len(dm)), 2))
 
     def get_dist_matrix(self):
         return self.raw_distance_matrix
 
     def do_cluster(self, number_of_clusters,seed=None):
-        """Run K-means clustering
+        """Run K-means clustering on the full distance matrix.
+        See cluster() for algorithms that scale to more models.
         @param number_of_clusters Num means
         @param seed the random seed
         """
@@ -279,45 +919,70 @@ class Clustering(object):
 
         self.structure_cluster_ids = kmeans.labels_
 
+    def cluster(self, algorithm):
+        """Cluster the models with a ClusteringAlgorithm, such as
+        LeaderClustering or MiniBatchKMedoids (which use the model
+        coordinates, so dist_matrix() need not be called first) or
+        HierarchicalClustering (which uses the condensed distance matrix).
+        @param algorithm the ClusteringAlgorithm to use
+        @return a list of IMP.pmi.output.Cluster objects, whose members
+                are model indexes
+        """
+        coordinates = None
+        if self.all_coords:
+            coordinates = self._get_model_coordinates()
+        clusters, self.structure_cluster_ids = algorithm.cluster(
+                    coordinates, self.distance_matrix)
+        return clusters
+
     def get_pickable_transformation_distance_dict(self):
         pickable_transformations = {}
-        for label in self.transformation_distance_dict:
-            tr = self.transformation_distance_dict[label]
+        n = len(self.distance_matrix)
+        for i, j in itertools.permutations(range(n), 2):
+            tr = self.distance_matrix.get_transformation(i, j)
             trans = tuple(tr.get_translation())
             rot = tuple(tr.get_rotation().get_quaternion())
-            pickable_transformations[label] = (rot, trans)
+            pickable_transformations[(i, j)] = (rot, trans)
         return pickable_transformations
 
     def set_transformation_distance_dict_from_pickable(
         self,
             pickable_transformations):
-        self.transformation_distance_dict = {}
-        for label in pickable_transformations:
-            tr = pickable_transformations[label]
-            trans = IMP.algebra.Vector3D(tr[1])
-            rot = IMP.algebra.Rotation3D(tr[0])
-            self.transformation_distance_dict[
-                label] = IMP.algebra.Transformation3D(rot, trans)
+        dm = self.distance_matrix
+        dm.aligned = True
+        npairs = dm._get_number_of_pairs()
+        dm.quaternions = np.zeros((npairs, 4))
+        dm.quaternions[:, 0] = 1.
+        dm.translations = np.zeros((npairs, 3))
+        for (i, j), (rot, trans) in pickable_transformations.items():
+            if i < j:
+                k = _get_condensed_indexes(len(dm), i, j)
+                dm.quaternions[k] = rot
+                dm.translations[k] = trans
 
     def save_distance_matrix_file(self, file_name='cluster.rawmatrix.pkl'):
-        import pickle
-        outf = open(file_name + ".data", 'wb')
-
-        # to pickle the transformation dictionary
-        # you have to save the arrays correposnding to
-        # the transformations
-
-        pickable_transformations = self.get_pickable_transformation_distance_dict(
-        )
-        pickle.dump(
-            (self.structure_cluster_ids,
-             self.model_list_names,
-             pickable_transformations),
-            outf)
-
-        np.save(file_name + ".npy", self.raw_distance_matrix)
+        """Save the distance matrix, the transformations and the cluster
+           labels, as .npy and JSON files with the given prefix
+           (see DistanceMatrix)"""
+        self.distance_matrix.cluster_ids = self.structure_cluster_ids
+        self.distance_matrix.save(file_name)
 
     def load_distance_matrix_file(self, file_name='cluster.rawmatrix.pkl'):
+        """Load a distance matrix written by save_distance_matrix_file().
+           The arrays are memory-mapped, not read into memory. Files
+           written by older versions of this class (using pickle) can
+           also be read."""
+        if os.path.exists(file_name + ".json"):
+            self.distance_matrix = DistanceMatrix(file_name=file_name)
+            self.model_list_names = self.distance_matrix.model_names
+            self.structure_cluster_ids = self.distance_matrix.cluster_ids
+        else:
+            self._load_pickled_distance_matrix_file(file_name)
+        self.model_indexes = list(range(len(self.model_list_names)))
+        self.model_indexes_dict = dict(
+            list(zip(self.model_list_names, self.model_indexes)))
+
+    def _load_pickled_distance_matrix_file(self, file_name):
         import pickle
 
         inputf = open(file_name + ".data", 'rb')
@@ -325,13 +990,10 @@ class Clustering(object):
          pickable_transformations) = pickle.load(inputf)
         inputf.close()
 
-        self.raw_distance_matrix = np.load(file_name + ".npy")
-
+        self.distance_matrix = DistanceMatrix(self.model_list_names)
+        self.distance_matrix.set_matrix(np.load(file_name + ".npy"))
         self.set_transformation_distance_dict_from_pickable(
             pickable_transformations)
-        self.model_indexes = list(range(len(self.model_list_names)))
-        self.model_indexes_dict = dict(
-            list(zip(self.model_list_names, self.model_indexes)))
 
     def plot_matrix(self, figurename="clustermatrix.pdf"):
         import matplotlib as mpl
@@ -342,7 +1004,7 @@ class Clustering(object):
         fig = pl.figure(figsize=(10,8))
         ax = fig.add_subplot(212)
         dendrogram = hrc.dendrogram(
-            hrc.linkage(self.raw_distance_matrix),
+            hrc.linkage(np.asarray(self.distance_matrix.distances)),
             color_threshold=7,
             no_labels=True)
         leaves_order = dendrogram['leaves']
@@ -350,10 +1012,9 @@ class Clustering(object):
         ax.set_ylabel('RMSD [Angstroms]')
 
         ax2 = fig.add_subplot(221)
+        leaves_order = np.asarray(leaves_order, dtype=int)
         cax = ax2.imshow(
-            self.raw_distance_matrix[leaves_order,
-                                     :][:,
-                                        leaves_order],
+            self.raw_distance_matrix[np.ix_(leaves_order, leaves_order)],
             interpolation='nearest')
         cb = fig.colorbar(cax)
         cb.set_label('RMSD [Angstroms]')
@@ -389,8 +1050,7 @@ class Clustering(object):
         indexes = self.get_cluster_label_indexes(label)
 
         if len(indexes) > 1:
-            sub_distance_matrix = self.raw_distance_matrix[
-                indexes, :][:, indexes]
+            sub_distance_matrix = self.distance_matrix.get_submatrix(indexes)
             average_rmsd = np.sum(sub_distance_matrix) / \
                 (len(sub_distance_matrix)
                  ** 2 - len(sub_distance_matrix))
@@ -406,70 +1066,255 @@ class Clustering(object):
         cluster_label,
             structure_index):
         reference = self.get_cluster_label_indexes(cluster_label)[0]
-        return self.transformation_distance_dict[(reference, structure_index)]
-
-    def matrix_calculation(self, all_coords, template_coords, list_of_pairs):
-
+        return self.distance_matrix.get_transformation(reference,
+                                                       structure_index)
+
+    def matrix_calculation(self, all_coords, template_coords, list_of_pairs,
+                           block_size=1024):
+        """Calculate the RMSD, and the transformation used to align the
+           models (if a template was given), for each pair of models.
+           The calculation is vectorized using ModelCoordinates, with the
+           pairs for each model handled in blocks of up to block_size."""
         model_list_names = list(all_coords.keys())
-        rmsd_protein_names = list(all_coords[model_list_names[0]].keys())
         raw_distance_dict = {}
         transformation_distance_dict = {}
         if template_coords is None:
-            do_alignment = False
+            alignment_protein_names = None
         else:
-            do_alignment = True
-            alignment_template_protein_names = list(template_coords.keys())
+            alignment_protein_names = list(template_coords.keys())
+        coords = ModelCoordinates(all_coords, model_list_names,
+                                  self.rmsd_weights, alignment_protein_names)
+        identity = IMP.algebra.get_identity_transformation_3d()
 
+        pairs_by_model = {}
         for (f1, f2) in list_of_pairs:
-
-            if not do_alignment:
-                # here we only get the rmsd,
-                # we need that for instance when you want to cluster conformations
-                # globally, eg the EM map is a reference
-                transformation = IMP.algebra.get_identity_transformation_3d()
-
-                coords_f1 = dict([(pr, all_coords[model_list_names[f1]][pr])
-                                 for pr in rmsd_protein_names])
-                coords_f2 = {}
-                for pr in rmsd_protein_names:
-                    coords_f2[pr] = all_coords[model_list_names[f2]][pr]
-
-                Ali = Alignment(coords_f1, coords_f2, self.rmsd_weights)
-                rmsd = Ali.get_rmsd()
-
-            elif do_alignment:
-                # here we actually align the conformations first
-                # and than calculate the rmsd. We need that when the
-                # protein(s) is the reference
-                coords_f1 = dict([(pr, all_coords[model_list_names[f1]][pr])
-                                 for pr in alignment_template_protein_names])
-                coords_f2 = dict([(pr, all_coords[model_list_names[f2]][pr])
-                                 for pr in alignment_template_protein_names])
-
-                Ali = Alignment(coords_f1, coords_f2)
-                template_rmsd, transformation = Ali.align()
-
-                # here we calculate the rmsd
-                # we will align two models based n the nuber of subunits provided
-                # and transform coordinates of model 2 to model 1
-                coords_f1 = dict([(pr, all_coords[model_list_names[f1]][pr])
-                                 for pr in rmsd_protein_names])
-                coords_f2 = {}
-                for pr in rmsd_protein_names:
-                    coords_f2[pr] = [transformation.get_transformed(
-                        i) for i in all_coords[model_list_names[f2]][pr]]
-
-                Ali = Alignment(coords_f1, coords_f2, self.rmsd_weights)
-                rmsd = Ali.get_rmsd()
-
-            raw_distance_dict[(f1, f2)] = rmsd
-            raw_distance_dict[(f2, f1)] = rmsd
-            transformation_distance_dict[(f1, f2)] = transformation
-            transformation_distance_dict[(f2, f1)] = transformation
+            pairs_by_model.setdefault(f1, []).append(f2)
+
+        for f1 in sorted(pairs_by_model.keys()):
+            f2s = pairs_by_model[f1]
+            for start in range(0, len(f2s), block_size):
+                block = f2s[start:start + block_size]
+                rmsds, rotations, translations = coords.get_rmsds(f1, block)
+                for n, f2 in enumerate(block):
+                    if rotations is None:
+                        transformation = identity
+                    else:
+                        transformation = _get_transformation_3d(
+                                           rotations[n], translations[n])
+                    rmsd = float(rmsds[n])
+                    raw_distance_dict[(f1, f2)] = rmsd
+                    raw_distance_dict[(f2, f1)] = rmsd
+                    transformation_distance_dict[(f1, f2)] = transformation
+                    transformation_distance_dict[(f2, f1)] = transformation
 
         return raw_distance_dict, transformation_distance_dict
 
 
+def get_clusters_from_labels(labels, centers=None, data=None):
+    """Make IMP.pmi.output.Cluster objects from a cluster label for each
+       model.
+       @param labels the cluster label of each model, numbered from 0
+       @param centers optional index of the center model of each cluster
+       @param data optional data for each model, stored with each member
+       @return a list of IMP.pmi.output.Cluster objects, one per label,
+               whose members are model indexes
+    """
+    clusters = [IMP.pmi.output.Cluster(n)
+                for n in range(int(np.max(labels)) + 1 if len(labels) else 0)]
+    for i, label in enumerate(labels):
+        clusters[label].add_member(i, None if data is None else data[i])
+    if centers is not None:
+        for c, center in zip(clusters, centers):
+            c.center_index = int(center)
+    return clusters
+
+
+class ClusteringAlgorithm(object):
+    """Base class for algorithms that cluster models.
+       Algorithms work either on the coordinates of the models (a
+       ModelCoordinates object) or on a condensed DistanceMatrix, so that
+       the full matrix of distances is never needed. Subclasses implement
+       get_labels().
+    """
+
+    def get_labels(self, coordinates=None, distance_matrix=None):
+        """Cluster the models.
+           @param coordinates a ModelCoordinates object
+           @param distance_matrix a DistanceMatrix object
+           @return the cluster label of each model (numbered from 0) and
+                   the index of the center model of each cluster
+        """
+        raise NotImplementedError
+
+    def cluster(self, coordinates=None, distance_matrix=None, data=None):
+        """Cluster the models.
+           @param coordinates a ModelCoordinates object
+           @param distance_matrix a DistanceMatrix object
+           @param data optional data for each model, stored in the clusters
+           @return a list of IMP.pmi.output.Cluster objects and the cluster
+                   label of each model
+        """
+        labels, centers = self.get_labels(coordinates, distance_matrix)
+        return get_clusters_from_labels(labels, centers, data), labels
+
+
+class LeaderClustering(ClusteringAlgorithm):
+    """Threshold-based (leader) clustering on model coordinates.
+       Each model in turn joins the cluster of the first leader within
+       rmsd_cutoff of it, or else becomes the leader of a new cluster. This
+       gives the same clusters as AnalysisReplicaExchange.cluster().
+       The RMSD is only calculated for the leaders that pass a cheap lower
+       bound (see ModelCoordinates.get_rmsd_lower_bounds()), and for
+       blocks of leaders at once.
+    """
+
+    def __init__(self, rmsd_cutoff=10., block_size=256):
+        """Constructor.
+           @param rmsd_cutoff the RMSD cutoff in Angstrom
+           @param block_size the number of leaders compared at once
+        """
+        self.rmsd_cutoff = rmsd_cutoff
+        self.block_size = block_size
+
+    def get_labels(self, coordinates=None, distance_matrix=None):
+        labels = np.empty(len(coordinates), dtype=int)
+        leaders = np.zeros(0, dtype=int)
+        for i in range(len(coordinates)):
+            bounds = coordinates.get_rmsd_lower_bounds(i, leaders)
+            candidates = np.flatnonzero(bounds < self.rmsd_cutoff)
+            label = None
+            for start in range(0, len(candidates), self.block_size):
+                block = candidates[start:start + self.block_size]
+                rmsds = coordinates.get_rmsds(i, leaders[block])[0]
+                close = np.flatnonzero(rmsds < self.rmsd_cutoff)
+                if len(close) > 0:
+                    label = block[close[0]]
+                    break
+            if label is None:
+                label = len(leaders)
+                leaders = np.append(leaders, i)
+            labels[i] = label
+        return labels, leaders
+
+
+class MiniBatchKMedoids(ClusteringAlgorithm):
+    """k-medoids clustering on model coordinates, using mini-batches.
+       The medoids are chosen by k-medoids++ from a random sample of
+       models, then refined using a new random batch of models at each
+       iteration, so each iteration needs only O(batch_size^2) RMSDs.
+       Finally each model is assigned to its nearest medoid.
+    """
+
+    def __init__(self, number_of_clusters, batch_size=1000,
+                 max_iterations=100, seed=None):
+        """Constructor.
+           @param number_of_clusters the number of clusters
+           @param batch_size the number of models used in each iteration
+           @param max_iterations the maximum number of iterations
+           @param seed the random seed
+        """
+        self.number_of_clusters = number_of_clusters
+        self.batch_size = batch_size
+        self.max_iterations = max_iterations
+        self.seed = seed
+
+    def _get_distances(self, coordinates, medoids, models):
+        """Get the (medoids, models) array of RMSDs"""
+        return np.array([coordinates.get_rmsds(m, models)[0]
+                         for m in medoids]).reshape(len(medoids), len(models))
+
+    def _get_batch(self, rng, nmodels):
+        return np.sort(rng.choice(nmodels, min(nmodels, self.batch_size),
+                                  replace=False))
+
+    def _get_initial_medoids(self, coordinates, rng):
+        sample = self._get_batch(rng, len(coordinates))
+        medoids = [sample[rng.randint(len(sample))]]
+        distances = self._get_distances(coordinates, medoids, sample)[0]
+        while len(medoids) < min(self.number_of_clusters, len(coordinates)):
+            weights = distances ** 2
+            if np.sum(weights) > 0.:
+                new = sample[rng.choice(len(sample),
+                                        p=weights / np.sum(weights))]
+            else:
+                new = rng.choice(np.setdiff1d(np.arange(len(coordinates)),
+                                              medoids))
+            medoids.append(new)
+            distances = np.minimum(distances, self._get_distances(
+                                        coordinates, [new], sample)[0])
+        return np.array(medoids, dtype=int)
+
+    def get_labels(self, coordinates=None, distance_matrix=None):
+        rng = np.random.RandomState(self.seed)
+        medoids = self._get_initial_medoids(coordinates, rng)
+        for iteration in range(self.max_iterations):
+            batch = self._get_batch(rng, len(coordinates))
+            nearest = np.argmin(self._get_distances(coordinates, medoids,
+                                                    batch), axis=0)
+            changed = False
+            for c, medoid in enumerate(medoids):
+                members = batch[nearest == c]
+                members = members[members != medoid]
+                if len(members) == 0:
+                    continue
+                # the current medoid is listed first, so is kept on a tie
+                candidates = np.append(medoid, members)
+                costs = [np.sum(coordinates.get_rmsds(m, members)[0])
+                         for m in candidates]
+                best = candidates[int(np.argmin(costs))]
+                if best != medoid:
+                    medoids[c] = best
+                    changed = True
+            if not changed:
+                break
+        labels = np.argmin(self._get_distances(
+                      coordinates, medoids, np.arange(len(coordinates))),
+                      axis=0)
+        labels[medoids] = np.arange(len(medoids))
+        return labels, medoids
+
+
+class HierarchicalClustering(ClusteringAlgorithm):
+    """Agglomerative hierarchical clustering on a condensed DistanceMatrix,
+       using scipy.cluster.hierarchy.
+       The tree is cut either to give a number of clusters or at an RMSD
+       cutoff.
+    """
+
+    def __init__(self, number_of_clusters=None, rmsd_cutoff=None,
+                 method='average'):
+        """Constructor.
+           @param number_of_clusters the maximum number of clusters
+           @param rmsd_cutoff alternatively, the RMSD at which to cut
+                  the tree
+           @param method the linkage method (see
+                  scipy.cluster.hierarchy.linkage)
+        """
+        if (number_of_clusters is None) == (rmsd_cutoff is None):
+            raise ValueError("Give one of number_of_clusters "
+                             "or rmsd_cutoff")
+        self.number_of_clusters = number_of_clusters
+        self.rmsd_cutoff = rmsd_cutoff
+        self.method = method
+
+    def get_labels(self, coordinates=None, distance_matrix=None):
+        from scipy.cluster import hierarchy
+        if len(distance_matrix) < 2:
+            return np.zeros(len(distance_matrix), dtype=int), [0]
+        z = hierarchy.linkage(np.asarray(distance_matrix.distances),
+                              method=self.method)
+        if self.number_of_clusters is not None:
+            flat = hierarchy.fcluster(z, self.number_of_clusters,
+                                      criterion='maxclust')
+        else:
+            flat = hierarchy.fcluster(z, self.rmsd_cutoff,
+                                      criterion='distance')
+        labels = np.unique(flat, return_inverse=True)[1]
+        centers = [distance_matrix.get_medoid(np.flatnonzero(labels == c))
+                   for c in range(np.max(labels) + 1)]
+        return labels, centers
+
+
 class RMSD(object):
     """Compute the RMSD (without alignment) taking into account the copy ambiguity.
     To be used with pmi2 hierarchies. Can be used for instance as follows:
@@ -590,11 +1435,210 @@ class RMSD(object):
 
 
 
+class _StructureDistances(object):
+    """Compute distances between structures with one of the Precision
+       styles, working on NumPy arrays of coordinates.
+
+       Each structure is first converted to a feature vector: its flattened
+       coordinates for RMSD, or the distances between all pairs of its
+       particles for the DRMSD-like styles. Distances between two sets of
+       structures are then computed a row at a time from these vectors,
+       so that each structure's internal distances are computed only once.
+       Rows are split between threads (NumPy releases the GIL for the
+       array arithmetic).
+    """
+    def __init__(self, style, threshold=None, number_of_threads=1,
+                 max_elements=2**22):
+        """
+        @param style one of the Precision styles
+        @param threshold distance cutoff for the pairwise_drmsd_Q style
+        @param number_of_threads the number of threads to use
+        @param max_elements the most array elements to use for temporary
+               storage per thread
+        """
+        if style not in ('pairwise_rmsd', 'pairwise_drmsd_k',
+                         'pairwise_drms_k', 'pairwise_drmsd_Q'):
+            raise ValueError("Style %s is not supported" % style)
+        self.style = style
+        self.threshold = threshold
+        self.number_of_threads = number_of_threads
+        self.max_elements = max_elements
+
+    def get_feature_kind(self):
+        """Get the kind of feature vector used by the style; styles with
+           the same kind can share feature vectors"""
+        if self.style == 'pairwise_rmsd':
+            return 'coordinates'
+        else:
+            return 'distances'
+
+    def get_features(self, coords, dtype=np.float64):
+        """Get the feature vector of each of a set of structures.
+           @param coords coordinates, of shape (nstructures, nparticles, 3)
+           @param dtype the NumPy type of the returned vectors
+        """
+        coords = np.asarray(coords, dtype=float)
+        if coords.ndim != 3:
+            coords = coords.reshape(len(coords), -1, 3)
+        if self.get_feature_kind() == 'coordinates':
+            return coords.reshape(len(coords), -1).astype(dtype)
+        i, j = np.triu_indices(coords.shape[1], k=1)
+        features = np.empty((len(coords), len(i)), dtype=dtype)
+        for n, c in enumerate(coords):
+            features[n] = np.sqrt(((c[i] - c[j]) ** 2).sum(axis=1))
+        return features
+
+    def get_row(self, feature, features):
+        """Get the distances from one structure to each of a set of
+           structures, given their feature vectors"""
+        if self.style == 'pairwise_rmsd':
+            norm = features.shape[1] // 3
+        else:
+            norm = features.shape[1]
+        step = max(1, self.max_elements // max(1, features.shape[1]))
+        row = np.empty(len(features))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for start in range(0, len(features), step):
+                block = features[start:start + step]
+                diff = block - feature
+                # accumulate in double precision, even for float32 features
+                if self.style == 'pairwise_drmsd_Q':
+                    mask = ((block <= self.threshold)
+                            | (feature <= self.threshold))
+                    row[start:start + step] = np.sqrt(
+                             (diff ** 2 * mask).sum(axis=1, dtype=np.float64)
+                             / mask.sum(axis=1))
+                else:
+                    row[start:start + step] = np.sqrt(
+                             np.einsum('ij,ij->i', diff, diff,
+                                       dtype=np.float64) / norm)
+        return row
+
+    def get_matrix(self, features1, features2):
+        """Get the matrix of distances between two sets of structures,
+           given their feature vectors"""
+        def get_row(feature):
+            return self.get_row(feature, features2)
+        if self.number_of_threads > 1 and len(features1) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.number_of_threads)
+            try:
+                rows = pool.map(get_row, features1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            rows = [get_row(f) for f in features1]
+        return np.array(rows).reshape(len(features1), len(features2))
+
+
+class CoordinateAccumulator(object):
+    """Accumulate statistics of particle coordinates over a set of frames,
+       in a single pass.
+
+       Each frame (the coordinates of the same particles, usually after
+       alignment) is added once, and the per-particle mean and variance are
+       updated with Welford's algorithm, so that frames need not be kept.
+       This gives the root mean square fluctuation (RMSF) of each particle,
+       the mean structure, the precision of the frames and an estimate of
+       their centroid. Accumulators filled separately (e.g. by several MPI
+       processes) can be combined with merge().
+    """
+    def __init__(self):
+        self.number_of_frames = 0
+        self._mean = None
+        # sum over frames of the squared distance of each particle
+        # from its mean position
+        self._m2 = None
+        self._centroid = None
+        self._centroid_coordinates = None
+
+    def add(self, coordinates, frame=None):
+        """Add a frame.
+           @param coordinates the particle coordinates, a list of
+                  (x,y,z) or an array of shape (nparticles, 3)
+           @param frame an identifier for the frame, as returned by
+                  get_centroid()
+        """
+        coordinates = np.array(coordinates, dtype=float).reshape(-1, 3)
+        if self._mean is None:
+            self._mean = np.zeros_like(coordinates)
+            self._m2 = np.zeros(len(coordinates))
+        elif coordinates.shape != self._mean.shape:
+            raise ValueError("Expected coordinates of %d particles, got %d"
+                             % (len(self._mean), len(coordinates)))
+        self.number_of_frames += 1
+        delta = coordinates - self._mean
+        self._mean += delta / self.number_of_frames
+        self._m2 += (delta * (coordinates - self._mean)).sum(axis=1)
+        self._update_centroid(frame, coordinates)
+
+    def merge(self, other):
+        """Add all the frames accumulated by another CoordinateAccumulator"""
+        if other.number_of_frames == 0:
+            return
+        if self.number_of_frames == 0:
+            self.number_of_frames = other.number_of_frames
+            self._mean = other._mean.copy()
+            self._m2 = other._m2.copy()
+            self._centroid = other._centroid
+            self._centroid_coordinates = other._centroid_coordinates
+            return
+        if other._mean.shape != self._mean.shape:
+            raise ValueError("Cannot merge statistics of different particles")
+        n = self.number_of_frames + other.number_of_frames
+        delta = other._mean - self._mean
+        self._m2 += other._m2 + ((delta ** 2).sum(axis=1)
+                                 * self.number_of_frames
+                                 * other.number_of_frames / float(n))
+        self._mean += delta * other.number_of_frames / float(n)
+        self.number_of_frames = n
+        self._update_centroid(other._centroid, other._centroid_coordinates)
+
+    def _update_centroid(self, frame, coordinates):
+        """Keep whichever of the current centroid estimate and the given
+           frame is closer to the current mean"""
+        def get_msd(c):
+            return ((c - self._mean) ** 2).sum()
+        if (self._centroid_coordinates is None
+                or get_msd(coordinates) < get_msd(self._centroid_coordinates)):
+            self._centroid = frame
+            self._centroid_coordinates = coordinates
+
+    def __len__(self):
+        return self.number_of_frames
+
+    def get_mean(self):
+        """Get the mean coordinates of each particle"""
+        return self._mean.copy()
+
+    def get_rmsf(self):
+        """Get the root mean square fluctuation of each particle about
+           its mean position"""
+        return np.sqrt(self._m2 / self.number_of_frames)
+
+    def get_precision(self):
+        """Get the root mean square deviation (without alignment) between
+           pairs of different frames"""
+        if self.number_of_frames < 2:
+            return 0.
+        msd = 2. * self._m2.sum() / (len(self._m2) * (self.number_of_frames - 1))
+        return sqrt(msd)
+
+    def get_centroid(self):
+        """Get an estimate of the centroid, as the frame identifier
+           given to add(). As each frame is added, whichever of it and the
+           current estimate is closer to the running mean is kept, so this
+           is not necessarily the frame closest to the final mean."""
+        return self._centroid
+
+
 class Precision(object):
     """A class to evaluate the precision of an ensemble.
 
     Also can evaluate the cross-precision of multiple ensembles.
-    Supports MPI for coordinate reading.
+    Supports MPI for coordinate reading, and MPI and/or threads for
+    computing distances.
     Recommended procedure:
       -# initialize object and pass the selection for evaluating precision
       -# call add_structures() to read in the data (specify group name)
@@ -603,7 +1647,9 @@ class Precision(object):
     """
     def __init__(self,model,
                  resolution=1,
-                 selection_dictionary={}):
+                 selection_dictionary={},
+                 number_of_threads=1,
+                 single_precision=False):
         """Constructor.
            @param model The IMP Model
            @param resolution Use 1 or 10 (kluge: requires that "_Res:X" is
@@ -611,6 +1657,11 @@ class Precision(object):
            @param selection_dictionary Dictionary where keys are names for
                   selections and values are selection tuples for scoring
                   precision. "All" is automatically made as well
+           @param number_of_threads Number of threads used (in each MPI
+                  process) to compute distances between structures
+           @param single_precision Store the distances between particles
+                  of each structure (used by the DRMSD-like styles) as
+                  32-bit floats, halving their memory use
         """
         try:
             from mpi4py import MPI
@@ -636,6 +1687,12 @@ class Precision(object):
         self.reference_prot = None
         self.selection_dictionary = selection_dictionary
         self.threshold = 40.0
+        self.number_of_threads = number_of_threads
+        self._features_dtype = np.float32 if single_precision else np.float64
+        # per-structure feature vectors, keyed by (structure set name,
+        # selection name, kind), see _StructureDistances, as (buffer,
+        # number of rows used) tuples
+        self._features = {}
         self.residue_particle_index_map = None
         self.prots = None
         if resolution in [1,10]:
@@ -769,6 +1826,10 @@ class Precision(object):
                     self.comm.send(self.structures_dictionary, dest=i, tag=11)
             if self.rank != 0:
                 self.structures_dictionary = self.comm.recv(source=0, tag=11)
+            # the structures were reordered, so recompute the features
+            for key in list(self._features.keys()):
+                if key[0] == structure_set_name:
+                    del self._features[key]
 
     def _get_residue_particle_index_map(self,prot_name,structure,hier):
         # Creates map from all particles to residue numbers
@@ -824,33 +1885,65 @@ class Precision(object):
                      index1,
                      index2):
         """ Compute distance between structures with various metrics """
-        c1 = self.structures_dictionary[structure_set_name1][selection_name][index1]
-        c2 = self.structures_dictionary[structure_set_name2][selection_name][index2]
-        coordinates1 = [IMP.algebra.Vector3D(c) for c in c1]
-        coordinates2 = [IMP.algebra.Vector3D(c) for c in c2]
-
-        if self.style=='pairwise_drmsd_k':
-            distance=IMP.atom.get_drmsd(coordinates1,coordinates2)
-        if self.style=='pairwise_drms_k':
-            distance=IMP.atom.get_drms(coordinates1,coordinates2)
-        if self.style=='pairwise_drmsd_Q':
-            distance=IMP.atom.get_drmsd_Q(coordinates1,coordinates2,self.threshold)
-
-        if self.style=='pairwise_rmsd':
-            distance=IMP.algebra.get_rmsd(coordinates1,coordinates2)
-        return distance
+        f1 = self._get_features(structure_set_name1, selection_name)
+        f2 = self._get_features(structure_set_name2, selection_name)
+        return self._get_engine().get_row(f1[index1], f2[index2:index2+1])[0]
+
+    def _get_engine(self):
+        return _StructureDistances(self.style, self.threshold,
+                                   self.number_of_threads)
+
+    def _get_coordinates(self, structure_set_name, selection_name, start=0):
+        """Get the coordinates of a selection in a structure set, from
+           structure start onwards, as an array of shape
+           (nstructures, nparticles, 3)"""
+        coords = self.structures_dictionary[structure_set_name][selection_name]
+        nparticles = len(coords[0]) if coords else 0
+        return np.array(coords[start:], dtype=float).reshape(
+                                      len(coords) - start, nparticles, 3)
+
+    def _get_features(self, structure_set_name, selection_name):
+        """Get the feature vectors of a selection in a structure set for
+           the current style (see _StructureDistances), as an array with
+           one row per structure. Vectors are computed only once for each
+           structure, when first needed, and stored in a buffer that
+           grows as structures are added."""
+        engine = self._get_engine()
+        kind = engine.get_feature_kind()
+        key = (structure_set_name, selection_name, kind)
+        dtype = self._features_dtype if kind == 'distances' else np.float64
+        nstructures = len(self.structures_dictionary[structure_set_name]
+                                                    [selection_name])
+        buf, count = self._features.get(key, (None, 0))
+        if count > nstructures:
+            buf, count = None, 0
+        if count < nstructures:
+            coords = self._get_coordinates(structure_set_name,
+                                           selection_name, count)
+            new = engine.get_features(coords, dtype)
+            if buf is None:
+                buf = np.empty((nstructures, new.shape[1]), dtype=dtype)
+            elif len(buf) < nstructures:
+                # double the buffer, to add structures in amortized
+                # constant time
+                grown = np.empty((max(nstructures, 2 * len(buf)),
+                                  buf.shape[1]), dtype=dtype)
+                grown[:count] = buf[:count]
+                buf = grown
+            buf[count:nstructures] = new
+            count = nstructures
+            self._features[key] = (buf, count)
+        if buf is None:
+            return np.empty((0, 0), dtype=dtype)
+        return buf[:count]
 
     def _get_particle_distances(self,structure_set_name1,structure_set_name2,
                                selection_name,index1,index2):
         c1 = self.structures_dictionary[structure_set_name1][selection_name][index1]
         c2 = self.structures_dictionary[structure_set_name2][selection_name][index2]
-
-        coordinates1 = [IMP.algebra.Vector3D(c) for c in c1]
-        coordinates2 = [IMP.algebra.Vector3D(c) for c in c2]
-
-        distances=[np.linalg.norm(a-b) for (a,b) in zip(coordinates1,coordinates2)]
-
-        return distances
+        c1 = np.array(c1, dtype=float).reshape(-1, 3)
+        c2 = np.array(c2, dtype=float).reshape(-1, 3)
+        return np.sqrt(((c1 - c2) ** 2).sum(axis=1))
 
     def get_precision(self,
                       structure_set_name1,
@@ -881,26 +1974,27 @@ class Precision(object):
         if outfile is not None:
             of = open(outfile,"w")
         centroid_index = 0
+        engine = self._get_engine()
         for selection_name in sel_keys:
-            number_of_structures_1 = len(self.structures_dictionary[structure_set_name1][selection_name])
-            number_of_structures_2 = len(self.structures_dictionary[structure_set_name2][selection_name])
-            distances={}
+            features_1 = self._get_features(structure_set_name1, selection_name)
+            features_2 = self._get_features(structure_set_name2, selection_name)
+            number_of_structures_1 = len(features_1)
+            number_of_structures_2 = len(features_2)
             structure_pointers_1 = list(range(0,number_of_structures_1,skip))
             structure_pointers_2 = list(range(0,number_of_structures_2,skip))
-            pair_combination_list = list(itertools.product(structure_pointers_1,structure_pointers_2))
-            if len(pair_combination_list)==0:
+            if len(structure_pointers_1)==0 or len(structure_pointers_2)==0:
                 raise ValueError("no structure selected. Check the skip parameter.")
 
-            # compute pairwise distances in parallel
-            my_pair_combination_list = IMP.pmi.tools.chunk_list_into_segments(
-                pair_combination_list,self.number_of_processes)[self.rank]
-            my_length = len(my_pair_combination_list)
-            for n,pair in enumerate(my_pair_combination_list):
-                progression = int(float(n)/my_length*100.0)
-                distances[pair] = self._get_distance(structure_set_name1,structure_set_name2,
-                                                     selection_name,pair[0],pair[1])
+            # compute pairwise distances in parallel, split by rows
+            segments = IMP.pmi.tools.chunk_list_into_segments(
+                structure_pointers_1,self.number_of_processes)
+            my_rows = segments[self.rank] if self.rank < len(segments) else []
+            rows = engine.get_matrix(features_1[my_rows],
+                                     features_2[structure_pointers_2])
+            distances = dict(zip(my_rows, rows))
             if self.number_of_processes > 1:
                 distances = IMP.pmi.tools.scatter_and_gather(distances)
+            distance_matrix = np.array([distances[n] for n in structure_pointers_1])
 
             # Finally compute distance to centroid
             if self.rank == 0:
@@ -908,40 +2002,18 @@ class Precision(object):
                     structure_pointers = structure_pointers_1
                     number_of_structures = number_of_structures_1
 
-                    # calculate the distance from the first centroid
-                    #  and determine the centroid
-                    distance = 0.0
-                    distances_to_structure = {}
-                    distances_to_structure_normalization = {}
-
-                    for n in structure_pointers:
-                        distances_to_structure[n] = 0.0
-                        distances_to_structure_normalization[n]=0
-
-                    for k in distances:
-                        distance += distances[k]
-                        distances_to_structure[k[0]] += distances[k]
-                        distances_to_structure[k[1]] += distances[k]
-                        distances_to_structure_normalization[k[0]] += 1
-                        distances_to_structure_normalization[k[1]] += 1
-
-                    for n in structure_pointers:
-                        distances_to_structure[n] = distances_to_structure[n]/distances_to_structure_normalization[n]
-
-                    min_distance = min([distances_to_structure[n] for n in distances_to_structure])
-                    centroid_index = [k for k, v in distances_to_structure.items() if v == min_distance][0]
+                    # the centroid has the smallest average distance to
+                    # the other structures
+                    distances_to_structure = ((distance_matrix.sum(axis=0)
+                                               + distance_matrix.sum(axis=1))
+                                              / (2. * len(structure_pointers)))
+                    centroid_index = structure_pointers[
+                                           int(np.argmin(distances_to_structure))]
                     centroid_rmf_name = self.rmf_names_frames[structure_set_name1][centroid_index]
 
-                    centroid_distance = 0.0
-                    distance_list = []
-                    for n in range(number_of_structures):
-                        dist = self._get_distance(structure_set_name1,structure_set_name1,
-                                                             selection_name,centroid_index,n)
-                        centroid_distance += dist
-                        distance_list.append(dist)
-
-                    #pairwise_distance=distance/len(distances.keys())
-                    centroid_distance /= number_of_structures
+                    distance_list = engine.get_row(features_1[centroid_index],
+                                                   features_1)
+                    centroid_distance = float(distance_list.mean())
                     #average_centroid_distance=sum(distances_to_structure)/len(distances_to_structure)
                     if outfile is not None:
                         of.write(str(selection_name)+" "+structure_set_name1+
@@ -953,7 +2025,7 @@ class Precision(object):
                         of.write(str(selection_name)+" "+structure_set_name1+
                                         " median centroid distance  "+str(np.median(distance_list))+"\n")
 
-                average_pairwise_distances=sum(distances.values())/len(list(distances.values()))
+                average_pairwise_distances=float(distance_matrix.mean())
                 if outfile is not None:
                     of.write(str(selection_name)+" "+structure_set_name1+" "+structure_set_name2+
                              " average pairwise distance "+str(average_pairwise_distances)+"\n")
@@ -989,28 +2061,23 @@ class Precision(object):
                 rpim = self.residue_particle_index_map[sel_name]
                 outfile = outdir+"/rmsf."+sel_name+".dat"
                 of = open(outfile,"w")
-                residue_distances = {}
-                residue_nblock = {}
-                for index in range(number_of_structures):
-                    distances = self._get_particle_distances(structure_set_name,
-                                                             structure_set_name,
-                                                             sel_name,
-                                                             centroid_index,index)
-                    for nblock,block in enumerate(rpim):
-                        for residue_number in block:
-                            residue_nblock[residue_number] = nblock
-                            if residue_number not in residue_distances:
-                                residue_distances[residue_number] = [distances[nblock]]
-                            else:
-                                residue_distances[residue_number].append(distances[nblock])
+                # distances of each particle from the centroid, in all
+                # structures, as an array of shape (nstructures, nparticles)
+                coords = self._get_coordinates(structure_set_name, sel_name)
+                distances = np.sqrt(((coords - coords[centroid_index]) ** 2
+                                     ).sum(axis=2))
+                residue_nblocks = IMP.pmi.tools.OrderedDict()
+                for nblock,block in enumerate(rpim):
+                    for residue_number in block:
+                        residue_nblocks.setdefault(residue_number, []).append(nblock)
 
                 residues = []
                 rmsfs = []
-                for rn in residue_distances:
+                for rn in residue_nblocks:
                     residues.append(rn)
-                    rmsf = np.std(residue_distances[rn])
+                    rmsf = float(np.std(distances[:, residue_nblocks[rn]]))
                     rmsfs.append(rmsf)
-                    of.write(str(rn)+" "+str(residue_nblock[rn])+" "+str(rmsf)+"\n")
+                    of.write(str(rn)+" "+str(residue_nblocks[rn][-1])+" "+str(rmsf)+"\n")
 
                 IMP.pmi.output.plot_xy_data(residues,rmsfs,title=sel_name,
                                             out_fn=outdir+"/rmsf."+sel_name,display=False,
@@ -1073,21 +2140,13 @@ class Precision(object):
         if self.reference_structures_dictionary=={}:
             print("Cannot compute until you set a reference structure")
             return
+        engine = self._get_engine()
         for selection_name in self.selection_dictionary:
             reference_coordinates = self.reference_structures_dictionary[selection_name]
-            coordinates2 = [IMP.algebra.Vector3D(c) for c in reference_coordinates]
-            distances = []
-            for sc in self.structures_dictionary[structure_set_name][selection_name]:
-                coordinates1 = [IMP.algebra.Vector3D(c) for c in sc]
-                if self.style=='pairwise_drmsd_k':
-                    distance = IMP.atom.get_drmsd(coordinates1,coordinates2)
-                if self.style=='pairwise_drms_k':
-                    distance = IMP.atom.get_drms(coordinates1,coordinates2)
-                if self.style=='pairwise_drmsd_Q':
-                    distance = IMP.atom.get_drmsd_Q(coordinates1,coordinates2,self.threshold)
-                if self.style=='pairwise_rmsd':
-                    distance = IMP.algebra.get_rmsd(coordinates1,coordinates2)
-                distances.append(distance)
+            reference_features = engine.get_features([reference_coordinates])
+            features = self._get_features(structure_set_name, selection_name)
+            distances = [float(d) for d in engine.get_row(reference_features[0],
+                                                          features)]
 
             print(selection_name,"average distance",sum(distances)/len(distances),"minimum distance",min(distances),'nframes',len(distances))
             ret[selection_name] = {'average_distance':sum(distances)/len(distances),'minimum_distance':min(distances)}
@@ -1103,15 +2162,91 @@ class Precision(object):
             raise ValueError("No such style")
 
 
+def _add_gaussians(args):
+    """Sum the Gaussian densities of many particles on a grid.
+       This is a top-level function so that it can be run in a
+       multiprocessing pool; see GetModelDensity.
+       @param args a tuple of the particle coordinates, masses and widths
+              (sigma), the voxel size, the index of the first grid point
+              and the grid shape (nx, ny, nz). Grid point (i,j,k) is at
+              ((first[0]+i)*voxel, (first[1]+j)*voxel, (first[2]+k)*voxel).
+       @return the flattened grid, with x varying fastest
+    """
+    coords, masses, sigmas, voxel, first, shape, max_elements = args
+    values = np.zeros(shape[0] * shape[1] * shape[2])
+    if len(coords) == 0:
+        return values
+    # as for IMP.em.SampledDensityMap, the kernel is cut off at 3 sigma
+    halfwidths = np.ceil(3. * sigmas / voxel).astype(int)
+    centers = np.round(coords / voxel).astype(int)
+    for halfwidth in np.unique(halfwidths):
+        r = np.arange(-halfwidth, halfwidth + 1)
+        offsets = np.array(np.meshgrid(r, r, r, indexing='ij')).reshape(3, -1).T
+        which = np.flatnonzero(halfwidths == halfwidth)
+        step = max(1, max_elements // len(offsets))
+        for chunk in range(0, len(which), step):
+            ps = which[chunk:chunk + step]
+            points = centers[ps][:, np.newaxis, :] + offsets
+            d2 = ((points * voxel - coords[ps][:, np.newaxis, :]) ** 2).sum(axis=2)
+            sig2 = (sigmas[ps] ** 2)[:, np.newaxis]
+            norm = masses[ps][:, np.newaxis] / (2. * np.pi * sig2) ** 1.5
+            weights = norm * np.exp(-0.5 * d2 / sig2) * (d2 <= 9. * sig2)
+            points = points - first
+            flat = (points[:, :, 0] + shape[0] * (points[:, :, 1]
+                                   + shape[1] * points[:, :, 2])).ravel()
+            values += np.bincount(flat, weights.ravel(),
+                                  minlength=len(values))
+    return values
+
+
+def _write_mrc_file(file_name, grid, voxel, origin):
+    """Write a grid of densities to an MRC file, as IMP.em.write_map
+       does with IMP.em.MRCReaderWriter (as 32-bit floats).
+       @param file_name the file to write
+       @param grid the densities, as an array of shape (nz, ny, nx)
+       @param voxel the voxel size
+       @param origin the coordinates of the first voxel
+    """
+    data = np.ascontiguousarray(grid, dtype='<f4')
+    nz, ny, nx = data.shape
+    header = np.zeros(256, dtype='<i4')
+    header[:3] = (nx, ny, nz)
+    header[3] = 2  # mode: 32-bit floats
+    header[7:10] = (nx, ny, nz)
+    fheader = header.view('<f4')
+    fheader[10:13] = (nx * voxel, ny * voxel, nz * voxel)
+    fheader[13:16] = 90.
+    header[16:19] = (1, 2, 3)
+    header[27] = 20140  # MRC2014 format
+    if data.size:
+        fheader[19:22] = (data.min(), data.max(), data.mean())
+        fheader[54] = data.std()
+    fheader[49:52] = origin
+    header[52] = np.frombuffer(b'MAP ', dtype='<i4')[0]
+    # machine stamp for little-endian data
+    header[53] = np.frombuffer(b'\x44\x44\x00\x00', dtype='<i4')[0]
+    with open(file_name, 'wb') as fh:
+        fh.write(header.tobytes())
+        fh.write(data.tobytes())
+
+
 class GetModelDensity(object):
     """Compute mean density maps from structures.
 
     Keeps a dictionary of density maps,
     keys are in the custom ranges. When you call add_subunits_density, it adds
     particle coordinates to the existing density maps.
+
+    The particles of each density are selected only once (unless the
+    selection depends on copy indexes, which can change from frame to frame),
+    and the coordinates of each frame are only stored until batch_size
+    frames have been added. The batch is then added to a NumPy grid in one
+    go, optionally split between nproc worker processes.
+    Maps are written to MRC files directly from these grids.
     """
 
-    def __init__(self, custom_ranges, representation=None, resolution=20.0, voxel=5.0):
+    def __init__(self, custom_ranges, representation=None, resolution=20.0,
+                 voxel=5.0, batch_size=100, nproc=1):
         """Constructor.
            @param custom_ranges  Required. It's a dictionary, keys are the
                   density component names, values are selection tuples
@@ -1123,14 +2258,98 @@ class GetModelDensity(object):
                           Not needed if you only pass hierarchies
            @param resolution The MRC resolution of the output map (in Angstrom unit)
            @param voxel The voxel size for the output map (lower is slower)
+           @param batch_size The number of frames to add to the maps at once
+           @param nproc The number of worker processes used to add a batch
         """
 
         self.representation = representation
         self.MRCresolution = resolution
         self.voxel = voxel
+        self.batch_size = batch_size
+        self.nproc = nproc
         self.densities = {}
         self.count_models = 0.0
         self.custom_ranges = custom_ranges
+        # for each density, the index of the first grid point, and the grid
+        self._grids = {}
+        # for each density, (coordinates, masses, sigmas) of frames not
+        # yet added to the grid
+        self._pending = {}
+        # selected particles, for the last hierarchy seen
+        self._particles_key = None
+        self._particles = {}
+        # worker processes, started when first needed
+        self._pool = None
+
+    def __del__(self):
+        if getattr(self, '_pool', None) is not None:
+            self._pool.close()
+
+    def _get_pool(self):
+        """Get the pool of nproc worker processes"""
+        if self._pool is None:
+            import multiprocessing
+            self._pool = multiprocessing.Pool(self.nproc)
+        return self._pool
+
+    def _get_is_copy_dependent(self, density_name):
+        """Return True if the selection of a density uses copy indexes"""
+        return any(type(seg) == tuple and len(seg) in (2, 4)
+                   for seg in self.custom_ranges[density_name])
+
+    def _select_particles(self, density_name, hierarchy,
+                          all_particles_by_resolution):
+        parts = []
+        if hierarchy:
+            all_particles_by_segments = []
+
+        for seg in self.custom_ranges[density_name]:
+            if not hierarchy:
+                # when you have a IMP.pmi.representation.Representation class
+                parts += IMP.tools.select_by_tuple(self.representation,
+                                                   seg, resolution=1, name_is_ambiguous=False)
+            else:
+                # else, when you have a hierarchy, but not a representation
+                if not IMP.pmi.get_is_canonical(hierarchy):
+                    for h in hierarchy.get_children():
+                        if not IMP.atom.Molecule.get_is_setup(h):
+                            IMP.atom.Molecule.setup_particle(h.get_particle())
+
+                if type(seg) == str:
+                    s = IMP.atom.Selection(hierarchy,molecule=seg)
+                elif type(seg) == tuple and len(seg) == 2:
+                    s = IMP.atom.Selection(
+                        hierarchy, molecule=seg[0],copy_index=seg[1])
+                elif type(seg) == tuple and len(seg) == 3:
+                    s = IMP.atom.Selection(
+                        hierarchy, molecule=seg[2],residue_indexes=range(seg[0], seg[1] + 1))
+                elif type(seg) == tuple and len(seg) == 4:
+                    s = IMP.atom.Selection(
+                        hierarchy, molecule=seg[2],residue_indexes=range(seg[0], seg[1] + 1),copy_index=seg[3])
+                else:
+                    raise Exception('could not understand selection tuple '+str(seg))
+
+                all_particles_by_segments += s.get_selected_particles()
+        if hierarchy:
+            if IMP.pmi.get_is_canonical(hierarchy):
+                parts = all_particles_by_segments
+            else:
+                parts = list(
+                    set(all_particles_by_segments) & set(all_particles_by_resolution))
+        return parts
+
+    def _get_particle_data(self, parts):
+        """Get the model, particle indexes, masses and kernel widths
+           of particles"""
+        indexes = [p.get_index() for p in parts]
+        masses = np.array([IMP.atom.Mass(p).get_mass()
+                           if IMP.atom.Mass.get_is_setup(p) else 1.0
+                           for p in parts])
+        radii = np.array([IMP.core.XYZR(p).get_radius() for p in parts])
+        # Gaussian width from the resolution (as defined by EMAN) and
+        # the particle radius, as for IMP.em.SampledDensityMap
+        sigmas = np.sqrt(self.MRCresolution ** 2 + radii ** 2) / (sqrt(2.) * np.pi)
+        return parts[0].get_model(), indexes, masses, sigmas
 
     def add_subunits_density(self, hierarchy=None):
         """Add a frame to the densities.
@@ -1140,93 +2359,115 @@ class GetModelDensity(object):
         self.count_models += 1.0
 
         if hierarchy:
-            part_dict = get_particles_at_resolution_one(hierarchy)
-            all_particles_by_resolution = []
-            for name in part_dict:
-                all_particles_by_resolution += part_dict[name]
+            key = hierarchy.get_particle_index()
+        else:
+            key = None
+        if key != self._particles_key:
+            self._particles_key = key
+            self._particles = {}
 
+        all_particles_by_resolution = None
         for density_name in self.custom_ranges:
-            parts = []
-            if hierarchy:
-                all_particles_by_segments = []
-
-            for seg in self.custom_ranges[density_name]:
-                if not hierarchy:
-                    # when you have a IMP.pmi.representation.Representation class
-                    parts += IMP.tools.select_by_tuple(self.representation,
-                                                       seg, resolution=1, name_is_ambiguous=False)
-                else:
-                    # else, when you have a hierarchy, but not a representation
-                    if not IMP.pmi.get_is_canonical(hierarchy):
-                        for h in hierarchy.get_children():
-                            if not IMP.atom.Molecule.get_is_setup(h):
-                                IMP.atom.Molecule.setup_particle(h.get_particle())
-
-                    if type(seg) == str:
-                        s = IMP.atom.Selection(hierarchy,molecule=seg)
-                    elif type(seg) == tuple and len(seg) == 2:
-                        s = IMP.atom.Selection(
-                            hierarchy, molecule=seg[0],copy_index=seg[1])
-                    elif type(seg) == tuple and len(seg) == 3:
-                        s = IMP.atom.Selection(
-                            hierarchy, molecule=seg[2],residue_indexes=range(seg[0], seg[1] + 1))
-                    elif type(seg) == tuple and len(seg) == 4:
-                        s = IMP.atom.Selection(
-                            hierarchy, molecule=seg[2],residue_indexes=range(seg[0], seg[1] + 1),copy_index=seg[3])
-                    else:
-                        raise Exception('could not understand selection tuple '+str(seg))
-
-                    all_particles_by_segments += s.get_selected_particles()
-            if hierarchy:
-                if IMP.pmi.get_is_canonical(hierarchy):
-                    parts = all_particles_by_segments
-                else:
-                    parts = list(
-                        set(all_particles_by_segments) & set(all_particles_by_resolution))
-            self._create_density_from_particles(parts, density_name)
+            data = self._particles.get(density_name)
+            if data is None:
+                if hierarchy and all_particles_by_resolution is None:
+                    part_dict = get_particles_at_resolution_one(hierarchy)
+                    all_particles_by_resolution = []
+                    for name in part_dict:
+                        all_particles_by_resolution += part_dict[name]
+                parts = self._select_particles(density_name, hierarchy,
+                                               all_particles_by_resolution)
+                if not parts:
+                    continue
+                data = self._get_particle_data(parts)
+                if not self._get_is_copy_dependent(density_name):
+                    self._particles[density_name] = data
+            model, indexes, masses, sigmas = data
+            coords = IMP.pmi.tools.get_coordinates_array(model, indexes)
+            self._pending.setdefault(density_name, []).append(
+                                                   (coords, masses, sigmas))
+            if len(self._pending[density_name]) >= self.batch_size:
+                self._add_pending(density_name)
+
+    def _add_pending(self, density_name):
+        """Add all frames not yet added to the grid of a density"""
+        pending = self._pending.pop(density_name, [])
+        if not pending:
+            return
+        coords = np.vstack([p[0] for p in pending])
+        masses = np.concatenate([p[1] for p in pending])
+        sigmas = np.concatenate([p[2] for p in pending])
+        # grow the grid to cover the new particles and their kernels
+        halfwidths = np.ceil(3. * sigmas / self.voxel).astype(int)
+        centers = np.round(coords / self.voxel).astype(int)
+        lower = (centers - halfwidths[:, np.newaxis]).min(axis=0)
+        upper = (centers + halfwidths[:, np.newaxis]).max(axis=0)
+        if density_name in self._grids:
+            first, grid = self._grids[density_name]
+            old_upper = first + np.array(grid.shape[::-1]) - 1
+            lower = np.minimum(lower, first)
+            upper = np.maximum(upper, old_upper)
+        shape = upper - lower + 1
+        new_grid = np.zeros(shape[::-1])
+        if density_name in self._grids:
+            o = first - lower
+            new_grid[o[2]:o[2] + grid.shape[0], o[1]:o[1] + grid.shape[1],
+                     o[0]:o[0] + grid.shape[2]] = grid
+        max_elements = 2**22
+        nproc = min(self.nproc, len(pending))
+        chunks = [(coords[c], masses[c], sigmas[c], self.voxel, lower,
+                   shape, max_elements)
+                  for c in np.array_split(np.arange(len(coords)), nproc)]
+        if nproc > 1:
+            results = self._get_pool().map(_add_gaussians, chunks)
+        else:
+            results = [_add_gaussians(c) for c in chunks]
+        for r in results:
+            new_grid += r.reshape(new_grid.shape)
+        self._grids[density_name] = (lower, new_grid)
+        self.densities.pop(density_name, None)
+
+    def _add_all_pending(self):
+        """Add all pending frames to the grids"""
+        for density_name in list(self._pending.keys()):
+            self._add_pending(density_name)
+
+    def _get_density_map(self, density_name):
+        """Make an IMP.em map of a density. The grid is passed to IMP in
+           bulk, as a temporary MRC file."""
+        import tempfile
+        first, grid = self._grids[density_name]
+        fd, name = tempfile.mkstemp(suffix='.mrc')
+        os.close(fd)
+        try:
+            _write_mrc_file(name, grid, self.voxel, first * self.voxel)
+            dmap = IMP.em.read_map(name, IMP.em.MRCReaderWriter())
+        finally:
+            os.unlink(name)
+        dmap.set_was_used(True)
+        return dmap
 
     def normalize_density(self):
         pass
 
-    def _create_density_from_particles(self, ps, name,
-                                      kernel_type='GAUSSIAN'):
-        '''Internal function for adding to densities.
-        pass XYZR particles with mass and create a density from them.
-        kernel type options are GAUSSIAN, BINARIZED_SPHERE, and SPHERE.'''
-        kd = {
-            'GAUSSIAN': IMP.em.GAUSSIAN,
-            'BINARIZED_SPHERE': IMP.em.BINARIZED_SPHERE,
-            'SPHERE': IMP.em.SPHERE}
-
-        dmap = IMP.em.SampledDensityMap(ps, self.MRCresolution, self.voxel)
-        dmap.calcRMS()
-        dmap.set_was_used(True)
-        if name not in self.densities:
-            self.densities[name] = dmap
-        else:
-            bbox1 = IMP.em.get_bounding_box(self.densities[name])
-            bbox2 = IMP.em.get_bounding_box(dmap)
-            bbox1 += bbox2
-            dmap3 = IMP.em.create_density_map(bbox1,self.voxel)
-            dmap3.set_was_used(True)
-            dmap3.add(dmap)
-            dmap3.add(self.densities[name])
-            self.densities[name] = dmap3
-
     def get_density_keys(self):
-        return list(self.densities.keys())
+        self._add_all_pending()
+        return list(self._grids.keys())
 
     def get_density(self,name):
         """Get the current density for some component name"""
-        if name not in self.densities:
+        self._add_pending(name)
+        if name not in self._grids:
             return None
-        else:
-            return self.densities[name]
+        if name not in self.densities:
+            self.densities[name] = self._get_density_map(name)
+        return self.densities[name]
 
     def write_mrc(self, path="./",suffix=None):
         import os, errno
-        for density_name in self.densities:
-            self.densities[density_name].multiply(1. / self.count_models)
+        self._add_all_pending()
+        for density_name in self._grids:
+            first, grid = self._grids[density_name]
             if suffix is None:
                 name=path + "/" + density_name + ".mrc"
             else:
@@ -1238,9 +2479,8 @@ class GetModelDensity(object):
                 except OSError as e:
                     if e.errno != errno.EEXIST:
                         raise
-            IMP.em.write_map(
-                self.densities[density_name],name,
-                IMP.em.MRCReaderWriter())
+            _write_mrc_file(name, grid / self.count_models, self.voxel,
+                            first * self.voxel)
 
 
 class GetContactMap(object):
@@ -17,6 +17,8 @@ import numpy as np
 import re
 from collections import defaultdict
 import itertools
+import heapq
+import operator
 
 def parse_dssp(dssp_fn, limit_to_chains='',name_map=None):
     """Read a DSSP file, and return secondary structure elements (SSEs).
@@ -134,7 +136,8 @@ def save_best_models(model,
                      feature_keys=None,
                      rmf_file_key="rmf_file",
                      rmf_file_frame_key="rmf_frame_index",
-                     override_rmf_dir=None):
+                     override_rmf_dir=None,
+                     nproc=1, score_threshold=None):
     """Given a list of stat files, read them all and find the best models.
     Save to a single RMF along with a stat file.
     @param model The IMP Model
@@ -147,6 +150,10 @@ def save_best_models(model,
     @param rmf_file_key The key that says RMF file name
     @param rmf_file_frame_key The key that says RMF frame number
     @param override_rmf_dir For output, change the name of the RMF directory (experiment)
+    @param nproc Number of worker processes used to read the stat files
+           (on each MPI rank, if MPI is used)
+    @param score_threshold If given, only consider models with a score
+           below this value
     """
 
     # start by splitting into jobs
@@ -165,44 +172,19 @@ def save_best_models(model,
     out_stat_fn = os.path.join(out_dir,"top_"+str(number_of_best_scoring_models)+".out")
     out_rmf_fn = os.path.join(out_dir,"top_"+str(number_of_best_scoring_models)+".rmf3")
 
-    # extract all the models
-    all_fields=[]
-    for nsf,sf in enumerate(my_stat_files):
-
-        # get list of keywords
+    # extract the best models from each file
+    results = _read_stat_files(my_stat_files, score_key, feature_keys,
+                               rmf_file_key, rmf_file_frame_key,
+                               score_threshold, get_every,
+                               number_of_best_scoring_models, nproc)
+    for sf, keywords, fields, statistics in results:
         root_directory_of_stat_file = os.path.dirname(os.path.dirname(sf))
-        print("getting data from file %s" % sf)
-        po = IMP.pmi.output.ProcessOutput(sf)
-        all_keys = [score_key,
-                    rmf_file_key,
-                    rmf_file_frame_key]
-        for k in po.get_keys():
-            for fk in feature_keys:
-                if fk in k:
-                    all_keys.append(k)
-        fields = po.get_fields(all_keys,
-                               get_every=get_every)
-
-        # check that all lengths are all equal
-        length_set = set([len(fields[f]) for f in fields])
-        minlen = min(length_set)
-        # if some of the fields are missing, truncate
-        # the feature files to the shortest one
-        if len(length_set) > 1:
-            print("get_best_models: the statfile is not synchronous")
-            minlen = min(length_set)
-            for f in fields:
-                fields[f] = fields[f][0:minlen]
-        if nsf==0:
-            all_fields=fields
-        else:
-            for k in fields:
-                all_fields[k]+=fields[k]
-
         if override_rmf_dir is not None:
-            for i in range(minlen):
-                all_fields[rmf_file_key][i]=os.path.join(
-                    override_rmf_dir,os.path.basename(all_fields[rmf_file_key][i]))
+            fields[rmf_file_key] = [
+                    os.path.join(override_rmf_dir, os.path.basename(rmf))
+                    for rmf in fields[rmf_file_key]]
+    all_fields = _merge_best_fields([r[2] for r in results], score_key,
+                                    number_of_best_scoring_models)
 
     # gather info, sort, write
     if number_of_processes!=1:
@@ -210,14 +192,11 @@ def save_best_models(model,
     if rank!=0:
         comm.send(all_fields, dest=0, tag=11)
     else:
+        all_fields = [all_fields]
         for i in range(1,number_of_processes):
-            data_tmp = comm.recv(source=i, tag=11)
-            for k in all_fields:
-                all_fields[k]+=data_tmp[k]
-
-        # sort by total score
-        order = sorted(range(len(all_fields[score_key])),
-                       key=lambda i: float(all_fields[score_key][i]))
+            all_fields.append(comm.recv(source=i, tag=11))
+        all_fields = _merge_best_fields(all_fields, score_key,
+                                        number_of_best_scoring_models)
 
         # write the stat and RMF files
         stat = open(out_stat_fn,'w')
@@ -227,17 +206,17 @@ def save_best_models(model,
         del rh0
         outf = RMF.create_rmf_file(out_rmf_fn)
         IMP.rmf.add_hierarchies(outf,prots)
-        for nm,i in enumerate(order[:number_of_best_scoring_models]):
-            dline=dict((k,all_fields[k][i]) for k in all_fields)
+        for nm in range(len(all_fields[score_key])):
+            dline=dict((k,all_fields[k][nm]) for k in all_fields)
             dline['orig_rmf_file']=dline[rmf_file_key]
             dline['orig_rmf_frame_index']=dline[rmf_file_frame_key]
             dline[rmf_file_key]=out_rmf_fn
             dline[rmf_file_frame_key]=nm
             rh = RMF.open_rmf_file_read_only(
-                os.path.join(root_directory_of_stat_file,all_fields[rmf_file_key][i]))
+                os.path.join(root_directory_of_stat_file,all_fields[rmf_file_key][nm]))
             IMP.rmf.link_hierarchies(rh,prots)
             IMP.rmf.load_frame(rh,
-                               RMF.FrameID(all_fields[rmf_file_frame_key][i]))
+                               RMF.FrameID(all_fields[rmf_file_frame_key][nm]))
             IMP.rmf.save_frame(outf)
             del rh
             stat.write(str(dline)+'\n')
@@ -245,6 +224,119 @@ def save_best_models(model,
         print('wrote stats to',out_stat_fn)
         print('wrote rmfs to',out_rmf_fn)
 
+
+def _read_stat_file(args):
+    """Read the score, RMF and feature fields from a single stat file.
+       This is a top-level function so that it can be run in a
+       multiprocessing pool; see _read_stat_files()."""
+    (sf, score_key, feature_keys, rmf_file_key, rmf_file_frame_key,
+     prefiltervalue, get_every, number_of_best_scoring_models) = args
+    print("getting data from file %s" % sf)
+    po = IMP.pmi.output.ProcessOutput(sf)
+
+    try:
+        file_keywords = po.get_keys()
+    except:
+        return None
+
+    keywords = [score_key,
+                rmf_file_key,
+                rmf_file_frame_key]
+
+    # check all requested keys are in the file
+    #  this looks weird because searching for "*requested_key*"
+    if feature_keys:
+        for requested_key in feature_keys:
+            for file_k in file_keywords:
+                if requested_key in file_k:
+                    if file_k not in keywords:
+                        keywords.append(file_k)
+
+    statistics = IMP.pmi.output.OutputStatistics()
+    if number_of_best_scoring_models is not None:
+        # only read the other fields for the best scoring frames
+        fields = po.get_best_fields(keywords, score_key,
+                                    number_of_best_scoring_models,
+                                    score_threshold=prefiltervalue,
+                                    get_every=get_every,
+                                    statistics=statistics)
+        return sf, keywords, fields, statistics
+    elif prefiltervalue is None:
+        fields = po.get_fields(keywords,
+                               get_every=get_every,
+                               statistics=statistics)
+    else:
+        fields = po.get_fields(keywords,
+                               filtertuple=(score_key,"<",prefiltervalue),
+                               get_every=get_every,
+                               statistics=statistics)
+
+    # check that all lengths are all equal
+    length_set = set()
+    for f in fields:
+        length_set.add(len(fields[f]))
+
+    # if some of the fields are missing, truncate
+    # the feature files to the shortest one
+    if len(length_set) > 1:
+        print("get_best_models: the statfile is not synchronous")
+        minlen = min(length_set)
+        for f in fields:
+            fields[f] = fields[f][0:minlen]
+    return sf, keywords, fields, statistics
+
+
+def _read_stat_files(stat_files, score_key, feature_keys, rmf_file_key,
+                     rmf_file_frame_key, prefiltervalue, get_every,
+                     number_of_best_scoring_models, nproc):
+    """Read fields from each stat file, using nproc worker processes.
+       If number_of_best_scoring_models is given, only that many of
+       the best scoring frames are read from each file (see
+       IMP.pmi.output.ProcessOutput.get_best_fields()).
+       @return a list of (stat file, keywords, fields, OutputStatistics)
+               tuples, in the same order as stat_files (unreadable files
+               are skipped)"""
+    args = [(sf, score_key, feature_keys, rmf_file_key, rmf_file_frame_key,
+             prefiltervalue, get_every, number_of_best_scoring_models)
+            for sf in stat_files]
+    if nproc > 1 and len(stat_files) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(nproc, len(stat_files)))
+        try:
+            # map() returns results in input order, so the merge is
+            # deterministic regardless of which worker finishes first
+            results = pool.map(_read_stat_file, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_read_stat_file(a) for a in args]
+    return [r for r in results if r is not None]
+
+
+def _merge_best_fields(fields_list, score_key, number_of_best_scoring_models):
+    """Merge fields dictionaries, keeping only the best scoring frames.
+       A bounded heap is used, so memory use does not depend on the total
+       number of frames. Frames are returned sorted by score; ties are
+       broken by their order in fields_list.
+       @return a single fields dictionary"""
+    def get_frames():
+        for nf, fields in enumerate(fields_list):
+            for i, score in enumerate(fields[score_key]):
+                yield float(score), nf, i
+    best = heapq.nsmallest(number_of_best_scoring_models, get_frames(),
+                           key=operator.itemgetter(0))
+    merged = defaultdict(list)
+    for score, nf, i in best:
+        for k, v in fields_list[nf].items():
+            merged[k].append(v[i])
+    if not best:
+        for fields in fields_list:
+            for k in fields:
+                merged[k]
+    return dict(merged)
+
+
 class _TempProvenance(object):
     """Placeholder to track provenance information added to the IMP model.
        This is since we typically don't preserve the IMP::Model object
@@ -297,72 +389,53 @@ def get_best_models(stat_files,
                     rmf_file_key="rmf_file",
                     rmf_file_frame_key="rmf_frame_index",
                     prefiltervalue=None,
-                    get_every=1, provenance=None):
+                    get_every=1, provenance=None,
+                    number_of_best_scoring_models=None, nproc=1):
     """ Given a list of stat files, read them all and find the best models.
     Returns the best rmf filenames, frame numbers, scores, and values for feature keywords
+    @param number_of_best_scoring_models If given, return only this many of
+           the best scoring models, sorted by score (otherwise all models
+           are returned, in file order)
+    @param nproc Number of worker processes used to read the stat files
     """
     rmf_file_list=[]              # best RMF files
     rmf_file_frame_list=[]        # best RMF frames
     score_list=[]                 # best scores
     feature_keyword_list_dict=defaultdict(list)  # best values of the feature keys
     statistics = IMP.pmi.output.OutputStatistics()
-    for sf in stat_files:
+    results = _read_stat_files(stat_files, score_key, feature_keys,
+                               rmf_file_key, rmf_file_frame_key,
+                               prefiltervalue, get_every,
+                               number_of_best_scoring_models, nproc)
+    for sf, keywords, fields, file_statistics in results:
         root_directory_of_stat_file = os.path.dirname(os.path.abspath(sf))
         if sf[-4:]=='rmf3':
             root_directory_of_stat_file = os.path.dirname(os.path.abspath(root_directory_of_stat_file))
-        print("getting data from file %s" % sf)
-        po = IMP.pmi.output.ProcessOutput(sf)
+        for attr in ('total', 'passed_get_every', 'passed_filterout',
+                     'passed_filtertuple'):
+            setattr(statistics, attr, getattr(statistics, attr)
+                                      + getattr(file_statistics, attr))
 
-        try:
-            file_keywords = po.get_keys()
-        except:
-            continue
-
-        keywords = [score_key,
-                    rmf_file_key,
-                    rmf_file_frame_key]
-
-        # check all requested keys are in the file
-        #  this looks weird because searching for "*requested_key*"
-        if feature_keys:
-            for requested_key in feature_keys:
-                for file_k in file_keywords:
-                    if requested_key in file_k:
-                        if file_k not in keywords:
-                            keywords.append(file_k)
-
-        if prefiltervalue is None:
-            fields = po.get_fields(keywords,
-                                   get_every=get_every,
-                                   statistics=statistics)
-        else:
-            fields = po.get_fields(keywords,
-                                   filtertuple=(score_key,"<",prefiltervalue),
-                                   get_every=get_every,
-                                   statistics=statistics)
-
-        # check that all lengths are all equal
-        length_set = set()
-        for f in fields:
-            length_set.add(len(fields[f]))
-
-        # if some of the fields are missing, truncate
-        # the feature files to the shortest one
-        if len(length_set) > 1:
-            print("get_best_models: the statfile is not synchronous")
-            minlen = min(length_set)
-            for f in fields:
-                fields[f] = fields[f][0:minlen]
-
-        # append to the lists
-        score_list += fields[score_key]
+        rmfs = []
         for rmf in fields[rmf_file_key]:
             rmf=os.path.normpath(rmf)
             if root_directory_of_stat_file not in rmf:
                 rmf_local_path=os.path.join(os.path.basename(os.path.dirname(rmf)),os.path.basename(rmf))
                 rmf=os.path.join(root_directory_of_stat_file,rmf_local_path)
-            rmf_file_list.append(rmf)
-
+            rmfs.append(rmf)
+        fields[rmf_file_key] = rmfs
+    if number_of_best_scoring_models is not None:
+        merged = _merge_best_fields([r[2] for r in results], score_key,
+                                    number_of_best_scoring_models)
+        keywords = []
+        for r in results:
+            keywords += [k for k in r[1] if k not in keywords]
+        results = [(None, keywords, merged, None)]
+
+    # append to the lists
+    for sf, keywords, fields, file_statistics in results:
+        score_list += fields[score_key]
+        rmf_file_list += fields[rmf_file_key]
         rmf_file_frame_list += fields[rmf_file_frame_key]
 
         for k in keywords:
@@ -383,42 +456,24 @@ def get_best_models(stat_files,
 
     return rmf_file_list,rmf_file_frame_list,score_list,feature_keyword_list_dict
 
+
 def get_trajectory_models(stat_files,
                           score_key="SimplifiedModel_Total_Score_None",
                           rmf_file_key="rmf_file",
                           rmf_file_frame_key="rmf_frame_index",
-                          get_every=1):
+                          get_every=1, nproc=1):
     """ Given a list of stat files, read them all and find a trajectory of models.
     Returns the rmf filenames, frame numbers, scores, and values for feature keywords
+    @param nproc Number of worker processes used to read the stat files
     """
     rmf_file_list=[]              # best RMF files
     rmf_file_frame_list=[]        # best RMF frames
     score_list=[]                 # best scores
-    for sf in stat_files:
+    results = _read_stat_files(stat_files, score_key, None, rmf_file_key,
+                               rmf_file_frame_key, None, get_every, None,
+                               nproc)
+    for sf, keywords, fields, statistics in results:
         root_directory_of_stat_file = os.path.dirname(os.path.dirname(sf))
-        print("getting data from file %s" % sf)
-        po = IMP.pmi.output.ProcessOutput(sf)
-        keywords = po.get_keys()
-
-        feature_keywords = [score_key,
-                            rmf_file_key,
-                            rmf_file_frame_key]
-
-        fields = po.get_fields(feature_keywords,
-                                   get_every=get_every)
-
-        # check that all lengths are all equal
-        length_set = set()
-        for f in fields:
-            length_set.add(len(fields[f]))
-
-        # if some of the fields are missing, truncate
-        # the feature files to the shortest one
-        if len(length_set) > 1:
-            print("get_best_models: the statfile is not synchronous")
-            minlen = min(length_set)
-            for f in fields:
-                fields[f] = fields[f][0:minlen]
 
         # append to the lists
         score_list += fields[score_key]
@@ -430,6 +485,7 @@ def get_trajectory_models(stat_files,
     return rmf_file_list,rmf_file_frame_list,score_list
 
 
+
 def read_coordinates_of_rmfs(model,
                              rmf_tuples,
                              alignment_components=None,
@@ -16,10 +16,20 @@ import RMF
 import IMP.display
 import operator
 import math
+import numbers
 import sys
 import ihm.location
 import ihm.dataset
+import numpy as np
 from collections import defaultdict
+try:
+    from collections.abc import MutableMapping, MutableSequence, Sequence
+except ImportError:
+    from collections import MutableMapping, MutableSequence, Sequence
+try:
+    from collections import OrderedDict
+except ImportError:
+    from IMP.pmi._compat_collections import OrderedDict
 
 # json default serializations
 def set_json_default(obj):
@@ -152,7 +162,7 @@ class _ProteinsResiduesArray(tuple):
         @input_data can be a dict or a tuple
         '''
         self.cldbsk=_CrossLinkDataBaseStandardKeys()
-        if type(input_data) is dict:
+        if isinstance(input_data, (dict, MutableMapping)):
             monolink=False
             p1=input_data[self.cldbsk.protein1_key]
             try:
@@ -256,6 +266,23 @@ class FilterOperator(object):
         else:
             return op(FilterOperator1.evaluate(xl_item), FilterOperator2.evaluate(xl_item))
 
+    def compile(self):
+        '''
+        Compile the filter into a _CompiledFilter, that evaluates it
+        for many cross-links at once. The result is cached, so the
+        tree is only compiled once.
+        '''
+        if getattr(self, '_compiled', None) is None:
+            self._compiled = _CompiledFilter(self)
+        return self._compiled
+
+    def _get_mask(self, table, rows):
+        '''
+        Evaluate the filter for the given rows of a _CrossLinkTable
+        @return a NumPy boolean array with an element for each row
+        '''
+        return self.compile()(table, rows)
+
 '''
 def filter_factory(xl_):
 
@@ -269,6 +296,125 @@ def filter_factory(xl_):
     return FilterOperator
 '''
 
+# comparisons that NumPy can apply to a whole column at once
+_array_operators = (operator.eq, operator.ne, operator.lt, operator.le,
+                    operator.gt, operator.ge)
+
+def _compare(op, values, value):
+    '''Apply op(v, value) to each element v of a NumPy array, returning
+       a boolean array. NumPy does the work where it gives the same
+       result as Python.'''
+    if op in _array_operators and np.ndim(value) == 0 \
+       and (values.dtype.kind == 'O'
+            or (isinstance(value, numbers.Real)
+                and not isinstance(value, bool))):
+        mask = op(values, value)
+        if isinstance(mask, np.ndarray) and mask.shape == values.shape:
+            return mask.astype(bool)
+    return np.array([bool(op(v, value)) for v in values.tolist()],
+                    dtype=bool)
+
+
+class _CompiledFilter(object):
+    '''
+    A FilterOperator tree compiled into a predicate over the columns of
+    a _CrossLinkTable. Identical subexpressions (the same
+    FilterOperator object, or comparisons of the same key with the same
+    operator and value) are evaluated only once, each key's column is
+    read only once, and the second operand of & and | is only evaluated
+    for the rows where the first one does not already decide the result.
+    '''
+
+    def __init__(self, FilterOperator):
+        # nodes are ('key', keyword, operator, value) leaves or
+        # (operator, node1, node2) operations, with node2 None for
+        # unary operators
+        self._nodes = []
+        self._node_index = {}
+        # the keys the filter reads
+        self.keys = set()
+        self._root = self._add(FilterOperator, {})
+
+    def _add(self, fo, seen):
+        if id(fo) in seen:
+            return seen[id(fo)]
+        if len(fo.operations) == 0:
+            keyword, op, value = fo.values
+            self.keys.add(keyword)
+            node = ('key', keyword, op, value)
+            try:
+                key = ('key', keyword, op, type(value), value)
+                hash(key)
+            except TypeError:
+                key = ('key', keyword, op, type(value), id(value))
+        else:
+            fo1, op, fo2 = fo.operations
+            node = (op, self._add(fo1, seen),
+                    None if fo2 is None else self._add(fo2, seen))
+            key = node
+        if key not in self._node_index:
+            self._node_index[key] = len(self._nodes)
+            self._nodes.append(node)
+        seen[id(fo)] = self._node_index[key]
+        return seen[id(fo)]
+
+    def __call__(self, table, rows):
+        '''
+        Evaluate the filter for the given rows of a _CrossLinkTable
+        @return a NumPy boolean array with an element for each row
+        '''
+        self._table = table
+        self._rows = rows
+        self._columns = {}
+        # for each node, the results so far and which of them are known
+        self._results = {}
+        try:
+            return self._evaluate(self._root, np.arange(len(rows)))
+        finally:
+            del self._table, self._rows, self._columns, self._results
+
+    def _evaluate(self, node, positions):
+        if node not in self._results:
+            self._results[node] = (np.zeros(len(self._rows), dtype=bool),
+                                   np.zeros(len(self._rows), dtype=bool))
+        results, known = self._results[node]
+        todo = positions[~known[positions]]
+        if len(todo) > 0:
+            results[todo] = self._compute(node, todo)
+            known[todo] = True
+        return results[positions]
+
+    def _compute(self, node, positions):
+        if self._nodes[node][0] == 'key':
+            keyword, op, value = self._nodes[node][1:]
+            if keyword not in self._columns:
+                self._columns[keyword] = self._table.get_array(keyword,
+                                                               self._rows)
+            values, present = self._columns[keyword]
+            if not present[positions].all():
+                raise KeyError(keyword)
+            return _compare(op, values[positions], value)
+        op, argument1, argument2 = self._nodes[node]
+        mask1 = self._evaluate(argument1, positions)
+        if argument2 is None:
+            if op is operator.not_:
+                return ~mask1
+            return np.array([bool(op(m)) for m in mask1.tolist()],
+                            dtype=bool)
+        if op is operator.and_ or op is operator.or_:
+            # only rows not decided by the first operand need the second
+            undecided = mask1 if op is operator.and_ else ~mask1
+            result = mask1.copy()
+            if undecided.any():
+                result[undecided] = self._evaluate(argument2,
+                                                   positions[undecided])
+            return result
+        mask2 = self._evaluate(argument2, positions)
+        if op is operator.xor:
+            return mask1 ^ mask2
+        return np.array([bool(op(m1, m2)) for m1, m2
+                         in zip(mask1.tolist(), mask2.tolist())], dtype=bool)
+
 class CrossLinkDataBaseKeywordsConverter(_CrossLinkDataBaseStandardKeys):
     '''
     This class is needed to convert the keywords from a generic database
@@ -524,6 +670,419 @@ class FixedFormatParser(_CrossLinkDataBaseStandardKeys):
                 xl[self.residue2_key]=int(tockens[5])
                 return xl
 
+class _CrossLinkColumn(object):
+    '''
+    A column of values for one key of a _CrossLinkTable. Values of keys
+    typed as int or float are kept in a typed NumPy array; everything
+    else (or a typed column that is given a value of another type) is
+    kept in an object array. A boolean mask flags the rows that have a
+    value for the key.
+    '''
+
+    _dtypes = {int: np.int64, float: np.float64}
+
+    def __init__(self, value_type, capacity):
+        dtype = self._dtypes.get(value_type, object)
+        self.values = np.zeros(capacity, dtype=dtype)
+        if dtype is object:
+            self.values[:] = None
+        self.present = np.zeros(capacity, dtype=bool)
+
+    def resize(self, capacity):
+        values = np.zeros(capacity, dtype=self.values.dtype)
+        if self.values.dtype == object:
+            values[:] = None
+        values[:len(self.values)] = self.values
+        present = np.zeros(capacity, dtype=bool)
+        present[:len(self.present)] = self.present
+        self.values = values
+        self.present = present
+
+    def _accepts(self, value):
+        kind = self.values.dtype.kind
+        if kind == 'O':
+            return True
+        if isinstance(value, bool) or isinstance(value, np.bool_):
+            return False
+        if kind == 'i':
+            return isinstance(value, (numbers.Integral, np.integer))
+        return isinstance(value, (numbers.Real, np.integer, np.floating))
+
+    def _accepts_array(self, values):
+        kind = self.values.dtype.kind
+        if kind == 'O':
+            return True
+        if kind == 'i':
+            return values.dtype.kind in 'iu'
+        return values.dtype.kind in 'iuf'
+
+    def _make_object(self):
+        self.values = self.values.astype(object)
+
+    def get(self, row):
+        v = self.values[row]
+        if self.values.dtype.kind != 'O':
+            return v.item()
+        return v
+
+    def set(self, row, value):
+        if not self._accepts(value):
+            self._make_object()
+        self.values[row] = value
+        self.present[row] = True
+
+    def set_many(self, rows, values):
+        '''Set the given rows from a scalar, or from a list or NumPy array
+           with one value per row'''
+        if isinstance(values, np.ndarray):
+            if not self._accepts_array(values):
+                self._make_object()
+        elif isinstance(values, (list, tuple)):
+            # whether a value is accepted only depends on its type
+            samples = dict((type(v), v) for v in values)
+            if not all(self._accepts(v) for v in samples.values()):
+                self._make_object()
+            if self.values.dtype.kind == 'O':
+                # fill element by element, so that list values are kept
+                # as they are rather than broadcast by NumPy
+                arr = np.empty(len(values), dtype=object)
+                for n, v in enumerate(values):
+                    arr[n] = v
+                values = arr
+        else:
+            if not self._accepts(values):
+                self._make_object()
+            if self.values.dtype.kind == 'O':
+                arr = np.empty(len(rows), dtype=object)
+                arr.fill(values)
+                values = arr
+        self.values[rows] = values
+        self.present[rows] = True
+
+
+class _CrossLinkTable(object):
+    '''
+    Columnar storage for the cross-links of a CrossLinkDataBase.
+    Each cross-link is a row, identified by its integer index; each key
+    is a _CrossLinkColumn. Rows are only ever added, so row indexes are
+    stable and can be shared by several databases.
+    Each change to a key increases its version, so that the databases
+    can tell when the fields derived from it are out of date.
+    '''
+
+    def __init__(self, types):
+        '''
+        @param types dictionary from key to value type (int, float, ...)
+        '''
+        self.types = types
+        self.columns = OrderedDict()
+        self.nrows = 0
+        self._capacity = 0
+        self.version = 0
+        self._versions = {}
+        # the database whose derived fields are stored, see
+        # CrossLinkDataBase._update()
+        self.derived_owner = None
+
+    def __len__(self):
+        return self.nrows
+
+    def _reserve(self, nrows):
+        if nrows > self._capacity:
+            self._capacity = max(nrows, 2 * self._capacity, 16)
+            for column in self.columns.values():
+                column.resize(self._capacity)
+
+    def _touch(self, key):
+        self.version += 1
+        self._versions[key] = self.version
+
+    def get_version(self, key):
+        '''Get the version of a key, which changes whenever it is set'''
+        return self._versions.get(key, 0)
+
+    def _get_column(self, key):
+        if key not in self.columns:
+            self.columns[key] = _CrossLinkColumn(self.types.get(key),
+                                                 self._capacity)
+        return self.columns[key]
+
+    def add_rows(self, xls):
+        '''Add cross-links, given as dictionaries, and return their rows'''
+        xls = list(xls)
+        first = self.nrows
+        self._reserve(first + len(xls))
+        self.nrows += len(xls)
+        self.version += 1
+        # gather the values of each key, to set them all at once
+        columns = OrderedDict()
+        for row, xl in enumerate(xls, first):
+            for k in xl:
+                if k not in columns:
+                    columns[k] = ([], [])
+                rows, values = columns[k]
+                rows.append(row)
+                values.append(xl[k])
+        for k, (rows, values) in columns.items():
+            self.set_array(k, rows, values)
+        return list(range(first, self.nrows))
+
+    def add_columns(self, nrows, columns):
+        '''Add cross-links, given as a dictionary from key to a
+           (values, present) pair with one element per cross-link, and
+           return their rows. present is a NumPy boolean array flagging
+           the cross-links that have the key (with values then a NumPy
+           array), or None if they all do.'''
+        first = self.nrows
+        self._reserve(first + nrows)
+        self.nrows += nrows
+        self.version += 1
+        rows = np.arange(first, self.nrows)
+        for key, (values, present) in columns.items():
+            if present is None:
+                self.set_array(key, rows, values)
+            elif present.any():
+                self.set_array(key, rows[present], values[present])
+        return rows
+
+    def copy_rows(self, rows):
+        '''Duplicate the given rows and return the new rows'''
+        rows = np.asarray(rows, dtype=np.int64)
+        first = self.nrows
+        self._reserve(first + len(rows))
+        self.nrows += len(rows)
+        self.version += 1
+        new_rows = np.arange(first, self.nrows)
+        for column in self.columns.values():
+            column.values[new_rows] = column.values[rows]
+            column.present[new_rows] = column.present[rows]
+        return new_rows.tolist()
+
+    def has(self, row, key):
+        column = self.columns.get(key)
+        return column is not None and bool(column.present[row])
+
+    def get(self, row, key):
+        column = self.columns.get(key)
+        if column is None or not column.present[row]:
+            raise KeyError(key)
+        return column.get(row)
+
+    def set(self, row, key, value):
+        self._get_column(key).set(row, value)
+        self._touch(key)
+
+    def delete(self, row, key):
+        if not self.has(row, key):
+            raise KeyError(key)
+        column = self.columns[key]
+        self._touch(key)
+        column.present[row] = False
+        if column.values.dtype.kind == 'O':
+            column.values[row] = None
+
+    def get_keys(self, row):
+        return [k for k, column in self.columns.items()
+                if column.present[row]]
+
+    def get_array(self, key, rows):
+        '''Get the values of a key for the given rows, as a
+           (values, present) pair of NumPy arrays'''
+        column = self.columns.get(key)
+        if column is None:
+            values = np.empty(len(rows), dtype=object)
+            values[:] = None
+            return values, np.zeros(len(rows), dtype=bool)
+        return column.values[rows], column.present[rows]
+
+    def set_array(self, key, rows, values):
+        '''Set the values of a key for the given rows, from a scalar
+           or a sequence of the same length as rows'''
+        self._get_column(key).set_many(rows, values)
+        self._touch(key)
+
+
+class _CrossLink(MutableMapping):
+    '''
+    Dictionary-like view of a single cross-link of a CrossLinkDataBase.
+    Changes made through the view are stored in the database.
+    '''
+
+    __slots__ = ('_cldb', '_row')
+
+    def __init__(self, cldb, row):
+        self._cldb = cldb
+        self._row = row
+
+    def __getitem__(self, key):
+        self._cldb._update_derived((key,))
+        return self._cldb._table.get(self._row, key)
+
+    def __setitem__(self, key, value):
+        self._cldb._update_derived((key,))
+        self._cldb._table.set(self._row, key, value)
+
+    def __delitem__(self, key):
+        self._cldb._update_derived((key,))
+        self._cldb._table.delete(self._row, key)
+
+    def __contains__(self, key):
+        self._cldb._update_derived((key,))
+        return self._cldb._table.has(self._row, key)
+
+    def __iter__(self):
+        self._cldb._update_derived()
+        return iter(self._cldb._table.get_keys(self._row))
+
+    def __len__(self):
+        self._cldb._update_derived()
+        return len(self._cldb._table.get_keys(self._row))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return dict(self)
+
+
+class _CrossLinkGroup(MutableSequence):
+    '''
+    List-like view of the cross-links of a CrossLinkDataBase that share
+    a unique ID. Changes made through the view, such as appending or
+    removing cross-links, are stored in the database.
+    '''
+
+    __slots__ = ('_cldb', '_xlid')
+
+    def __init__(self, cldb, xlid):
+        self._cldb = cldb
+        self._xlid = xlid
+
+    def _get_list(self):
+        return [_CrossLink(self._cldb, row)
+                for row in self._cldb._groups[self._xlid]]
+
+    def _set_list(self, xls):
+        self._cldb._set_group(self._xlid, xls)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._get_list()[index]
+        return _CrossLink(self._cldb, self._cldb._groups[self._xlid][index])
+
+    def __setitem__(self, index, value):
+        xls = self._get_list()
+        xls[index] = value
+        self._set_list(xls)
+
+    def __delitem__(self, index):
+        xls = self._get_list()
+        del xls[index]
+        self._set_list(xls)
+
+    def insert(self, index, value):
+        xls = self._get_list()
+        xls.insert(index, value)
+        self._set_list(xls)
+
+    def __iter__(self):
+        return iter(self._get_list())
+
+    def __len__(self):
+        return len(self._cldb._groups[self._xlid])
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return self._get_list() == list(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return self._get_list() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self._get_list()
+
+    def __repr__(self):
+        return repr(self._get_list())
+
+
+class _CrossLinkGroups(MutableMapping):
+    '''
+    Dictionary-like view of a CrossLinkDataBase, from each unique ID
+    to the list of cross-links that share it (see _CrossLinkGroup).
+    '''
+
+    def __init__(self, cldb):
+        self._cldb = cldb
+
+    def __getitem__(self, xlid):
+        if xlid not in self._cldb._groups:
+            raise KeyError(xlid)
+        return _CrossLinkGroup(self._cldb, xlid)
+
+    def __setitem__(self, xlid, xls):
+        self._cldb._set_group(xlid, xls)
+
+    def __delitem__(self, xlid):
+        del self._cldb._groups[xlid]
+        self._cldb._rows = None
+
+    def __iter__(self):
+        return iter(list(self._cldb._groups.keys()))
+
+    def __len__(self):
+        return len(self._cldb._groups)
+
+
+# start of the files written by CrossLinkDataBase.dump_binary()
+_binary_format_header = b'IMP.pmi cross-links 1\n'
+
+def _read_csv_chunks(file_name, chunk_size=10000):
+    '''Read a CSV file with a header line, yielding the header and then
+       lists of at most chunk_size rows'''
+    import csv
+    with open(file_name) as fh:
+        csvr = csv.reader(fh)
+        header = next(csvr, None)
+        if header is None:
+            return
+        yield header
+        chunk = []
+        for row in csvr:
+            # skip blank lines, as csv.DictReader does
+            if row:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+
+def _convert_column(value_type, values):
+    '''Convert a list of strings read from a file with value_type,
+       returning a NumPy array for int and float and a list otherwise'''
+    if value_type is str:
+        return values
+    dtype = _CrossLinkColumn._dtypes.get(value_type)
+    if dtype is not None:
+        try:
+            # NumPy parses strings as int() and float() do, so only fall
+            # back to Python if it fails, to get the same result or error
+            return np.array(values).astype(dtype)
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return [value_type(v) for v in values]
+
+
 class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
     import operator
     '''
@@ -543,12 +1102,29 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
                 and if a fasta_seq is given
         '''
 
-        if data_base is None:
-            self.data_base = {}
-        else:
-            self.data_base=data_base
-
         _CrossLinkDataBaseStandardKeys.__init__(self)
+
+        # cross-links that are already in another database share its storage
+        self._table = None
+        if data_base is not None:
+            for xls in data_base.values():
+                for xl in xls:
+                    if isinstance(xl, _CrossLink):
+                        self._table = xl._cldb._table
+                        break
+                if self._table is not None:
+                    break
+        if self._table is None:
+            self._table = _CrossLinkTable(self.type)
+        self._groups = OrderedDict()
+        self._rows = None
+        self._derived_state = None
+        self._derived_fields_state = {}
+        self._consistency_state = None
+        self._match_cache = (None, {})
+        if data_base is not None:
+            self.data_base = data_base
+
         if converter is not None:
             self.cldbkc = converter                     #type: CrossLinkDataBaseKeywordsConverter
             self.list_parser=self.cldbkc.rplp
@@ -565,24 +1141,142 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
         self.dataset = None
         self._update()
 
+    @property
+    def data_base(self):
+        '''Dictionary-like view from each unique ID to the list of
+           cross-links (as dictionary-like objects) with that ID'''
+        return _CrossLinkGroups(self)
+
+    @data_base.setter
+    def data_base(self, data_base):
+        groups = [(xlid, list(data_base[xlid])) for xlid in data_base]
+        self._groups = OrderedDict()
+        self._rows = None
+        self._set_groups(groups)
+
+    def _set_group(self, xlid, xls):
+        '''Set the cross-links of a unique ID. Cross-links already stored
+           in this database's table are shared, others are copied in.'''
+        self._set_groups([(xlid, xls)])
+
+    def _set_groups(self, groups):
+        '''Set the cross-links of several unique IDs, given as a list
+           of (unique ID, cross-links) pairs, as for _set_group()'''
+        group_rows = []
+        new_xls = []
+        for xlid, xls in groups:
+            rows = []
+            for xl in xls:
+                if isinstance(xl, _CrossLink) \
+                   and xl._cldb._table is self._table:
+                    rows.append(xl._row)
+                else:
+                    rows.append(None)
+                    new_xls.append(xl)
+            group_rows.append((xlid, rows))
+        new_rows = iter(self._table.add_rows(new_xls))
+        for xlid, rows in group_rows:
+            self._groups[xlid] = [next(new_rows) if row is None else row
+                                  for row in rows]
+        self._rows = None
+
+    def _get_rows(self):
+        '''Get the table rows of all cross-links, in iteration order'''
+        if self._rows is None:
+            self._rows = np.array([row for xlid in sorted(self._groups)
+                                   for row in self._groups[xlid]],
+                                  dtype=np.int64)
+        return self._rows
+
     def _update(self):
         '''
-        Update the whole dataset after changes
+        Update the whole dataset after changes.
+        The derived fields (unique sub-indexes, redundancy and residue
+        link numbers) are recomputed when they are next read, and only if
+        the cross-links or keys they depend on changed. The consistency
+        with the sequences is checked again only if the cross-linked
+        sites changed.
+        Databases sharing storage also share the derived fields, which
+        are those of the last database to be updated.
+        '''
+        owner = self._table.derived_owner
+        if owner is not self:
+            if owner is not None:
+                # cross-links not in this database keep the values
+                # of the previous owner
+                owner._compute_derived()
+            self._table.derived_owner = self
+            # other databases may have overwritten the derived fields
+            # since this one last computed them
+            self._derived_state = None
+            self._derived_fields_state = {}
+        if self.cldbkc and self.fasta_seq:
+            keys = (self.protein1_key, self.protein2_key,
+                    self.residue1_key, self.residue2_key,
+                    self.residue1_amino_acid_key, self.residue2_amino_acid_key)
+            state = (self._get_rows(),
+                     [self._table.get_version(k) for k in keys],
+                     self.fasta_seq, self.def_aa_tuple)
+            old_state = self._consistency_state
+            if old_state is None or old_state[0] is not state[0] \
+               or old_state[1] != state[1] or old_state[2] is not state[2] \
+               or old_state[3] != state[3]:
+                self.check_cross_link_consistency()
+                self._consistency_state = state
+
+    def _get_derived_fields(self):
+        '''Get the derived fields, as (keys they set, keys they are
+           computed from, function to compute them) tuples'''
+        site_keys = (self.protein1_key, self.protein2_key,
+                     self.residue1_key, self.residue2_key)
+        return (((self.ambiguity_key, self.unique_sub_index_key,
+                  self.unique_sub_id_key), (),
+                 self.update_cross_link_unique_sub_index),
+                ((self.redundancy_key, self.redundancy_list_key), site_keys,
+                 self.update_cross_link_redundancy),
+                ((self.residue1_links_number_key,
+                  self.residue2_links_number_key), site_keys,
+                 self.update_residues_links_number))
+
+    def _update_derived(self, keys=None):
+        '''Make sure the derived fields in the storage are up to date
+           before they are read or written
+           @param keys if given, only update the fields setting these keys
         '''
-        self.update_cross_link_unique_sub_index()
-        self.update_cross_link_redundancy()
-        self.update_residues_links_number()
-        self.check_cross_link_consistency()
+        owner = self._table.derived_owner
+        if owner is not None:
+            owner._compute_derived(keys)
+
+    def _compute_derived(self, keys=None):
+        '''Recompute the derived fields that are out of date because
+           the cross-links of this database, or the keys the fields are
+           computed from, changed
+           @param keys if given, only update the fields setting these keys
+        '''
+        rows = self._get_rows()
+        table = self._table
+        if self._derived_state is not None \
+           and self._derived_state[0] is rows \
+           and self._derived_state[1] == table.version:
+            return
+        for outputs, inputs, update in self._get_derived_fields():
+            if keys is not None and not any(k in outputs for k in keys):
+                continue
+            versions = [table.get_version(k) for k in inputs]
+            state = self._derived_fields_state.get(outputs)
+            if state is None or state[0] is not rows or state[1] != versions:
+                update()
+                self._derived_fields_state[outputs] = (rows, versions)
+        if keys is None:
+            self._derived_state = (rows, table.version)
 
 
     def __iter__(self):
-        sorted_ids=sorted(self.data_base.keys())
-        for k in sorted_ids:
-            for xl in self.data_base[k]:
-                yield xl
+        for row in self._get_rows().tolist():
+            yield _CrossLink(self, row)
 
     def xlid_iterator(self):
-        sorted_ids=sorted(self.data_base.keys())
+        sorted_ids=sorted(self._groups.keys())
         for xlid in sorted_ids:
             yield xlid
 
@@ -590,21 +1284,20 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
         return self.data_base[xlid]
 
     def __len__(self):
-        return len([xl for xl in self])
+        return len(self._get_rows())
 
     def get_name(self):
         return self.name
 
     def set_name(self,name):
-        new_data_base={}
-        for k in self.data_base:
-            new_data_base[k+"."+name]=self.data_base[k]
-        self.data_base=new_data_base
+        self._groups=OrderedDict((k+"."+name, rows)
+                                 for k, rows in self._groups.items())
+        self._rows=None
         self.name=name
         self._update()
 
     def get_number_of_xlid(self):
-        return len(self.data_base)
+        return len(self._groups)
 
 
     def create_set_from_file(self,file_name,converter=None,FixedFormatParser=None):
@@ -614,9 +1307,8 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
         @param converter an instance of CrossLinkDataBaseKeywordsConverter
         @param FixedFormatParser a parser for a fixed format
         '''
+        new_xl_dict=None
         if not FixedFormatParser:
-            xl_list=IMP.pmi.tools.get_db_from_csv(file_name)
-
             if converter is not None:
                 self.cldbkc = converter
                 self.list_parser=self.cldbkc.rplp
@@ -626,27 +1318,11 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
             if not self.list_parser:
                 # normal procedure without a list_parser
                 # each line is a cross-link
-                new_xl_dict={}
-                for nxl,xl in enumerate(xl_list):
-                    new_xl={}
-                    for k in xl:
-                        if k in self.converter:
-                            new_xl[self.converter[k]]=self.type[self.converter[k]](xl[k])
-                        else:
-                            new_xl[k]=xl[k]
-                    if self.unique_id_key in self.cldbkc.get_setup_keys():
-                        if new_xl[self.unique_id_key] not in new_xl_dict:
-                            new_xl_dict[new_xl[self.unique_id_key]]=[new_xl]
-                        else:
-                            new_xl_dict[new_xl[self.unique_id_key]].append(new_xl)
-                    else:
-                        if str(nxl) not in new_xl_dict:
-                            new_xl_dict[str(nxl)]=[new_xl]
-                        else:
-                            new_xl_dict[str(nxl)].append(new_xl)
+                self._create_set_from_csv(file_name)
 
             else:
                 # with a list_parser, a line can be a list of ambiguous crosslinks
+                xl_list=IMP.pmi.tools.get_db_from_csv(file_name)
                 new_xl_dict={}
                 for nxl,entry in enumerate(xl_list):
 
@@ -715,51 +1391,143 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
                     nxl+=1
 
 
-        self.data_base=new_xl_dict
+        if new_xl_dict is not None:
+            self.data_base=new_xl_dict
         self.name=file_name
         l = ihm.location.InputFileLocation(file_name, details='Crosslinks')
         self.dataset = ihm.dataset.CXMSDataset(l)
         self._update()
 
+    def _create_set_from_csv(self, file_name, chunk_size=10000):
+        '''
+        Read cross-links from a comma-separated-values file, one per line,
+        replacing those in the database. The file is read in chunks, each
+        converted a whole column at a time and added directly to the storage.
+        '''
+        chunks = _read_csv_chunks(file_name, chunk_size)
+        header = next(chunks, [])
+        # as for csv.DictReader, the last column with a given name is used
+        fields = OrderedDict()
+        for n, k in enumerate(header):
+            fields[k] = n
+        use_unique_id = self.unique_id_key in self.cldbkc.get_setup_keys()
+        groups = OrderedDict()
+        nxl = 0
+        for chunk in chunks:
+            nrows = len(chunk)
+            if any(len(row) < len(header) for row in chunk):
+                # missing values are None, as for csv.DictReader
+                chunk = [row + [None] * (len(header) - len(row))
+                         if len(row) < len(header) else row for row in chunk]
+            columns = OrderedDict()
+            for k, n in fields.items():
+                values = [row[n] for row in chunk]
+                if k in self.converter:
+                    k = self.converter[k]
+                    values = _convert_column(self.type[k], values)
+                columns[k] = (values, None)
+            # extra values are kept as a list, as for csv.DictReader
+            extra = np.array([len(row) > len(header) for row in chunk])
+            if extra.any():
+                values = np.empty(nrows, dtype=object)
+                for n in np.flatnonzero(extra).tolist():
+                    values[n] = chunk[n][len(header):]
+                columns[None] = (values, extra)
+
+            rows = self._table.add_columns(nrows, columns).tolist()
+            if use_unique_id:
+                if self.unique_id_key not in columns:
+                    raise KeyError(self.unique_id_key)
+                xlids = columns[self.unique_id_key][0]
+                if isinstance(xlids, np.ndarray):
+                    xlids = xlids.tolist()
+            else:
+                xlids = [str(n) for n in range(nxl, nxl + nrows)]
+            for xlid, row in zip(xlids, rows):
+                if xlid in groups:
+                    groups[xlid].append(row)
+                else:
+                    groups[xlid] = [row]
+            nxl += nrows
+        self._groups = groups
+        self._rows = None
+
+    def _get_sites(self, rows):
+        '''
+        Get the cross-linked sites of the given rows, as for
+        _ProteinsResiduesArray: lists of protein1, protein2, residue1
+        and residue2 (protein2 is "" and residue2 None for monolinks),
+        and arrays of integer site ids for the (protein, residue) pairs.
+        '''
+        p1, has_p1 = self._table.get_array(self.protein1_key, rows)
+        r1, has_r1 = self._table.get_array(self.residue1_key, rows)
+        if not has_p1.all():
+            raise KeyError(self.protein1_key)
+        if not has_r1.all():
+            raise KeyError(self.residue1_key)
+        p2, has_p2 = self._table.get_array(self.protein2_key, rows)
+        r2, has_r2 = self._table.get_array(self.residue2_key, rows)
+        p1, r1, p2, r2 = p1.tolist(), r1.tolist(), p2.tolist(), r2.tolist()
+        for n in np.flatnonzero(~(has_p2 & has_r2)).tolist():
+            p2[n] = ""
+            r2[n] = None
+        site_ids = {}
+        s1 = np.array([site_ids.setdefault(site, len(site_ids))
+                       for site in zip(p1, r1)], dtype=np.int64)
+        s2 = np.array([site_ids.setdefault(site, len(site_ids))
+                       for site in zip(p2, r2)], dtype=np.int64)
+        return (p1, p2, r1, r2), (s1, s2, len(site_ids))
+
     def update_cross_link_unique_sub_index(self):
-        for k in self.data_base:
-            for n,xl in enumerate(self.data_base[k]):
-                xl[self.ambiguity_key]=len(self.data_base[k])
-                xl[self.unique_sub_index_key]=n+1
-                xl[self.unique_sub_id_key]=k+"."+str(n+1)
+        xlids = sorted(self._groups)
+        lengths = np.array([len(self._groups[k]) for k in xlids],
+                           dtype=np.int64)
+        rows = self._get_rows()
+        starts = np.cumsum(lengths) - lengths
+        self._table.set_array(self.ambiguity_key, rows,
+                              np.repeat(lengths, lengths))
+        self._table.set_array(self.unique_sub_index_key, rows,
+                              np.arange(len(rows))
+                              - np.repeat(starts, lengths) + 1)
+        self._table.set_array(self.unique_sub_id_key, rows,
+                              [k+"."+str(n+1) for k, l
+                               in zip(xlids, lengths.tolist())
+                               for n in range(l)])
 
     def update_cross_link_redundancy(self):
-        redundancy_data_base={}
-        for xl in self:
-            pra=_ProteinsResiduesArray(xl)
-            if pra not in redundancy_data_base:
-                redundancy_data_base[pra]=[xl[self.unique_sub_id_key]]
-                redundancy_data_base[pra.get_inverted()]=[xl[self.unique_sub_id_key]]
-            else:
-                redundancy_data_base[pra].append(xl[self.unique_sub_id_key])
-                redundancy_data_base[pra.get_inverted()].append(xl[self.unique_sub_id_key])
-        for xl in self:
-            pra=_ProteinsResiduesArray(xl)
-            xl[self.redundancy_key]=len(redundancy_data_base[pra])
-            xl[self.redundancy_list_key]=redundancy_data_base[pra]
+        rows = self._get_rows()
+        if len(rows) == 0:
+            return
+        # the redundancy lists are made of unique sub-ids
+        self._compute_derived((self.unique_sub_id_key,))
+        (s1, s2, nsites) = self._get_sites(rows)[1]
+        # a cross-link and its inverse are the same pair of sites
+        pairs = np.minimum(s1, s2) * nsites + np.maximum(s1, s2)
+        unique_pairs, inverse, counts = np.unique(pairs, return_inverse=True,
+                                                  return_counts=True)
+        sub_ids = self._table.get_array(self.unique_sub_id_key,
+                                        rows)[0].tolist()
+        redundancy_lists = [[] for p in unique_pairs]
+        inverse = inverse.ravel().tolist()
+        for n, p in enumerate(inverse):
+            redundancy_lists[p].append(sub_ids[n])
+        self._table.set_array(self.redundancy_key, rows, counts[inverse])
+        self._table.set_array(self.redundancy_list_key, rows,
+                              [redundancy_lists[p] for p in inverse])
 
     def update_residues_links_number(self):
-        residue_links={}
-        for xl in self:
-            (p1,p2,r1,r2)=_ProteinsResiduesArray(xl)
-            if (p1,r1) not in residue_links:
-                residue_links[(p1,r1)]=set([(p2,r2)])
-            else:
-                residue_links[(p1,r1)].add((p2,r2))
-            if (p2,r2) not in residue_links:
-                residue_links[(p2,r2)]=set([(p1,r1)])
-            else:
-                residue_links[(p2,r2)].add((p1,r1))
-
-        for xl in self:
-            (p1,p2,r1,r2)=_ProteinsResiduesArray(xl)
-            xl[self.residue1_links_number_key]=len(residue_links[(p1,r1)])
-            xl[self.residue2_links_number_key]=len(residue_links[(p2,r2)])
+        rows = self._get_rows()
+        if len(rows) == 0:
+            return
+        (s1, s2, nsites) = self._get_sites(rows)[1]
+        # number of distinct sites each site is linked to
+        links = np.unique(np.concatenate((s1 * nsites + s2,
+                                          s2 * nsites + s1)))
+        links_number = np.bincount(links // nsites, minlength=nsites)
+        self._table.set_array(self.residue1_links_number_key, rows,
+                              links_number[s1])
+        self._table.set_array(self.residue2_links_number_key, rows,
+                              links_number[s2])
 
     def check_cross_link_consistency(self):
         """This function checks the consistency of the dataset with the amino acid sequence"""
@@ -767,12 +1535,18 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
             cnt_matched, cnt_matched_file = 0, 0
             matched = {}
             non_matched = {}
-            for xl in self:
-                (p1, p2, r1, r2) = _ProteinsResiduesArray(xl)
+            rows = self._get_rows()
+            (p1s, p2s, r1s, r2s) = self._get_sites(rows)[0]
+            aa1s, has_aa1s = self._table.get_array(
+                                self.residue1_amino_acid_key, rows)
+            aa2s, has_aa2s = self._table.get_array(
+                                self.residue2_amino_acid_key, rows)
+            for n in range(len(rows)):
+                p1, p2, r1, r2 = p1s[n], p2s[n], r1s[n], r2s[n]
                 b_matched_file = False
-                if self.residue1_amino_acid_key in xl:
+                if has_aa1s[n]:
                     # either you know the residue type and aa_tuple is a single entry
-                    aa_from_file = (xl[self.residue1_amino_acid_key].upper(),)
+                    aa_from_file = (aa1s[n].upper(),)
                     b_matched = self._match_xlinks(p1, r1, aa_from_file)
                     b_matched_file = b_matched
                 else:
@@ -781,8 +1555,8 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
 
                 matched, non_matched = self._update_matched_xlinks(b_matched, p1, r1, matched, non_matched)
 
-                if self.residue2_amino_acid_key in xl:
-                    aa_from_file = (xl[self.residue2_amino_acid_key].upper(), )
+                if has_aa2s[n]:
+                    aa_from_file = (aa2s[n].upper(), )
                     b_matched = self._match_xlinks(p2, r2, aa_from_file)
                     b_matched_file = b_matched
                 else:
@@ -805,6 +1579,18 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
             return matched,non_matched
 
     def _match_xlinks(self, prot_name, res_index, aa_tuple):
+        # the result only depends on the sequences, so is cached for
+        # each (protein, residue, amino acids)
+        if self._match_cache[0] is not self.fasta_seq:
+            self._match_cache = (self.fasta_seq, {})
+        key = (prot_name, res_index, tuple(aa_tuple))
+        cache = self._match_cache[1]
+        if key not in cache:
+            cache[key] = self._match_xlinks_to_sequence(prot_name, res_index,
+                                                        aa_tuple)
+        return cache[key]
+
+    def _match_xlinks_to_sequence(self, prot_name, res_index, aa_tuple):
         # returns Boolean whether given aa matches a position in the fasta file
         # cross link files usually start counting at 1 and not 0; therefore subtract -1 to compare with fasta
         amino_dict = IMP.pmi.tools.ThreeToOneConverter()
@@ -875,17 +1661,29 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
 
         return string
 
+    def _create_view(self, groups):
+        '''Create a database of some of the cross-links of this one,
+           sharing their storage.
+           @param groups dictionary from unique ID to the list of
+                  table rows of its cross-links'''
+        cdb = CrossLinkDataBase(self.cldbkc)
+        cdb._table = self._table
+        for xlid in groups:
+            cdb._groups[xlid] = list(groups[xlid])
+        cdb._rows = None
+        cdb._update()
+        return cdb
+
     def filter(self,FilterOperator):
-        new_xl_dict={}
-        for id in self.data_base.keys():
-            for xl in self.data_base[id]:
-                if FilterOperator.evaluate(xl):
-                    if id not in new_xl_dict:
-                        new_xl_dict[id]=[xl]
-                    else:
-                        new_xl_dict[id].append(xl)
-        self._update()
-        cdb = CrossLinkDataBase(self.cldbkc,new_xl_dict)
+        self._update_derived(FilterOperator.compile().keys)
+        rows = self._get_rows()
+        selected = set(rows[FilterOperator._get_mask(self._table, rows)].tolist())
+        new_groups=OrderedDict()
+        for id in self._groups:
+            group=[row for row in self._groups[id] if row in selected]
+            if group:
+                new_groups[id]=group
+        cdb = self._create_view(new_groups)
         cdb.dataset = self.dataset
         return cdb
 
@@ -914,12 +1712,8 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
             name2=id(CrossLinkDataBase2)
 
         #rename first database:
-        new_data_base={}
-        for k in self.data_base:
-            new_data_base[k]=self.data_base[k]
         for k in CrossLinkDataBase2.data_base:
-            new_data_base[k]=CrossLinkDataBase2.data_base[k]
-        self.data_base=new_data_base
+            self._set_group(k, CrossLinkDataBase2.data_base[k])
         self._update()
 
     def set_value(self,key,new_value,FilterOperator=None):
@@ -934,12 +1728,12 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
         example: `cldb1.set_value(cldb1.protein1_key,'FFF',FO(cldb.protein1_key,operator.eq,"AAA"))`
         '''
 
-        for xl in self:
-            if FilterOperator is not None:
-                if FilterOperator.evaluate(xl):
-                    xl[key]=new_value
-            else:
-                xl[key]=new_value
+        rows = self._get_rows()
+        if FilterOperator is not None:
+            self._update_derived(FilterOperator.compile().keys)
+            rows = rows[FilterOperator._get_mask(self._table, rows)]
+        self._update_derived((key,))
+        self._table.set_array(key, rows, new_value)
         self._update()
 
     def get_values(self,key):
@@ -947,10 +1741,11 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
         this function returns the list of values for a given key in the database
         alphanumerically sorted
         '''
-        values=set()
-        for xl in self:
-            values.add(xl[key])
-        return sorted(list(values))
+        self._update_derived((key,))
+        values, present = self._table.get_array(key, self._get_rows())
+        if not present.all():
+            raise KeyError(key)
+        return sorted(set(values.tolist()))
 
     def offset_residue_index(self,protein_name,offset):
         '''
@@ -959,11 +1754,15 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
         @param offset: the offset value
         '''
 
-        for xl in self:
-            if xl[self.protein1_key] == protein_name:
-                xl[self.residue1_key]=xl[self.residue1_key]+offset
-            if xl[self.protein2_key] == protein_name:
-                xl[self.residue2_key]=xl[self.residue2_key]+offset
+        rows = self._get_rows()
+        for protein_key, residue_key in ((self.protein1_key, self.residue1_key),
+                                         (self.protein2_key, self.residue2_key)):
+            proteins, present = self._table.get_array(protein_key, rows)
+            protein_rows = rows[present & (proteins == protein_name)]
+            residues, present = self._table.get_array(residue_key, protein_rows)
+            if not present.all():
+                raise KeyError(residue_key)
+            self._table.set_array(residue_key, protein_rows, residues + offset)
         self._update()
 
     def create_new_keyword(self,keyword,values_from_keyword=None):
@@ -973,11 +1772,15 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
         @param keyword the new keyword name:
         @param values_from_keyword the keyword from which we are copying the values:
         '''
-        for xl in self:
-            if values_from_keyword is not None:
-                xl[keyword] = xl[values_from_keyword]
-            else:
-                xl[keyword] = None
+        self._update_derived((keyword, values_from_keyword))
+        rows = self._get_rows()
+        if values_from_keyword is not None:
+            values, present = self._table.get_array(values_from_keyword, rows)
+            if not present.all():
+                raise KeyError(values_from_keyword)
+            self._table.set_array(keyword, rows, values)
+        else:
+            self._table.set_array(keyword, rows, None)
         self._update()
 
     def rename_proteins(self,old_to_new_names_dictionary, protein_to_rename="both"):
@@ -997,32 +1800,49 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
                 fo2=FilterOperator(self.protein2_key,operator.eq,old_name)
                 self.set_value(self.protein2_key,new_name,fo2)
 
+    def _get_protein_masks(self, rows, protein_name):
+        '''Get boolean arrays flagging the given rows whose protein1
+           and protein2 are protein_name'''
+        masks = []
+        for key in (self.protein1_key, self.protein2_key):
+            proteins, present = self._table.get_array(key, rows)
+            masks.append(present & (proteins == protein_name))
+        return masks
+
     def clone_protein(self,protein_name,new_protein_name):
-        new_xl_dict={}
-        for id in self.data_base.keys():
-            new_data_base=[]
-            for xl in self.data_base[id]:
-                new_data_base.append(xl)
-                if xl[self.protein1_key]==protein_name and xl[self.protein2_key]!=protein_name:
-                    new_xl=dict(xl)
-                    new_xl[self.protein1_key]=new_protein_name
-                    new_data_base.append(new_xl)
-                elif xl[self.protein1_key]!=protein_name and xl[self.protein2_key]==protein_name:
-                    new_xl=dict(xl)
-                    new_xl[self.protein2_key]=new_protein_name
-                    new_data_base.append(new_xl)
-                elif xl[self.protein1_key]==protein_name and xl[self.protein2_key]==protein_name:
-                    new_xl=dict(xl)
-                    new_xl[self.protein1_key]=new_protein_name
-                    new_data_base.append(new_xl)
-                    new_xl=dict(xl)
-                    new_xl[self.protein2_key]=new_protein_name
-                    new_data_base.append(new_xl)
-                    new_xl=dict(xl)
-                    new_xl[self.protein1_key]=new_protein_name
-                    new_xl[self.protein2_key]=new_protein_name
-                    new_data_base.append(new_xl)
-            self.data_base[id]=new_data_base
+        rows = self._get_rows()
+        is_protein1, is_protein2 = self._get_protein_masks(rows, protein_name)
+        clone_keys = dict(zip(rows.tolist(),
+                              zip(is_protein1.tolist(), is_protein2.tolist())))
+        # for each group, place the clones of each cross-link right after it
+        clones = []
+        new_groups = OrderedDict()
+        for id in self._groups:
+            new_rows = []
+            for row in self._groups[id]:
+                new_rows.append(row)
+                p1, p2 = clone_keys.get(row, (False, False))
+                if p1 and not p2:
+                    to_rename = [(True, False)]
+                elif p2 and not p1:
+                    to_rename = [(False, True)]
+                elif p1 and p2:
+                    to_rename = [(True, False), (False, True), (True, True)]
+                else:
+                    to_rename = []
+                for rename in to_rename:
+                    new_rows.append(-1 - len(clones))
+                    clones.append((row, rename))
+            new_groups[id] = new_rows
+        clone_rows = self._table.copy_rows([c[0] for c in clones])
+        for n, key in enumerate((self.protein1_key, self.protein2_key)):
+            self._table.set_array(key, [row for row, c in zip(clone_rows, clones)
+                                        if c[1][n]], new_protein_name)
+        for id in new_groups:
+            new_groups[id] = [clone_rows[-1 - row] if row < 0 else row
+                              for row in new_groups[id]]
+        self._groups = new_groups
+        self._rows = None
         self._update()
 
     def filter_out_same_residues(self):
@@ -1030,15 +1850,17 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
         This function remove cross-links applied to the same residue
         (ie, same chain name and residue number)
         '''
-        new_xl_dict={}
-        for id in self.data_base.keys():
-            new_data_base=[]
-            for xl in self.data_base[id]:
-                if xl[self.protein1_key]==xl[self.protein2_key] and xl[self.residue1_key]==xl[self.residue2_key]:
-                    continue
-                else:
-                    new_data_base.append(xl)
-            self.data_base[id]=new_data_base
+        rows = self._get_rows()
+        p1, has_p1 = self._table.get_array(self.protein1_key, rows)
+        p2, has_p2 = self._table.get_array(self.protein2_key, rows)
+        r1, has_r1 = self._table.get_array(self.residue1_key, rows)
+        r2, has_r2 = self._table.get_array(self.residue2_key, rows)
+        same = has_p1 & has_p2 & has_r1 & has_r2 & (p1 == p2) & (r1 == r2)
+        same_rows = set(rows[same].tolist())
+        for id in self._groups:
+            self._groups[id] = [row for row in self._groups[id]
+                                if row not in same_rows]
+        self._rows = None
         self._update()
 
 
@@ -1054,11 +1876,9 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
             raise ValueError('the percentage of random cross-link spectra should be between 0 and 1')
         nspectra=self.get_number_of_xlid()
         nrandom_spectra=int(nspectra*percentage)
-        random_keys=random.sample(self.data_base.keys(),nrandom_spectra)
-        new_data_base={}
-        for k in random_keys:
-            new_data_base[k]=self.data_base[k]
-        return CrossLinkDataBase(self.cldbkc,new_data_base)
+        random_keys=random.sample(sorted(self._groups.keys()),nrandom_spectra)
+        return self._create_view(
+                    OrderedDict((k, self._groups[k]) for k in random_keys))
 
     def __str__(self):
         outstr=''
@@ -1182,10 +2002,103 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
                   xplotrange=None,normalized=True,
                   leg_names=None)
 
+    def _get_dicts(self):
+        '''Get a copy of the database as a dictionary from unique ID
+           to the list of cross-links, as dictionaries'''
+        self._update_derived()
+        rows = self._get_rows()
+        xls = [{} for row in rows]
+        for key in self._table.columns:
+            values, present = self._table.get_array(key, rows)
+            values = values.tolist()
+            for n in np.flatnonzero(present).tolist():
+                xls[n][key] = values[n]
+        data_base = {}
+        start = 0
+        for xlid in sorted(self._groups):
+            end = start + len(self._groups[xlid])
+            data_base[xlid] = xls[start:end]
+            start = end
+        return data_base
+
     def dump(self,json_filename):
         import json
         with open(json_filename, 'w') as fp:
-            json.dump(self.data_base, fp, sort_keys=True, indent=2, default=set_json_default)
+            json.dump(self._get_dicts(),
+                      fp, sort_keys=True, indent=2, default=set_json_default)
+
+    def dump_binary(self,file_name):
+        '''
+        Save the database in a compact binary file, which load_binary()
+        reads back much faster than load() reads the output of dump().
+        The derived fields (unique sub-indexes, redundancy, residue link
+        numbers) are not saved, but computed again when loading.
+        '''
+        try:
+            import cPickle as pickle
+        except ImportError:
+            import pickle
+        derived = set(k for f in self._get_derived_fields() for k in f[0])
+        rows = self._get_rows()
+        columns = []
+        for key in self._table.columns:
+            if key in derived:
+                continue
+            values, present = self._table.get_array(key, rows)
+            if not present.any():
+                continue
+            only_present = False
+            if values.dtype.kind == 'O':
+                strings = values[present].tolist()
+                # a NumPy string array is much more compact to store than
+                # a list of Python objects (but drops trailing NULs)
+                if all(type(v) is str and v[-1:] != '\0' for v in strings):
+                    values = np.array(strings)
+                    only_present = True
+            columns.append((key, values, present, only_present))
+        xlids = sorted(self._groups)
+        data = {'xlids': xlids,
+                'group_sizes': np.array([len(self._groups[k]) for k in xlids],
+                                        dtype=np.int64),
+                'columns': columns}
+        with open(file_name, 'wb') as fh:
+            fh.write(_binary_format_header)
+            pickle.dump(data, fh, 2)
+
+    def load_binary(self,file_name):
+        '''
+        Load cross-links saved by dump_binary(), replacing those in the
+        database
+        @note The file is read with pickle, so only load files from
+              trusted sources
+        '''
+        try:
+            import cPickle as pickle
+        except ImportError:
+            import pickle
+        with open(file_name, 'rb') as fh:
+            if fh.read(len(_binary_format_header)) != _binary_format_header:
+                raise ValueError("%s is not a cross-link database saved by "
+                                 "dump_binary()" % file_name)
+            data = pickle.load(fh)
+        group_sizes = data['group_sizes']
+        nrows = int(group_sizes.sum())
+        columns = OrderedDict()
+        for key, values, present, only_present in data['columns']:
+            if only_present:
+                # put the strings back at the rows that have the key
+                all_values = np.empty(nrows, dtype=object)
+                all_values[present] = values.astype(object)
+                values = all_values
+            columns[key] = (values, present)
+        rows = self._table.add_columns(nrows, columns)
+        ends = np.cumsum(group_sizes).tolist()
+        starts = [0] + ends[:-1]
+        rows = rows.tolist()
+        self._groups = OrderedDict((xlid, rows[start:end]) for xlid, start, end
+                                   in zip(data['xlids'], starts, ends))
+        self._rows = None
+        self._update()
 
     def load(self,json_filename):
         import json
@@ -1227,13 +2140,13 @@ class CrossLinkDataBase(_CrossLinkDataBaseStandardKeys):
         """
         Returns the number of non redundant crosslink sites
         """
-        praset=set()
-        for xl in self:
-            pra=_ProteinsResiduesArray(xl)
-            prai=pra.get_inverted()
-            praset.add(pra)
-            praset.add(prai)
-        return len(list(praset))
+        rows = self._get_rows()
+        if len(rows) == 0:
+            return 0
+        (s1, s2, nsites) = self._get_sites(rows)[1]
+        # count each cross-link and its inverse, as _ProteinsResiduesArray
+        return len(np.unique(np.concatenate((s1 * nsites + s2,
+                                             s2 * nsites + s1))))
 
 class JaccardDistanceMatrix(object):
     """This class allows to compute and plot the distance between datasets"""
@@ -1385,40 +2298,24 @@ class MapCrossLinkDataBaseOnStructure(object):
                 xl["MinAmbiguousDistance"]=min(group_dists)
 
     def _get_distance_and_particle_pair(self,r1,c1,r2,c2):
-        '''more robust and slower version of above'''
-        sel=IMP.atom.Selection(self.prots,molecule=c1,residue_index=r1,resolution=1)
-        selpart_1=sel.get_selected_particles()
+        '''more robust version of above'''
+        residue_index=IMP.pmi.tools.get_residue_particle_index(self.prots)
+        selpart_1=residue_index.get_entries(c1,r1,resolution=1)
         if len(selpart_1)==0:
             print("MapCrossLinkDataBaseOnStructure: Warning: no particle selected for first site")
             return None
-        sel=IMP.atom.Selection(self.prots,molecule=c2,residue_index=r2,resolution=1)
-        selpart_2=sel.get_selected_particles()
+        selpart_2=residue_index.get_entries(c2,r2,resolution=1)
         if len(selpart_2)==0:
             print("MapCrossLinkDataBaseOnStructure: Warning: no particle selected for second site")
             return None
         results=[]
-        for p1 in selpart_1:
-            for p2 in selpart_2:
+        for state_index1,copy_index1,p1 in selpart_1:
+            for state_index2,copy_index2,p2 in selpart_2:
                 if p1 == p2 and r1 == r2: continue
                 d1=IMP.core.XYZ(p1)
                 d2=IMP.core.XYZ(p2)
                 #round distance to second decimal
                 dist=float(int(IMP.core.get_distance(d1,d2)*100.0))/100.0
-                h1=IMP.atom.Hierarchy(p1)
-                while not IMP.atom.Molecule.get_is_setup(h1.get_particle()):
-                    h1=h1.get_parent()
-                copy_index1=IMP.atom.Copy(h1).get_copy_index()
-                while not IMP.atom.State.get_is_setup(h1.get_particle()):
-                    h1=h1.get_parent()
-                state_index1=IMP.atom.State(h1).get_state_index()
-                h2=IMP.atom.Hierarchy(p2)
-                while not IMP.atom.Molecule.get_is_setup(h2.get_particle()):
-                    h2=h2.get_parent()
-                copy_index2=IMP.atom.Copy(h2).get_copy_index()
-                while not IMP.atom.State.get_is_setup(h2.get_particle()):
-                    h2=h2.get_parent()
-                state_index2=IMP.atom.State(h2).get_state_index()
-
                 results.append((dist,state_index1,copy_index1,state_index2,copy_index2,p1,p2))
         if len(results)==0: return None
         results_sorted = sorted(results, key=operator.itemgetter(0,1,2,3,4))
@@ -1652,14 +2549,14 @@ class CrossLinkDataBaseFromStructure(object):
 
         self.beta_true=-1.4427*math.log(0.5*(1.0-confidence_true))
         self.beta_false=-1.4427*math.log(0.5*(1.0-confidence_false))
-        self.cldb.data_base[str(number_of_spectra)]=[]
+        new_xl_dict={str(number_of_spectra):[]}
         self.sites_weighted=None
 
         while number_of_spectra<total_number_of_spectra:
-            if random() > ambiguity_probability and len(self.cldb.data_base[str(number_of_spectra)]) != 0:
+            if random() > ambiguity_probability and len(new_xl_dict[str(number_of_spectra)]) != 0:
                     # new spectrum
                 number_of_spectra+=1
-                self.cldb.data_base[str(number_of_spectra)]=[]
+                new_xl_dict[str(number_of_spectra)]=[]
             noisy=False
             if random() > noise:
                 # not noisy crosslink
@@ -1714,7 +2611,8 @@ class CrossLinkDataBaseFromStructure(object):
             else:
                 new_xl["InterRigidBody"] = None
 
-            self.cldb.data_base[str(number_of_spectra)].append(new_xl)
+            new_xl_dict[str(number_of_spectra)].append(new_xl)
+        self.cldb.data_base=new_xl_dict
         self.cldb._update()
         return self.cldb
 
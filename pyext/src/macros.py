@@ -95,6 +95,9 @@ class ReplicaExchange0(object):
                  rmf_dir="rmfs/",
                  best_pdb_dir="pdbs/",
                  replica_stat_file_suffix="stat_replica",
+                 stat_flush_frames=1,
+                 stat_flush_seconds=None,
+                 output_queue_size=0,
                  em_object_for_rmf=None,
                  atomistic=False,
                  replica_exchange_object=None,
@@ -153,6 +156,14 @@ class ReplicaExchange0(object):
            @param write_initial_rmf        Write the initial configuration
            @param global_output_directory Folder that will be created to house
                   output.
+           @param stat_flush_frames Flush stat files to disk every N frames
+                  (see IMP.pmi.output.Output)
+           @param stat_flush_seconds Flush stat files to disk at least this
+                  often, in seconds (see IMP.pmi.output.Output)
+           @param output_queue_size If greater than zero, write stat and
+                  PDB files in a background thread while sampling
+                  continues, with at most this many writes waiting
+                  (see IMP.pmi.output.Output.start_background_writer)
         @param test_mode Set to True to avoid writing any files, just test one frame.
         """
         self.model = model
@@ -238,6 +249,9 @@ class ReplicaExchange0(object):
         self.vars["best_pdb_dir"] = best_pdb_dir
         self.vars["atomistic"] = atomistic
         self.vars["replica_stat_file_suffix"] = replica_stat_file_suffix
+        self.vars["stat_flush_frames"] = stat_flush_frames
+        self.vars["stat_flush_seconds"] = stat_flush_seconds
+        self.vars["output_queue_size"] = output_queue_size
         self.vars["geometries"] = None
         self.test_mode = test_mode
 
@@ -395,7 +409,10 @@ class ReplicaExchange0(object):
             self.rmf_output_objects.append(sw)
 
         print("Setting up stat file")
-        output = IMP.pmi.output.Output(atomistic=self.vars["atomistic"])
+        output = IMP.pmi.output.Output(
+                     atomistic=self.vars["atomistic"],
+                     stat_flush_frames=self.vars["stat_flush_frames"],
+                     stat_flush_seconds=self.vars["stat_flush_seconds"])
         low_temp_stat_file = globaldir + \
             self.vars["stat_file_name_suffix"] + "." + str(myindex) + ".out"
 
@@ -500,63 +517,73 @@ class ReplicaExchange0(object):
         nframes = self.vars["number_of_frames"]
         if self.test_mode:
             nframes = 1
-        for i in range(nframes):
-            if self.test_mode:
-                score = 0.
-            else:
-                for nr in range(self.vars["num_sample_rounds"]):
-                    if sampler_md is not None:
-                        sampler_md.optimize(
-                                  self.vars["molecular_dynamics_steps"])
-                    if sampler_mc is not None:
-                        sampler_mc.optimize(self.vars["monte_carlo_steps"])
-                score = IMP.pmi.tools.get_restraint_set(
-                                             self.model).evaluate(False)
-                mpivs.set_value("score",score)
-            output.set_output_entry("score", score)
-
-
-
-            my_temp_index = int(rex.get_my_temp() * temp_index_factor)
-
-            if self.vars["save_coordinates_mode"] == "lowest_temperature":
-                save_frame=(min_temp_index == my_temp_index)
-            elif self.vars["save_coordinates_mode"] == "25th_score":
-                score_perc=mpivs.get_percentile("score")
-                save_frame=(score_perc*100.0<=25.0)
-            elif self.vars["save_coordinates_mode"] == "50th_score":
-                score_perc=mpivs.get_percentile("score")
-                save_frame=(score_perc*100.0<=50.0)
-            elif self.vars["save_coordinates_mode"] == "75th_score":
-                score_perc=mpivs.get_percentile("score")
-                save_frame=(score_perc*100.0<=75.0)
-
-            # Ensure model is updated before saving output files
-            if save_frame or not self.test_mode:
-                self.model.update()
-
-            if save_frame:
-                print("--- frame %s score %s " % (str(i), str(score)))
+        if self.vars["output_queue_size"] > 0:
+            output.start_background_writer(self.vars["output_queue_size"])
+        try:
+            for i in range(nframes):
+                if self.test_mode:
+                    score = 0.
+                else:
+                    for nr in range(self.vars["num_sample_rounds"]):
+                        if sampler_md is not None:
+                            sampler_md.optimize(
+                                      self.vars["molecular_dynamics_steps"])
+                        if sampler_mc is not None:
+                            sampler_mc.optimize(self.vars["monte_carlo_steps"])
+                    score = IMP.pmi.tools.get_restraint_set(
+                                                 self.model).evaluate(False)
+                    mpivs.set_value("score",score)
+                # all outputs of this frame can share a single scoring pass
+                output.set_output_cache_key(i)
+                output.set_output_entry("score", score)
+
+
+
+                my_temp_index = int(rex.get_my_temp() * temp_index_factor)
+
+                if self.vars["save_coordinates_mode"] == "lowest_temperature":
+                    save_frame=(min_temp_index == my_temp_index)
+                elif self.vars["save_coordinates_mode"] == "25th_score":
+                    score_perc=mpivs.get_percentile("score")
+                    save_frame=(score_perc*100.0<=25.0)
+                elif self.vars["save_coordinates_mode"] == "50th_score":
+                    score_perc=mpivs.get_percentile("score")
+                    save_frame=(score_perc*100.0<=50.0)
+                elif self.vars["save_coordinates_mode"] == "75th_score":
+                    score_perc=mpivs.get_percentile("score")
+                    save_frame=(score_perc*100.0<=75.0)
+
+                # Ensure model is updated before saving output files
+                if save_frame or not self.test_mode:
+                    self.model.update()
+
+                if save_frame:
+                    print("--- frame %s score %s " % (str(i), str(score)))
+
+                    if not self.test_mode:
+                        if i % self.vars["nframes_write_coordinates"]==0:
+                            print('--- writing coordinates')
+                            if self.vars["number_of_best_scoring_models"] > 0:
+                                output.write_pdb_best_scoring(score)
+                            output.write_rmf(rmfname)
+                            output.set_output_entry("rmf_file", rmfname)
+                            output.set_output_entry("rmf_frame_index", ntimes_at_low_temp)
+                        else:
+                            output.set_output_entry("rmf_file", rmfname)
+                            output.set_output_entry("rmf_frame_index", '-1')
+                        if self.output_objects is not None:
+                            output.write_stat2(low_temp_stat_file)
+                    ntimes_at_low_temp += 1
 
                 if not self.test_mode:
-                    if i % self.vars["nframes_write_coordinates"]==0:
-                        print('--- writing coordinates')
-                        if self.vars["number_of_best_scoring_models"] > 0:
-                            output.write_pdb_best_scoring(score)
-                        output.write_rmf(rmfname)
-                        output.set_output_entry("rmf_file", rmfname)
-                        output.set_output_entry("rmf_frame_index", ntimes_at_low_temp)
-                    else:
-                        output.set_output_entry("rmf_file", rmfname)
-                        output.set_output_entry("rmf_frame_index", '-1')
-                    if self.output_objects is not None:
-                        output.write_stat2(low_temp_stat_file)
-                ntimes_at_low_temp += 1
-
-            if not self.test_mode:
-                output.write_stat2(replica_stat_file)
-            if self.vars["replica_exchange_swap"]:
-                rex.swap_temp(i, score)
+                    output.write_stat2(replica_stat_file)
+                if self.vars["replica_exchange_swap"]:
+                    rex.swap_temp(i, score)
+        finally:
+            # make sure all frames reach the disk, even on error
+            output.stop_background_writer()
+            output.close_stats()
+            output.set_output_cache_key(None)
         for p, state in IMP.pmi.tools._all_protocol_outputs(
                             [self.representation],
                             self.root_hier if self.pmi2 else None):
@@ -990,7 +1017,10 @@ class AnalysisReplicaExchange0(object):
         @param number_of_best_scoring_models  Num models to keep per run
         @param rmsd_calculation_components    For calculating RMSD
                                                (same format as alignment_components)
-        @param distance_matrix_file           Where to store/read the distance matrix
+        @param distance_matrix_file           Where to store/read the distance matrix.
+                                               The matrix is written to this file as
+                                               it is calculated, so an interrupted
+                                               calculation is resumed when rerun.
         @param load_distance_matrix_file      Try to load the distance matrix file
         @param skip_clustering                Just extract the best scoring models
                                                and save the pdbs
@@ -1293,7 +1323,7 @@ class AnalysisReplicaExchange0(object):
             print("Global calculating the distance matrix")
 
             # calculate distance matrix, all against all
-            self.cluster_obj.dist_matrix()
+            self.cluster_obj.dist_matrix(file_name=distance_matrix_file)
 
             # perform clustering and optionally display
             if self.rank == 0:
@@ -1484,18 +1514,28 @@ class AnalysisReplicaExchange(object):
                  stat_files,
                  best_models=None,
                  score_key=None,
-                 alignment=True):
+                 alignment=True,
+                 cache_max_bytes=None,
+                 cache_file_name=None):
         """
         Construction of the Class.
         @param model IMP.Model()
         @param stat_files list of string. Can be ascii stat files, rmf files names
         @param best_models Integer. Number of best scoring models, if None: all models will be read
         @param alignment boolean (Default=True). Align before computing the rmsd.
+        @param cache_max_bytes the most memory used to cache the frames of
+               each of the two hierarchies (see
+               IMP.pmi.output.StatHierarchyHandler)
+        @param cache_file_name if given, cached frames that do not fit in
+               memory are stored in this file (and this file name plus
+               ".copy", for the second hierarchy)
         """
 
         self.model=model
         self.best_models=best_models
-        self.stath0=IMP.pmi.output.StatHierarchyHandler(model,stat_files,self.best_models,score_key,cache=True)
+        self.stath0=IMP.pmi.output.StatHierarchyHandler(model,stat_files,self.best_models,score_key,cache=True,
+                                                        cache_max_bytes=cache_max_bytes,
+                                                        cache_file_name=cache_file_name)
         self.stath1=IMP.pmi.output.StatHierarchyHandler(StatHierarchyHandler=self.stath0)
 
         self.rbs1, self.beads1 = IMP.pmi.tools.get_rbs_and_beads(IMP.pmi.tools.select_at_all_resolutions(self.stath1))
@@ -1564,6 +1604,36 @@ class AnalysisReplicaExchange(object):
         #self.merge_aggregates(rmsd_cutoff, metric)
         self.update_clusters()
 
+    def cluster_models(self, algorithm):
+        """
+        Cluster the models with one of the algorithms in IMP.pmi.analysis
+        (LeaderClustering, MiniBatchKMedoids), which work on the coordinates
+        of all models at once rather than computing one RMSD at a time.
+        The rmsd selection is used. If alignment is on, the models are aligned
+        on the rmsd selection, and copies of molecules are assigned as in rmsd()
+        (molecules set as symmetric are treated as ordinary copies).
+        @param algorithm an IMP.pmi.analysis.ClusteringAlgorithm
+        """
+        all_coords = {}
+        data = []
+        for n in range(len(self.stath0)):
+            data.append(self.stath0[n])
+            all_coords[n] = {}
+            for molname, sels in self.seldict0.items():
+                for copy, sel in enumerate(sels):
+                    all_coords[n]["%s..%d" % (molname, copy)] = \
+                        [IMP.core.XYZ(p).get_coordinates()
+                         for p in sel.get_selected_particles()]
+        alignment_protein_names = None
+        if self.alignment:
+            alignment_protein_names = list(all_coords[0].keys())
+        coordinates = IMP.pmi.analysis.ModelCoordinates(
+            all_coords, list(range(len(self.stath0))),
+            alignment_protein_names=alignment_protein_names)
+        self.clean_clusters()
+        self.clusters, labels = algorithm.cluster(coordinates, data=data)
+        self.update_clusters()
+
     def refine(self,rmsd_cutoff=10):
         """
         Refine the clusters by merging the ones whose centers are close
@@ -1714,8 +1784,7 @@ class AnalysisReplicaExchange(object):
         d1=self.stath1[cluster.members[0]]
         self.model.update()
         o.init_rmf(rmf_name, [self.stath1])
-        for n1 in cluster.members:
-            d1=self.stath1[n1]
+        for n1,d1 in self.stath1.iter_frames(cluster.members):
             self.model.update()
             self.apply_molecular_assignments(n1)
             if self.alignment: self.align()
@@ -1772,10 +1841,9 @@ class AnalysisReplicaExchange(object):
 
         for n0 in members1:
             d0=self.stath0[n0]
-            for n1 in cluster.members:
+            for n1,d1 in self.stath1.iter_frames(cluster.members):
                 if n0!=n1:
                     npairs+=1
-                    d1=self.stath1[n1]
                     self.apply_molecular_assignments(n1)
                     tmp_rmsd, _ = self.rmsd()
                     rmsd+=tmp_rmsd
@@ -1795,8 +1863,7 @@ class AnalysisReplicaExchange(object):
         rmsd=0.0
         for cn0,n0 in enumerate(cluster1.members):
             d0=self.stath0[n0]
-            for cn1,n1 in enumerate(cluster2.members):
-                d1=self.stath1[n1]
+            for cn1,(n1,d1) in enumerate(self.stath1.iter_frames(cluster2.members)):
                 tmp_rmsd, _ =self.rmsd()
                 if verbose: print("--- rmsd between structure %s and structure %s is %s"%(str(cn0),str(cn1),str(tmp_rmsd)))
                 rmsd+=tmp_rmsd
@@ -1804,66 +1871,126 @@ class AnalysisReplicaExchange(object):
         precision=rmsd/npairs
         return precision
 
-    def rmsf(self,cluster,molecule,copy_index=0,state_index=0,cluster_ref=None,step=1):
-        """
-        Compute the Root mean square fluctuations
-        of a molecule in a cluster
-        Returns an IMP.pmi.tools.OrderedDict() where the keys are the residue indexes and the value is the rmsf
+    def _get_reference_members(self,cluster,cluster_ref=None):
+        """Get the members used as the reference for a cluster: its center
+        if it has one, otherwise all of its members"""
+        if cluster_ref is None:
+            cluster_ref = cluster
+        if not cluster_ref.center_index is None:
+            return [cluster_ref.center_index]
+        else:
+            return cluster_ref.members
+
+    def _get_molecule_particles(self,molecule,copy_index,state_index):
+        """Select the particles of a molecule in stath0, and of each of
+        its copies in stath1; the copy assignment of each model only
+        decides which of the copies is used
+        @return the residue indexes, the stath0 particles and the
+                stath1 particles of each copy
         """
-        rmsf=IMP.pmi.tools.OrderedDict()
-
         #assumes that residue indexes are identical for stath0 and stath1
-        if cluster_ref is not None:
-            if not cluster_ref.center_index is None:
-                members0 = [cluster_ref.center_index]
-            else:
-                members0 = cluster_ref.members
-        else:
-            if not cluster.center_index is None:
-                members0 = [cluster.center_index]
-            else:
-                members0 = cluster.members
-
         s0=IMP.atom.Selection(self.stath0,molecule=molecule,resolution=1,
                               copy_index=copy_index,state_index=state_index)
         ps0=s0.get_selected_particles()
         #get the residue indexes
         residue_indexes=list(IMP.pmi.tools.OrderedSet([IMP.pmi.tools.get_residue_indexes(p)[0] for p in ps0]))
 
-        #get the corresponding particles
-        #s0=IMP.atom.Selection(stat_ref,molecule=molecule,residue_indexes=residue_indexes,resolution=1,
-        #                      copy_index=copy_index,state_index=state_index)
-        #ps0 = s0.get_selected_particles()
-
-
+        copies1=[]
+        for c in sorted(self.molcopydict1[molecule].keys()):
+            s1=IMP.atom.Selection(self.stath1,molecule=molecule,residue_indexes=residue_indexes,resolution=1,
+                                  copy_index=c,state_index=state_index)
+            ps1=s1.get_selected_particles()
+            if len(ps1)>0:
+                copies1.append(ps1)
+        return residue_indexes, ps0, copies1
+
+    def _iter_molecule_coordinates(self,members,copies1,copy_index):
+        """Yield the model index and the stath1 coordinates of a molecule
+        for each of the given models, after assigning copies and (if
+        requested) aligning each model to the current stath0 frame"""
+        for n1,d1 in self.stath1.iter_frames(members):
+            self.apply_molecular_assignments(n1)
+            ps1=[ps for ps in copies1
+                 if IMP.atom.get_copy_index(IMP.atom.Hierarchy(ps[0]))==copy_index][0]
+            if self.alignment: self.align()
+            coordinates=[tuple(IMP.core.XYZ(p).get_coordinates()) for p in ps1]
+            self.undo_apply_molecular_assignments(n1)
+            yield n1, coordinates
 
+    def get_coordinate_statistics(self,cluster,molecule,copy_index=0,state_index=0,cluster_ref=None,step=1):
+        """
+        Accumulate the coordinates of a molecule over the members of a
+        cluster, in a single pass, after assigning copies and (if
+        requested) aligning each member to the cluster reference
+        @return the residue index of each particle and an
+                IMP.pmi.analysis.CoordinateAccumulator, whose frames are
+                identified by model index
+        """
+        n0=self._get_reference_members(cluster,cluster_ref)[0]
+        residue_indexes, ps0, copies1 = self._get_molecule_particles(
+                                        molecule, copy_index, state_index)
+        accumulator=IMP.pmi.analysis.CoordinateAccumulator()
+        d0=self.stath0[n0]
+        for n1, coordinates in self._iter_molecule_coordinates(
+                                        cluster.members[::step], copies1,
+                                        copy_index):
+            accumulator.add(coordinates, frame=n1)
+        return residue_indexes, accumulator
+
+    def _get_distances_to_reference(self,cluster,molecule,copy_index,state_index,cluster_ref,step):
+        """Get the distance of each particle of a molecule from the
+        reference, averaged over every pair of a reference member and a
+        (different) cluster member
+        @return the residue indexes and the average distances
+        """
+        members0=self._get_reference_members(cluster,cluster_ref)
+        residue_indexes, ps0, copies1 = self._get_molecule_particles(
+                                        molecule, copy_index, state_index)
+        nparticles=min(len(ps0), len(residue_indexes))
+        distances=np.zeros(nparticles)
         npairs=0
         for n0 in members0:
+            # the copy assignment and alignment of each member depend on
+            # the reference, so load it before reading the members
             d0=self.stath0[n0]
-            for n1 in cluster.members[::step]:
-                if n0!=n1:
-                    print("--- rmsf %s %s"%(str(n0),str(n1)))
-                    self.apply_molecular_assignments(n1)
+            coordinates0=np.array([IMP.core.XYZ(p).get_coordinates()
+                                   for p in ps0[:nparticles]],
+                                  dtype=float).reshape(nparticles, 3)
+            members=[n1 for n1 in cluster.members[::step] if n1!=n0]
+            for n1, coordinates in self._iter_molecule_coordinates(
+                                        members, copies1, copy_index):
+                n=min(nparticles, len(coordinates))
+                coordinates1=np.array(coordinates[:n],
+                                      dtype=float).reshape(n, 3)
+                distances[:n]+=np.sqrt(
+                        ((coordinates1-coordinates0[:n])**2).sum(axis=1))
+                npairs+=1
+        return residue_indexes[:nparticles], distances/max(npairs,1)
 
-                    s1=IMP.atom.Selection(self.stath1,molecule=molecule,residue_indexes=residue_indexes,resolution=1,
-                                          copy_index=copy_index,state_index=state_index)
-                    ps1 = s1.get_selected_particles()
-
-                    d1=self.stath1[n1]
-                    if self.alignment: self.align()
-                    for n,(p0,p1) in enumerate(zip(ps0,ps1)):
-                        r=residue_indexes[n]
-                        d0=IMP.core.XYZ(p0)
-                        d1=IMP.core.XYZ(p1)
-                        if r in rmsf:
-                            rmsf[r]+=IMP.core.get_distance(d0,d1)
-                        else:
-                            rmsf[r]=IMP.core.get_distance(d0,d1)
-                    npairs+=1
-                    self.undo_apply_molecular_assignments(n1)
-        for r in rmsf:
-            rmsf[r]/=npairs
+    def rmsf(self,cluster,molecule,copy_index=0,state_index=0,cluster_ref=None,step=1,about_mean=False):
+        """
+        Compute the Root mean square fluctuations
+        of a molecule in a cluster
+        Returns an IMP.pmi.tools.OrderedDict() where the keys are the residue indexes and the value is the rmsf
+        @param about_mean if False, the value for each residue is its
+               distance from the cluster reference (the cluster center, or
+               each member if there is no center) averaged over the
+               members. If True, it is the root mean square deviation from
+               its mean position over the members (see
+               get_coordinate_statistics()), computed in a single pass.
+        """
+        if about_mean:
+            residue_indexes, accumulator = self.get_coordinate_statistics(
+                   cluster, molecule, copy_index, state_index, cluster_ref, step)
+            values = accumulator.get_rmsf()
+        else:
+            residue_indexes, values = self._get_distances_to_reference(
+                   cluster, molecule, copy_index, state_index, cluster_ref, step)
+        rmsf=IMP.pmi.tools.OrderedDict()
+        for r, value in zip(residue_indexes, values):
+            rmsf[r]=rmsf.get(r, 0.)+float(value)
 
+        for r in rmsf:
             for stath in [self.stath0,self.stath1]:
                 if molecule not in self.symmetric_molecules:
                     s=IMP.atom.Selection(stath,molecule=molecule,residue_index=r,resolution=1,
@@ -1886,9 +2013,8 @@ class AnalysisReplicaExchange(object):
         dens = IMP.pmi.analysis.GetModelDensity(density_custom_ranges,
                                                 voxel=voxel_size)
 
-        for n1 in cluster.members[::step]:
+        for n1,d1 in self.stath1.iter_frames(cluster.members[::step]):
             print("density "+str(n1))
-            d1=self.stath1[n1]
             self.apply_molecular_assignments(n1)
             if self.alignment: self.align()
             dens.add_subunits_density(self.stath1)
@@ -1929,9 +2055,8 @@ class AnalysisReplicaExchange(object):
                 prev_stop+=seqlen
 
 
-        for ncl,n1 in enumerate(cluster.members):
+        for ncl,(n1,d1) in enumerate(self.stath1.iter_frames(cluster.members)):
             print(ncl)
-            d1=self.stath1[n1]
             #self.apply_molecular_assignments(n1)
             coord_dict=IMP.pmi.tools.OrderedDict()
             for mol in mols:
@@ -2268,7 +2393,9 @@ class AnalysisReplicaExchange(object):
 
     def rmsd_helper(self, sels0, sels1, metric):
         '''
-        a function that returns the permutation best_sel of sels0 that minimizes metric
+        a function that returns the permutation best_sel of sels0 that minimizes metric.
+        Without symmetries, the metric is evaluated once for each pair of
+        copies and the best permutation found by solving the assignment problem.
         '''
         best_rmsd2 = float('inf')
         best_sel = None
@@ -2288,14 +2415,11 @@ class AnalysisReplicaExchange(object):
                     best_sel = sels
                     best_order=order
         else:
-            for sels in itertools.permutations(sels0):
-                rmsd2=0.0
-                for sel0, sel1 in itertools.takewhile(lambda x: rmsd2<best_rmsd2, zip(sels, sels1)):
-                    r=metric(sel0, sel1)
-                    rmsd2+=r*r
-                if rmsd2 < best_rmsd2:
-                    best_rmsd2 = rmsd2
-                    best_sel = sels
+            # cost[i][j]: squared metric between copy j of sels0 and copy i of sels1
+            cost = [[metric(sel0, sel1)**2 for sel0 in sels0] for sel1 in sels1]
+            order = IMP.pmi.tools.get_best_assignment(cost)
+            best_sel = tuple(sels0[j] for j in order)
+            best_rmsd2 = sum(cost[i][j] for i, j in enumerate(order))
         ###for i,sel in enumerate(best_sel):
         ###    p0 = sel.get_selected_particles()[0]
         ###    p1 = sels1[i].get_selected_particles()[0]
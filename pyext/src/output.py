@@ -16,6 +16,24 @@ import RMF
 import numpy as np
 import operator
 import string
+import time
+import collections
+import heapq
+import zlib
+import contextlib
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 try:
     import cPickle as pickle
 except ImportError:
@@ -59,16 +77,167 @@ def _flatten(seq):
         else:
             yield elt
 
+class _PDBWritePlan(object):
+    """Static information for writing a PDB file: the particles to write,
+       in order, their atom, residue and chain information, and the
+       PDB records themselves, with only the coordinates left to fill in.
+       Writing a frame then only needs the coordinates."""
+
+    # Coordinates used to find where the coordinates go in a PDB record
+    _placeholder = (1111.125, 2222.25, 3333.375)
+
+    def __init__(self, model, plan):
+        self.model = model
+        self.particle_indexes = [p[0] for p in plan]
+        self.is_atom = [p[1] for p in plan]
+        # (atom type, residue type, chain ID, residue index,
+        #  all residue indexes, radius) for each particle
+        self.infos = [p[2] for p in plan]
+        self._templates = {}
+
+    def get_coordinates(self):
+        """Get the current coordinates of all particles, as an
+           (N,3) NumPy array"""
+        return IMP.pmi.tools.get_coordinates_array(self.model,
+                                                   self.particle_indexes)
+
+    def _get_templates(self, write_all_residues_per_bead):
+        """Get a list of (particle number, residue number, record before
+           coordinates, record after coordinates), one per PDB record"""
+        templates = self._templates.get(write_all_residues_per_bead)
+        if templates is not None:
+            return templates
+        templates = []
+        placeholder = "%8.3f%8.3f%8.3f" % self._placeholder
+        for n, (atom_type, residue_type, chain_id, residue_index,
+                all_indexes, radius) in enumerate(self.infos):
+            if write_all_residues_per_bead and all_indexes is not None:
+                residue_numbers = all_indexes
+            else:
+                residue_numbers = [residue_index]
+            for residue_number in residue_numbers:
+                record = self._get_record(n, self._placeholder,
+                                          residue_number)
+                i = record.find(placeholder)
+                if i < 0:
+                    # unexpected record format; let IMP format every record
+                    templates.append((n, residue_number, None, None))
+                else:
+                    templates.append((n, residue_number, record[:i],
+                                      record[i + len(placeholder):]))
+        self._templates[write_all_residues_per_bead] = templates
+        return templates
+
+    def _get_record(self, n, xyz, residue_number):
+        (atom_type, residue_type, chain_id, residue_index,
+         all_indexes, radius) = self.infos[n]
+        if atom_type is None:
+            atom_type = IMP.atom.AT_CA
+        return IMP.atom.get_pdb_string(IMP.algebra.Vector3D(*xyz), n+1,
+                                       atom_type, residue_type, chain_id,
+                                       residue_number, ' ', 1.00, radius)
+
+    def get_pdb_string(self, xyzs, geometric_center=(0, 0, 0),
+                       write_all_residues_per_bead=False):
+        """Get the PDB records for the given coordinates"""
+        xyzs = np.asarray(xyzs) - np.asarray(geometric_center)
+        records = []
+        for n, residue_number, before, after in self._get_templates(
+                                          write_all_residues_per_bead):
+            x, y, z = xyzs[n]
+            if before is None:
+                records.append(self._get_record(n, (x, y, z),
+                                                residue_number))
+            else:
+                records.append("%s%8.3f%8.3f%8.3f%s"
+                               % (before, x, y, z, after))
+        return "".join(records)
+
+
+class _BestScoreList(object):
+    """The sorted list of the best (lowest) scores seen so far.
+       If a file name is given, the list is stored in that file (as
+       binary doubles) so that it can be shared between replicas; every
+       update is done under an exclusive lock on the file, so concurrent
+       replicas never see or write a partially updated list."""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.scores = []
+        if filename is not None:
+            with self._lock() as fh:
+                fh.seek(0)
+                fh.truncate()
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(self.filename, 'a+b') as fh:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            elif msvcrt is not None:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield fh
+            finally:
+                fh.flush()
+                if fcntl is not None:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+                elif msvcrt is not None:
+                    fh.seek(0)
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @contextlib.contextmanager
+    def update(self):
+        """Get the current list of scores, for modification.
+           For a shared list, the file stays locked until the end of the
+           `with` block, after which the modified list is stored."""
+        if self.filename is None:
+            yield self.scores
+            return
+        with self._lock() as fh:
+            fh.seek(0)
+            self.scores = np.frombuffer(fh.read(), dtype='<f8').tolist()
+            yield self.scores
+            fh.seek(0)
+            fh.truncate()
+            fh.write(np.array(self.scores, dtype='<f8').tobytes())
+
+
 class Output(object):
     """Class for easy writing of PDBs, RMFs, and stat files
 
     @note Model should be updated prior to writing outputs.
+    @note Stat files are kept open between writes; call close_stats()
+          once all frames have been written.
     """
-    def __init__(self, ascii=True,atomistic=False):
+    def __init__(self, ascii=True,atomistic=False, stat_flush_frames=1,
+                 stat_flush_seconds=None):
+        """Constructor.
+           @param ascii If False, write_stat() writes pickled frames
+           @param atomistic Write atomic coordinates in PDB files
+           @param stat_flush_frames Flush stat files to disk every N frames
+                  (None to not flush on frame count)
+           @param stat_flush_seconds Flush stat files to disk if more than
+                  this many seconds have elapsed since the last flush
+                  (None to not flush on time)
+        """
         self.dictionary_pdbs = {}
         self.dictionary_rmfs = {}
         self.dictionary_stats = {}
         self.dictionary_stats2 = {}
+        self.dictionary_stats3 = {}
+        self.stat_flush_frames = stat_flush_frames
+        self.stat_flush_seconds = stat_flush_seconds
+        # open stat file handles, keyed by file name; values are
+        # [handle, frames written since last flush, time of last flush]
+        self._stat_handles = {}
+        # get_output() results for the current frame, keyed by object id;
+        # see set_output_cache_key()
+        self._output_cache = {}
+        self._output_cache_key = None
+        # see start_background_writer()
+        self._background_writer = None
         self.best_score_list = None
         self.nbestscoring = None
         self.suffixes = []
@@ -81,10 +250,36 @@ class Output(object):
         # Multi-character chain IDs, suitable for mmCIF output
         self.multi_chainids = _ChainIDs()
         self.dictchain = {}  # keys are molecule names, values are chain ids
+        # static information for writing each PDB file; see
+        # _get_pdb_write_plan()
+        self._pdb_write_plans = {}
         self.particle_infos_for_pdb = {}
         self.atomistic=atomistic
         self.use_pmi2 = False
 
+    def set_output_cache_key(self, key):
+        """Share get_output() results between all outputs of a frame.
+           While the key stays the same, the get_output() method of each
+           object is called at most once, and its result is reused by the
+           stat files and the RMF stat category. Set a new key (e.g. the
+           frame number) every time the model is rescored, or None to
+           disable caching (the default).
+        """
+        if key != self._output_cache_key:
+            self._output_cache = {}
+        self._output_cache_key = key
+
+    def _get_output(self, obj):
+        """Get the output of an object, using the per-frame cache if set"""
+        if self._output_cache_key is None:
+            return obj.get_output()
+        cached = self._output_cache.get(id(obj))
+        if cached is None:
+            # keep a reference to the object so that its id is not reused
+            cached = (obj, obj.get_output())
+            self._output_cache[id(obj)] = cached
+        return cached[1]
+
     def get_pdb_names(self):
         """Get a list of all PDB files being output by this instance"""
         return list(self.dictionary_pdbs.keys())
@@ -97,6 +292,7 @@ class Output(object):
 
     def _init_dictchain(self, name, prot, multichar_chain=False):
         self.dictchain[name] = {}
+        self._pdb_write_plans.pop(name, None)
         self.use_pmi2 = False
 
         # attempt to find PMI objects.
@@ -170,40 +366,34 @@ class Output(object):
                   appendmode=True,
                   translate_to_geometric_center=False,
                   write_all_residues_per_bead=False):
-        if appendmode:
-            flpdb = open(name, 'a')
+        plan, xyzs = self._get_pdb_coordinates(name)
+
+        if translate_to_geometric_center and len(xyzs) > 0:
+            geometric_center = tuple(xyzs.mean(axis=0))
         else:
-            flpdb = open(name, 'w')
+            geometric_center = (0, 0, 0)
 
-        (particle_infos_for_pdb,
-         geometric_center) = self.get_particle_infos_for_pdb_writing(name)
+        self._submit(self._write_pdb_file, name, appendmode, plan, xyzs,
+                     geometric_center, write_all_residues_per_bead)
 
-        if not translate_to_geometric_center:
-            geometric_center = (0, 0, 0)
+    def _get_pdb_coordinates(self, name):
+        """Get the write plan for a PDB file, and a copy of the current
+           coordinates of its particles, in the order of the plan"""
+        plan = self._get_pdb_write_plan(name)
+        return plan, plan.get_coordinates()
 
-        for n,tupl in enumerate(particle_infos_for_pdb):
-            (xyz, atom_type, residue_type,
-             chain_id, residue_index, all_indexes, radius) = tupl
-            if atom_type is None:
-                atom_type = IMP.atom.AT_CA
-            if ( (write_all_residues_per_bead) and (all_indexes is not None) ):
-                for residue_number in all_indexes:
-                    flpdb.write(IMP.atom.get_pdb_string((xyz[0] - geometric_center[0],
-                                                        xyz[1] - geometric_center[1],
-                                                        xyz[2] - geometric_center[2]),
-                                                        n+1, atom_type, residue_type,
-                                                        chain_id, residue_number,' ',1.00,radius))
-            else:
-                flpdb.write(IMP.atom.get_pdb_string((xyz[0] - geometric_center[0],
-                                                    xyz[1] - geometric_center[1],
-                                                    xyz[2] - geometric_center[2]),
-                                                    n+1, atom_type, residue_type,
-                                                    chain_id, residue_index,' ',1.00,radius))
+    def _write_pdb_file(self, name, appendmode, plan, xyzs,
+                        geometric_center, write_all_residues_per_bead=False):
+        """Write a PDB model, given coordinates from _get_pdb_coordinates()"""
+        if appendmode:
+            flpdb = open(name, 'a')
+        else:
+            flpdb = open(name, 'w')
+        flpdb.write(plan.get_pdb_string(xyzs, geometric_center,
+                                        write_all_residues_per_bead))
         flpdb.write("ENDMDL\n")
         flpdb.close()
 
-        del particle_infos_for_pdb
-
     def get_prot_name_from_particle(self, name, p):
         """Get the protein name from the particle.
            This is done by traversing the hierarchy."""
@@ -214,20 +404,47 @@ class Output(object):
                                        p, self.dictchain[name])
 
     def get_particle_infos_for_pdb_writing(self, name):
-        # index_residue_pair_list={}
+        """Get the information needed to write a PDB file.
+           @return a tuple of a list of (coordinates, atom type, residue
+                   type, chain ID, residue index, all residue indexes,
+                   radius) tuples, one per particle sorted by chain and
+                   residue, and the geometric center of the particles
+        """
+        plan = self._get_pdb_write_plan(name)
+        xyzs = plan.get_coordinates()
+        particle_infos_for_pdb = []
+        for xyz, info, is_atom in zip(xyzs, plan.infos, plan.is_atom):
+            if is_atom:
+                xyz = list(xyz)
+            else:
+                xyz = IMP.algebra.Vector3D(*xyz)
+            particle_infos_for_pdb.append((xyz,) + info)
+        if len(xyzs) > 0:
+            geometric_center = tuple(xyzs.mean(axis=0))
+        else:
+            geometric_center = (0, 0, 0)
+        return (particle_infos_for_pdb, geometric_center)
 
+    def _get_pdb_write_plan(self, name):
+        """Get the plan for writing the PDB file `name`.
+           The hierarchy is only traversed the first time this is called
+           for a given file (or after it is reinitialized), since the
+           topology does not change during sampling."""
+        plan = self._pdb_write_plans.get(name)
+        if plan is None:
+            plan = self._pdb_write_plans[name] = self._make_pdb_write_plan(
+                                                                     name)
+        return plan
+
+    def _make_pdb_write_plan(self, name):
         # the resindexes dictionary keep track of residues that have been already
         # added to avoid duplication
         # highest resolution have highest priority
         resindexes_dict = {}
 
-        # this dictionary dill contain the sequence of tuples needed to
-        # write the pdb
-        particle_infos_for_pdb = []
-
-        geometric_center = [0, 0, 0]
-        atom_count = 0
-        atom_index = 0
+        # this list will contain the particle index and the static
+        # information needed to write each particle to the pdb
+        plan = []
 
         if self.use_pmi2:
             # select highest resolution
@@ -239,22 +456,19 @@ class Output(object):
             protname, is_a_bead = self.get_prot_name_from_particle(name, p)
 
             if protname not in resindexes_dict:
-                resindexes_dict[protname] = []
+                resindexes_dict[protname] = set()
+            pi = IMP.atom.Hierarchy(p).get_particle_index()
 
             if IMP.atom.Atom.get_is_setup(p) and self.atomistic:
                 residue = IMP.atom.Residue(IMP.atom.Atom(p).get_parent())
                 rt = residue.get_residue_type()
                 resind = residue.get_index()
                 atomtype = IMP.atom.Atom(p).get_atom_type()
-                xyz = list(IMP.core.XYZ(p).get_coordinates())
                 radius = IMP.core.XYZR(p).get_radius()
-                geometric_center[0] += xyz[0]
-                geometric_center[1] += xyz[1]
-                geometric_center[2] += xyz[2]
-                atom_count += 1
-                particle_infos_for_pdb.append((xyz,
-                                               atomtype, rt, self.dictchain[name][protname], resind, None, radius))
-                resindexes_dict[protname].append(resind)
+                plan.append((pi, True, (atomtype, rt,
+                             self.dictchain[name][protname], resind, None,
+                             radius)))
+                resindexes_dict[protname].add(resind)
 
             elif IMP.atom.Residue.get_is_setup(p):
 
@@ -265,16 +479,12 @@ class Output(object):
                 if resind in resindexes_dict[protname]:
                     continue
                 else:
-                    resindexes_dict[protname].append(resind)
+                    resindexes_dict[protname].add(resind)
                 rt = residue.get_residue_type()
-                xyz = IMP.core.XYZ(p).get_coordinates()
                 radius = IMP.core.XYZR(p).get_radius()
-                geometric_center[0] += xyz[0]
-                geometric_center[1] += xyz[1]
-                geometric_center[2] += xyz[2]
-                atom_count += 1
-                particle_infos_for_pdb.append((xyz, None,
-                                               rt, self.dictchain[name][protname], resind, None, radius))
+                plan.append((pi, False, (None, rt,
+                             self.dictchain[name][protname], resind, None,
+                             radius)))
 
             elif IMP.atom.Fragment.get_is_setup(p) and not is_a_bead:
                 resindexes = IMP.pmi.tools.get_residue_indexes(p)
@@ -282,16 +492,12 @@ class Output(object):
                 if resind in resindexes_dict[protname]:
                     continue
                 else:
-                    resindexes_dict[protname].append(resind)
+                    resindexes_dict[protname].add(resind)
                 rt = IMP.atom.ResidueType('BEA')
-                xyz = IMP.core.XYZ(p).get_coordinates()
                 radius = IMP.core.XYZR(p).get_radius()
-                geometric_center[0] += xyz[0]
-                geometric_center[1] += xyz[1]
-                geometric_center[2] += xyz[2]
-                atom_count += 1
-                particle_infos_for_pdb.append((xyz, None,
-                                               rt, self.dictchain[name][protname], resind, resindexes, radius))
+                plan.append((pi, False, (None, rt,
+                             self.dictchain[name][protname], resind,
+                             resindexes, radius)))
 
             else:
                 if is_a_bead:
@@ -299,27 +505,16 @@ class Output(object):
                     resindexes = IMP.pmi.tools.get_residue_indexes(p)
                     if len(resindexes) > 0:
                         resind = resindexes[len(resindexes) // 2]
-                        xyz = IMP.core.XYZ(p).get_coordinates()
                         radius = IMP.core.XYZR(p).get_radius()
-                        geometric_center[0] += xyz[0]
-                        geometric_center[1] += xyz[1]
-                        geometric_center[2] += xyz[2]
-                        atom_count += 1
-                        particle_infos_for_pdb.append((xyz, None,
-                                                       rt, self.dictchain[name][protname], resind, resindexes, radius))
-
-        if atom_count > 0:
-            geometric_center = (geometric_center[0] / atom_count,
-                                geometric_center[1] / atom_count,
-                                geometric_center[2] / atom_count)
+                        plan.append((pi, False, (None, rt,
+                                     self.dictchain[name][protname], resind,
+                                     resindexes, radius)))
 
         # sort by chain ID, then residue index. Longer chain IDs (e.g. AA)
         # should always come after shorter (e.g. Z)
-        particle_infos_for_pdb = sorted(particle_infos_for_pdb,
-                                        key=lambda x: (len(x[3]), x[3], x[4]))
-
-        return (particle_infos_for_pdb, geometric_center)
+        plan = sorted(plan, key=lambda x: (len(x[2][2]), x[2][2], x[2][3]))
 
+        return _PDBWritePlan(self.dictionary_pdbs[name].get_model(), plan)
 
     def write_pdbs(self, appendmode=True):
         for pdb in self.dictionary_pdbs.keys():
@@ -338,16 +533,14 @@ class Output(object):
         if not self.replica_exchange:
             # common usage
             # if you are not in replica exchange mode
-            # initialize the array of scores internally
-            self.best_score_list = []
+            # keep the list of scores internally
+            self._best_scores = _BestScoreList()
         else:
             # otherwise the replicas must communicate
             # through a common file to know what are the best scores
-            self.best_score_file_name = "best.scores.rex.py"
-            self.best_score_list = []
-            with open(self.best_score_file_name, "w") as best_score_file:
-                best_score_file.write(
-                    "self.best_score_list=" + str(self.best_score_list) + "\n")
+            self.best_score_file_name = "best.scores.rex"
+            self._best_scores = _BestScoreList(self.best_score_file_name)
+        self.best_score_list = self._best_scores.scores
 
         self.nbestscoring = nbestscoring
         for i in range(self.nbestscoring):
@@ -361,48 +554,56 @@ class Output(object):
         if self.nbestscoring is None:
             print("Output.write_pdb_best_scoring: init_pdb_best_scoring not run")
 
-        # update the score list
-        if self.replica_exchange:
-            # read the self.best_score_list from the file
-            exec(open(self.best_score_file_name).read())
-
-        if len(self.best_score_list) < self.nbestscoring:
-            self.best_score_list.append(score)
-            self.best_score_list.sort()
-            index = self.best_score_list.index(score)
-            for suffix in self.suffixes:
-                for i in range(len(self.best_score_list) - 2, index - 1, -1):
-                    oldname = suffix + "." + str(i) + ".pdb"
-                    newname = suffix + "." + str(i + 1) + ".pdb"
-                    # rename on Windows fails if newname already exists
-                    if os.path.exists(newname):
-                        os.unlink(newname)
-                    os.rename(oldname, newname)
-                filetoadd = suffix + "." + str(index) + ".pdb"
-                self.write_pdb(filetoadd, appendmode=False)
-
-        else:
-            if score < self.best_score_list[-1]:
+        # the best scores only ever improve, so if this score would not
+        # make the last list we saw, it cannot make the current one either
+        if (len(self.best_score_list) >= self.nbestscoring
+            and score >= self.best_score_list[-1]):
+            return
+        # take a snapshot of the coordinates now, so that the files can
+        # be written in the background while sampling continues
+        coordinates = dict((suffix,
+                            self._get_pdb_coordinates(suffix + ".0.pdb"))
+                           for suffix in self.suffixes)
+        self._submit(self._write_pdb_best_scoring, score, coordinates)
+
+    def _write_pdb_best_scoring(self, score, coordinates):
+        # update the score list; for replica exchange, the shared list is
+        # locked until the PDB files are renamed, so that the files of
+        # different replicas stay consistent with the list
+        with self._best_scores.update() as self.best_score_list:
+            if len(self.best_score_list) < self.nbestscoring:
                 self.best_score_list.append(score)
                 self.best_score_list.sort()
-                self.best_score_list.pop(-1)
                 index = self.best_score_list.index(score)
                 for suffix in self.suffixes:
-                    for i in range(len(self.best_score_list) - 1, index - 1, -1):
+                    for i in range(len(self.best_score_list) - 2, index - 1, -1):
                         oldname = suffix + "." + str(i) + ".pdb"
                         newname = suffix + "." + str(i + 1) + ".pdb"
+                        # rename on Windows fails if newname already exists
+                        if os.path.exists(newname):
+                            os.unlink(newname)
                         os.rename(oldname, newname)
-                    filenametoremove = suffix + \
-                        "." + str(self.nbestscoring) + ".pdb"
-                    os.remove(filenametoremove)
                     filetoadd = suffix + "." + str(index) + ".pdb"
-                    self.write_pdb(filetoadd, appendmode=False)
+                    self._write_pdb_file(filetoadd, False,
+                                         *(coordinates[suffix] + ((0, 0, 0),)))
 
-        if self.replica_exchange:
-            # write the self.best_score_list to the file
-            with open(self.best_score_file_name, "w") as best_score_file:
-                best_score_file.write(
-                    "self.best_score_list=" + str(self.best_score_list) + '\n')
+            else:
+                if score < self.best_score_list[-1]:
+                    self.best_score_list.append(score)
+                    self.best_score_list.sort()
+                    self.best_score_list.pop(-1)
+                    index = self.best_score_list.index(score)
+                    for suffix in self.suffixes:
+                        for i in range(len(self.best_score_list) - 1, index - 1, -1):
+                            oldname = suffix + "." + str(i) + ".pdb"
+                            newname = suffix + "." + str(i + 1) + ".pdb"
+                            os.rename(oldname, newname)
+                        filenametoremove = suffix + \
+                            "." + str(self.nbestscoring) + ".pdb"
+                        os.remove(filenametoremove)
+                        filetoadd = suffix + "." + str(index) + ".pdb"
+                        self._write_pdb_file(filetoadd, False,
+                                         *(coordinates[suffix] + ((0, 0, 0),)))
 
     def init_rmf(self, name, hierarchies, rs=None, geometries=None, listofobjects=None):
         """
@@ -429,7 +630,7 @@ class Output(object):
             for l in listofobjects:
                 if not "get_output" in dir(l):
                     raise ValueError("Output: object %s doesn't have get_output() method" % str(l))
-                output=l.get_output()
+                output=self._get_output(l)
                 for outputkey in output:
                     rmftag=RMF.string_tag
                     if type(output[outputkey]) is float:
@@ -478,7 +679,7 @@ class Output(object):
             outputkey_rmfkey=self.dictionary_rmfs[name][2]
             listofobjects=self.dictionary_rmfs[name][3]
             for l in listofobjects:
-                output=l.get_output()
+                output=self._get_output(l)
                 for outputkey in output:
                     rmfkey=outputkey_rmfkey[outputkey]
                     try:
@@ -502,6 +703,7 @@ class Output(object):
             self.write_rmf(rmfinfo[0])
 
     def init_stat(self, name, listofobjects):
+        self._close_stat_file(name)
         if self.ascii:
             flstat = open(name, 'w')
             flstat.close()
@@ -521,24 +723,16 @@ class Output(object):
     def write_stat(self, name, appendmode=True):
         output = self.initoutput
         for obj in self.dictionary_stats[name]:
-            d = obj.get_output()
+            d = self._get_output(obj)
             # remove all entries that begin with _ (private entries)
             dfiltered = dict((k, v) for k, v in d.items() if k[0] != "_")
             output.update(dfiltered)
 
-        if appendmode:
-            writeflag = 'a'
-        else:
-            writeflag = 'w'
-
         if self.ascii:
-            flstat = open(name, writeflag)
-            flstat.write("%s \n" % output)
-            flstat.close()
+            self._write_to_stat_file(name, "%s \n" % output, appendmode)
         else:
-            flstat = open(name, writeflag + 'b')
-            cPickle.dump(output, flstat, 2)
-            flstat.close()
+            self._write_to_stat_file(name, pickle.dumps(output, 2),
+                                     appendmode, binary=True)
 
     def write_stats(self):
         for stat in self.dictionary_stats.keys():
@@ -547,7 +741,7 @@ class Output(object):
     def get_stat(self, name):
         output = {}
         for obj in self.dictionary_stats[name]:
-            output.update(obj.get_output())
+            output.update(self._get_output(obj))
         return output
 
     def write_test(self, name, listofobjects):
@@ -673,6 +867,7 @@ class Output(object):
             listofsummedobjects = []
         if extralabels is None:
             extralabels = []
+        self._close_stat_file(name)
         flstat = open(name, 'w')
         output = {}
         stat2_keywords = {"STAT2HEADER": "STAT2HEADER"}
@@ -686,7 +881,7 @@ class Output(object):
             if not "get_output" in dir(l):
                 raise ValueError("Output: object %s doesn't have get_output() method" % str(l))
             else:
-                d = l.get_output()
+                d = self._get_output(l)
                 # remove all entries that begin with _ (private entries)
                 dfiltered = dict((k, v)
                                  for k, v in d.items() if k[0] != "_")
@@ -698,7 +893,7 @@ class Output(object):
                 if not "get_output" in dir(t):
                     raise ValueError("Output: object %s doesn't have get_output() method" % str(t))
                 else:
-                    if "_TotalScore" not in t.get_output():
+                    if "_TotalScore" not in self._get_output(t):
                         raise ValueError("Output: object %s doesn't have _TotalScore entry to be summed" % str(t))
                     else:
                         output.update({l[1]: 0.0})
@@ -719,13 +914,20 @@ class Output(object):
             extralabels)
 
     def write_stat2(self, name, appendmode=True):
-        output = {}
         (listofobjects, stat2_inverse, listofsummedobjects,
          extralabels) = self.dictionary_stats2[name]
-
+        output = self._get_stat2_output(listofobjects, stat2_inverse,
+                                        listofsummedobjects, extralabels)
+        self._write_to_stat_file(name, "%s \n" % output, appendmode)
+
+    def _get_stat2_output(self, listofobjects, stat2_inverse,
+                          listofsummedobjects, extralabels):
+        """Collect the current output of all objects, keyed by the
+           integer column indexes of a stat2 (or stat3) header"""
+        output = {}
         # writing objects
         for obj in listofobjects:
-            od = obj.get_output()
+            od = self._get_output(obj)
             dfiltered = dict((k, v) for k, v in od.items() if k[0] != "_")
             for k in dfiltered:
                 output.update({stat2_inverse[k]: od[k]})
@@ -734,7 +936,7 @@ class Output(object):
         for l in listofsummedobjects:
             partial_score = 0.0
             for t in l[0]:
-                d = t.get_output()
+                d = self._get_output(t)
                 partial_score += float(d["_TotalScore"])
             output.update({stat2_inverse[l[1]]: str(partial_score)})
 
@@ -744,20 +946,536 @@ class Output(object):
                 output.update({stat2_inverse[k]: self.initoutput[k]})
             else:
                 output.update({stat2_inverse[k]: "None"})
-
-        if appendmode:
-            writeflag = 'a'
-        else:
-            writeflag = 'w'
-
-        flstat = open(name, writeflag)
-        flstat.write("%s \n" % output)
-        flstat.close()
+        return output
 
     def write_stats2(self):
         for stat in self.dictionary_stats2.keys():
             self.write_stat2(stat)
 
+    def init_stat3(self, name, listofobjects, extralabels=None,
+                   listofsummedobjects=None, string_width=256):
+        """Init writing of a binary stat3 file.
+           This takes the same arguments as init_stat2(), but frames are
+           written as fixed-width binary rows, which can be read back one
+           column at a time with ProcessOutput.get_column().
+           The column types are taken from the values seen in the
+           first frame written by write_stat3(). Numbers (or strings that
+           can be converted to numbers) are stored as 64-bit floats or
+           integers; other values as strings of `string_width` bytes.
+           If a later frame has a value that does not fit its column
+           (e.g. text in a numeric column, or a string longer than the
+           column width) the column is widened, and the frames already
+           in the file converted.
+        """
+        self.init_stat2(name, listofobjects, extralabels, listofsummedobjects)
+        # the stat2 text header is not needed; it will be replaced by a
+        # binary header when the first frame is written
+        flstat = open(name, 'wb')
+        flstat.close()
+        self.dictionary_stats3[name] = _Stat3Writer(
+                name, self.dictionary_stats2.pop(name), string_width,
+                {"STAT3HEADER_ENVIRON": str(self.get_environment_variables()),
+                 "STAT3HEADER_IMP_VERSIONS":
+                         str(self.get_versions_of_relevant_modules())})
+
+    def write_stat3(self, name):
+        writer = self.dictionary_stats3[name]
+        (listofobjects, stat2_inverse, listofsummedobjects,
+         extralabels) = writer.stat2_info
+        output = self._get_stat2_output(listofobjects, stat2_inverse,
+                                        listofsummedobjects, extralabels)
+        old_dtype = writer.update_columns(output)
+        if old_dtype is not None:
+            self._submit(self._do_convert_stat3_file, name, old_dtype,
+                         writer.get_header(), writer.dtype)
+        self._write_to_stat_file(name, writer.get_bytes(output), binary=True)
+
+    def _do_convert_stat3_file(self, name, old_dtype, header, dtype):
+        """Rewrite the frames already in a stat3 file with new column
+           types"""
+        self._close_stat_handle(name)
+        with open(name, 'rb') as fh:
+            offset = _read_stat3_header(fh)[2]
+            fh.seek(offset)
+            rows = np.frombuffer(fh.read(), dtype=old_dtype)
+        new_rows = np.zeros(len(rows), dtype=dtype)
+        for field in dtype.names:
+            new_rows[field] = _convert_stat3_column(rows[field], dtype[field])
+        with open(name, 'wb') as fh:
+            fh.write(header)
+            fh.write(new_rows.tobytes())
+
+    def write_stats3(self):
+        for stat in self.dictionary_stats3.keys():
+            self.write_stat3(stat)
+
+    def _write_to_stat_file(self, name, data, appendmode=True, binary=False):
+        self._submit(self._do_write_to_stat_file, name, data, appendmode,
+                     binary)
+
+    def _do_write_to_stat_file(self, name, data, appendmode, binary):
+        """Write data to a stat file, keeping the file open between calls.
+           The file is flushed according to stat_flush_frames and
+           stat_flush_seconds."""
+        if not appendmode:
+            self._close_stat_handle(name)
+        if name not in self._stat_handles:
+            mode = ('a' if appendmode else 'w') + ('b' if binary else '')
+            self._stat_handles[name] = [open(name, mode), 0, time.time()]
+        handle = self._stat_handles[name]
+        handle[0].write(data)
+        handle[1] += 1
+        if ((self.stat_flush_frames is not None
+             and handle[1] >= self.stat_flush_frames)
+            or (self.stat_flush_seconds is not None
+                and time.time() - handle[2] >= self.stat_flush_seconds)):
+            handle[0].flush()
+            handle[1] = 0
+            handle[2] = time.time()
+
+    def _close_stat_file(self, name):
+        self._wait_for_background_writer()
+        self._close_stat_handle(name)
+
+    def _close_stat_handle(self, name):
+        handle = self._stat_handles.pop(name, None)
+        if handle is not None:
+            handle[0].close()
+
+    def flush_stats(self):
+        """Flush all open stat files to disk"""
+        self._wait_for_background_writer()
+        for handle in self._stat_handles.values():
+            handle[0].flush()
+            handle[1] = 0
+            handle[2] = time.time()
+
+    def close_stats(self):
+        """Flush and close all open stat files.
+           Stat files can still be written to after this call; they
+           will simply be reopened."""
+        self._wait_for_background_writer()
+        for name in list(self._stat_handles.keys()):
+            self._close_stat_handle(name)
+
+    def start_background_writer(self, max_queued_frames=16):
+        """Write stat and PDB files in a background thread.
+           The values to write are still collected (and coordinates
+           copied) at the time of each write call, so the output is the
+           same as without the background writer; only the formatting and
+           file I/O is deferred. RMF frames are always written directly,
+           since RMF reads the coordinates from the model itself.
+           @param max_queued_frames the maximum number of writes waiting
+                  to be done; further write calls block until the writer
+                  catches up
+        """
+        if self._background_writer is None:
+            self._background_writer = _BackgroundWriter(max_queued_frames)
+
+    def stop_background_writer(self):
+        """Finish all pending writes and stop the background writer.
+           Any error raised while writing in the background is raised
+           here (or by the next write call)."""
+        writer = self._background_writer
+        if writer is not None:
+            self._background_writer = None
+            writer.close()
+
+    def _submit(self, func, *args):
+        """Run func(*args), in the background writer if it is running"""
+        if self._background_writer is None:
+            func(*args)
+        else:
+            self._background_writer.submit(func, args)
+
+    def _wait_for_background_writer(self):
+        if self._background_writer is not None:
+            self._background_writer.wait()
+
+
+class _BackgroundWriter(object):
+    """Run output tasks one at a time, in order, in a separate thread.
+       The queue of pending tasks is bounded, so that a slow disk slows
+       down sampling rather than using unlimited memory."""
+
+    def __init__(self, max_queued):
+        self._queue = queue.Queue(max_queued)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                # once a task fails, skip the rest so that the output
+                # does not silently have gaps
+                if self._error is None:
+                    func, args = task
+                    func(*args)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            e = self._error
+            self._error = None
+            raise e
+
+    def submit(self, func, args):
+        self._check_error()
+        self._queue.put((func, args))
+
+    def wait(self):
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._check_error()
+
+
+_STAT3_MAGIC = b"IMP.pmi.stat3\n"
+
+
+def _get_stat3_column_type(values, string_width=None):
+    """Get the numpy type of a stat3 column that can hold all `values`.
+       If `string_width` is None, string columns are made just wide
+       enough for the values given."""
+    def is_int(v):
+        return isinstance(v, int) and not isinstance(v, bool)
+    def is_float(v):
+        if isinstance(v, float) or is_int(v):
+            return True
+        try:
+            float(v)
+            return True
+        except (TypeError, ValueError):
+            return False
+    if all(is_int(v) for v in values):
+        return '<i8'
+    elif all(is_float(v) or v in (None, "None") for v in values):
+        return '<f8'
+    else:
+        if string_width is None:
+            string_width = max([len(str(v).encode('utf-8'))
+                                for v in values] + [1])
+        return 'S%d' % string_width
+
+
+def _get_stat3_value(value, dtype):
+    """Convert a value from get_output() for storage in a stat3 column"""
+    kind = np.dtype(dtype)
+    if kind.char == 'S':
+        s = str(value).encode('utf-8')
+        if len(s) > kind.itemsize:
+            raise ValueError("stat3: value %s is longer than the column "
+                             "width (%d); use a larger string_width"
+                             % (str(value), kind.itemsize))
+        return s
+    elif kind.char == 'd':
+        if value is None or value == "None":
+            return np.nan
+        return float(value)
+    else:
+        return int(float(value))
+
+
+def _get_stat3_value_fits(value, dtype):
+    """Return True iff _get_stat3_value() can store value in a column
+       of the given type"""
+    kind = np.dtype(dtype)
+    if kind.char == 'S':
+        return len(str(value).encode('utf-8')) <= kind.itemsize
+    if kind.char == 'd' and (value is None or value == "None"):
+        return True
+    try:
+        v = float(value)
+    except (TypeError, ValueError):
+        return False
+    return kind.char == 'd' or (v.is_integer() and not isinstance(value, bool))
+
+
+def _get_stat3_wider_column_type(value, dtype, string_width):
+    """Get the type of a column to replace one of type dtype that
+       cannot hold value"""
+    kind = np.dtype(dtype)
+    if kind.char != 'S' and kind.char != 'd' \
+       and _get_stat3_value_fits(value, '<f8'):
+        # integers become floats
+        return '<f8'
+    # numbers become strings; make sure they will fit
+    width = max(len(str(value).encode('utf-8')), string_width,
+                kind.itemsize if kind.char == 'S' else 32)
+    return 'S%d' % width
+
+
+def _convert_stat3_column(values, dtype):
+    """Convert the values of a stat3 column to a wider type"""
+    dtype = np.dtype(dtype)
+    if dtype.char == 'S' and values.dtype.char != 'S':
+        if values.dtype.char == 'd':
+            return [b"None" if np.isnan(v) else repr(v).encode('ascii')
+                    for v in values.tolist()]
+        return [str(v).encode('ascii') for v in values.tolist()]
+    return values.astype(dtype)
+
+
+def _get_stat3_header(header, columns):
+    """Get the stat3 file header: a magic line, then the length of the
+       header dictionary, then the dictionary itself, padded so that the
+       binary rows that follow are 8-byte aligned.
+       `columns` is a list of (key, numpy type) tuples."""
+    header = dict(header)
+    header["STAT3HEADER"] = "STAT3HEADER"
+    for n, col in enumerate(columns):
+        header[n] = col
+    hs = ("%s " % header).encode('utf-8')
+    offset = len(_STAT3_MAGIC) + 16 + len(hs) + 1
+    hs += b" " * (-offset % 8) + b"\n"
+    return _STAT3_MAGIC + ("%015d\n" % len(hs)).encode('ascii') + hs
+
+
+def _read_stat3_header(fh):
+    """Read a stat3 header made by _get_stat3_header().
+       @return the header dictionary, the numpy dtype of each row,
+               and the offset in bytes of the first row"""
+    magic = fh.read(len(_STAT3_MAGIC))
+    if magic != _STAT3_MAGIC:
+        raise ValueError("Not a stat3 file")
+    hlen = int(fh.read(16))
+    header = ast.literal_eval(fh.read(hlen).decode('utf-8'))
+    columns = [header[k] for k in sorted(k for k in header
+                                         if isinstance(k, int))]
+    dtype = np.dtype([("c%d" % n, typ) for n, (key, typ) in enumerate(columns)])
+    return header, dtype, len(_STAT3_MAGIC) + 16 + hlen
+
+
+class _Stat3Writer(object):
+    """Convert frames to the binary rows of a stat3 file.
+       The header (and hence the column types) is generated when the
+       first frame is seen."""
+    def __init__(self, name, stat2_info, string_width, header):
+        self.name = name
+        self.stat2_info = stat2_info
+        self.string_width = string_width
+        self.header = header
+        self.columns = None
+        self.dtype = None
+
+    def _set_columns(self, columns):
+        self.columns = columns
+        self.dtype = np.dtype([("c%d" % n, typ)
+                               for n, (key, typ) in enumerate(columns)])
+
+    def _init_columns(self, output):
+        stat2_inverse = self.stat2_info[1]
+        keys = sorted(stat2_inverse.keys(), key=lambda k: stat2_inverse[k])
+        self._set_columns([(k, _get_stat3_column_type(
+                                    [output[stat2_inverse[k]]],
+                                    self.string_width)) for k in keys])
+        return self.get_header()
+
+    def get_header(self):
+        """Get the file header for the current column types"""
+        return _get_stat3_header(self.header, self.columns)
+
+    def update_columns(self, output):
+        """Widen any columns that cannot hold the values of a frame.
+           @return None if the columns were unchanged, otherwise the
+                   previous row type (the frames already written must
+                   then be converted to the new one)"""
+        if self.dtype is None:
+            return None
+        columns = list(self.columns)
+        for n, (key, typ) in enumerate(columns):
+            if not _get_stat3_value_fits(output[n], typ):
+                columns[n] = (key, _get_stat3_wider_column_type(
+                                         output[n], typ, self.string_width))
+        if columns == self.columns:
+            return None
+        old_dtype = self.dtype
+        self._set_columns(columns)
+        return old_dtype
+
+    def get_bytes(self, output):
+        """Get the bytes to append to the file for a single frame, given
+           a dict keyed by column index. The header is included
+           the first time this is called."""
+        data = b""
+        if self.dtype is None:
+            data = self._init_columns(output)
+        row = np.zeros(1, dtype=self.dtype)
+        for n in range(len(self.dtype.names)):
+            field = "c%d" % n
+            row[field] = _get_stat3_value(output[n], self.dtype[field])
+        return data + row.tobytes()
+
+
+def convert_stat2_to_stat3(stat2_file, stat3_file):
+    """Convert a text stat2 file into a binary stat3 file.
+       The whole file is read first to determine the type (and, for
+       strings, the width) of each column.
+    """
+    po = ProcessOutput(stat2_file)
+    if not po.isstat2:
+        raise ValueError("%s is not a stat2 file" % stat2_file)
+    with open(stat2_file) as fh:
+        header = ast.literal_eval(fh.readline())
+    header = dict(("STAT3" + k[5:], v) for k, v in header.items()
+                  if isinstance(k, str) and k.startswith("STAT2HEADER_"))
+    keys = po.get_keys()
+    fields = po.get_fields(keys)
+    columns = [(k, _get_stat3_column_type(fields[k])) for k in keys]
+    with open(stat3_file, 'wb') as fh:
+        fh.write(_get_stat3_header(header, columns))
+        nframes = min(len(fields[k]) for k in keys) if keys else 0
+        rows = np.zeros(nframes, dtype=[("c%d" % n, typ)
+                                        for n, (k, typ) in enumerate(columns)])
+        for n, (k, typ) in enumerate(columns):
+            rows["c%d" % n] = [_get_stat3_value(v, typ)
+                               for v in fields[k][:nframes]]
+        fh.write(rows.tobytes())
+
+
+class _StatFileIndex(object):
+    """Index of the byte offset of each line in a text stat file.
+       Only complete lines (terminated by a newline) are indexed, so a
+       file that is still being written can be indexed safely; call
+       update() to index any lines added since.
+       If `index_file_name` is given, the index is saved there and
+       reloaded (and extended if the stat file has grown) next time.
+       The index is rebuilt if the stat file was replaced or rewritten
+       since it was indexed.
+    """
+    # The index file is a flat array of little-endian 64-bit integers:
+    # the format version (as a negative number), the number of bytes of
+    # the stat file that were indexed, the inode and modification time
+    # (in ns) of the stat file and a checksum of the end of the indexed
+    # bytes when it was indexed, followed by the offset of each line
+    _format_version = -2
+    _header_size = 5
+    _chunk_size = 1 << 22
+    # number of bytes at the end of the indexed part that are checksummed
+    _tail_size = 1 << 16
+
+    def __init__(self, filename, index_file_name=None):
+        self.filename = filename
+        self.index_file_name = index_file_name
+        self._reset()
+        if index_file_name is not None and os.path.exists(index_file_name):
+            data = np.fromfile(index_file_name, dtype='<i8')
+            if len(data) >= self._header_size \
+               and data[0] == self._format_version:
+                self.indexed_size = int(data[1])
+                self._file_id = tuple(int(x) for x in data[2:5])
+                self.offsets = data[self._header_size:]
+        self.update()
+
+    def _reset(self):
+        self.offsets = np.zeros(0, dtype='<i8')
+        self.indexed_size = 0
+        # (inode, modification time, checksum) of the indexed stat file
+        self._file_id = None
+
+    def _get_file_id(self, stat, size):
+        mtime = getattr(stat, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(stat.st_mtime * 1e9)
+        with open(self.filename, 'rb') as fh:
+            start = max(0, size - self._tail_size)
+            fh.seek(start)
+            tail = fh.read(size - start)
+        return (int(stat.st_ino), mtime, zlib.crc32(tail) & 0xffffffff)
+
+    def _is_valid(self, stat):
+        """Return True iff the index still matches the stat file"""
+        if self.indexed_size == 0:
+            return True
+        if self._file_id is None or stat.st_size < self.indexed_size \
+           or int(stat.st_ino) != self._file_id[0]:
+            return False
+        mtime = getattr(stat, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(stat.st_mtime * 1e9)
+        if mtime == self._file_id[1] and stat.st_size == self.indexed_size:
+            return True
+        # the file was changed; it is still valid if lines were only
+        # added to the end
+        if self._get_file_id(stat, self.indexed_size)[2] != self._file_id[2]:
+            return False
+        with open(self.filename, 'rb') as fh:
+            # each indexed line must start right after a newline
+            for offset in (self.offsets[-1], self.indexed_size):
+                if offset > 0:
+                    fh.seek(offset - 1)
+                    if fh.read(1) != b'\n':
+                        return False
+        return True
+
+    def update(self):
+        """Index any complete lines added to the stat file"""
+        stat = os.stat(self.filename)
+        size = stat.st_size
+        if not self._is_valid(stat):
+            # the file was truncated or rewritten; start again
+            self._reset()
+        if size == self.indexed_size:
+            return
+        new_offsets = []
+        start = self.indexed_size
+        with open(self.filename, 'rb') as fh:
+            fh.seek(start)
+            pos = start
+            while True:
+                chunk = fh.read(self._chunk_size)
+                if not chunk:
+                    break
+                newlines = np.flatnonzero(
+                        np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+                if len(newlines) > 0:
+                    # each newline starts a line at the next byte
+                    new_offsets.append(np.concatenate(
+                        ([start], pos + newlines[:-1] + 1)).astype('<i8'))
+                    start = pos + int(newlines[-1]) + 1
+                pos += len(chunk)
+        if new_offsets:
+            self.offsets = np.concatenate([self.offsets] + new_offsets)
+            self.indexed_size = start
+            self._file_id = self._get_file_id(stat, start)
+            self._save()
+
+    def _save(self):
+        if self.index_file_name is None:
+            return
+        try:
+            np.concatenate(([self._format_version, self.indexed_size]
+                            + list(self._file_id),
+                            self.offsets)).astype('<i8').tofile(
+                                                  self.index_file_name)
+        except (IOError, OSError):
+            # the index is only an optimization, so if it can't be
+            # written (e.g. read-only directory) just keep it in memory
+            pass
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get_lines(self, indexes):
+        """Get the text of the lines with the given (0-based) indexes"""
+        lines = []
+        with open(self.filename, 'rb') as fh:
+            for i in indexes:
+                fh.seek(self.offsets[i])
+                lines.append(fh.readline().decode('utf-8'))
+        return lines
+
 
 class OutputStatistics(object):
     """Collect statistics from ProcessOutput.get_fields().
@@ -772,10 +1490,20 @@ class OutputStatistics(object):
 
 class ProcessOutput(object):
     """A class for reading stat files (either rmf or ascii v1 and v2)"""
-    def __init__(self, filename):
+    def __init__(self, filename, use_index_file=False):
+        """Constructor.
+           @param filename The stat file to read (rmf or ascii)
+           @param use_index_file For ascii stat files, save the index of
+                  frame positions in the file to a sidecar file
+                  (filename + ".idx") so that it does not need to be
+                  rebuilt next time the file is read
+        """
         self.filename = filename
+        self.use_index_file = use_index_file
+        self._index = None
         self.isstat1 = False
         self.isstat2 = False
+        self.isstat3 = False
         self.isrmf = False
 
         if self.filename is None:
@@ -791,6 +1519,17 @@ class ProcessOutput(object):
             del rh
 
         except IOError:
+            with open(self.filename, "rb") as fh:
+                self.isstat3 = fh.read(len(_STAT3_MAGIC)) == _STAT3_MAGIC
+            if self.isstat3:
+                with open(self.filename, "rb") as fh:
+                    (header, self.stat3_dtype,
+                     self.stat3_offset) = _read_stat3_header(fh)
+                self.klist = [header[k][0] for k in sorted(
+                              k for k in header if isinstance(k, int))]
+                self.invstat3_dict = dict((k, "c%d" % n)
+                                          for n, k in enumerate(self.klist))
+                return
             f = open(self.filename, "r")
             # try with an ascii stat file
             # get the keys from the first line
@@ -832,6 +1571,94 @@ class ProcessOutput(object):
     def show_keys(self, ncolumns=2, truncate=65):
         IMP.pmi.tools.print_multicolumn(self.get_keys(), ncolumns, truncate)
 
+    def _get_stat3_rows(self):
+        """Map the rows of a stat3 file into memory.
+           Any incomplete row at the end of the file (e.g. one being
+           written while we read) is ignored."""
+        size = os.path.getsize(self.filename) - self.stat3_offset
+        nrows = size // self.stat3_dtype.itemsize
+        if nrows == 0:
+            return np.zeros(0, dtype=self.stat3_dtype)
+        return np.memmap(self.filename, dtype=self.stat3_dtype, mode='r',
+                         offset=self.stat3_offset, shape=(nrows,))
+
+    def get_index(self):
+        """Get the index of line positions in an ascii stat file.
+           The index is built on first use, and extended with any
+           frames added to the file since."""
+        if self._index is None:
+            self._index = _StatFileIndex(
+                   self.filename,
+                   self.filename + ".idx" if self.use_index_file else None)
+        else:
+            self._index.update()
+        return self._index
+
+    def get_number_of_frames(self):
+        """Get the number of frames in the file"""
+        if self.isrmf:
+            rh = RMF.open_rmf_file_read_only(self.filename)
+            return rh.get_number_of_frames()
+        elif self.isstat3:
+            return len(self._get_stat3_rows())
+        elif self.isstat2:
+            return max(len(self.get_index()) - 1, 0)
+        else:
+            return len(self.get_index())
+
+    def get_frames(self, frames, fields=None):
+        """Get the values of fields for only the given frames.
+           For ascii files, only the requested lines are read and parsed.
+           @param frames A list of (0-based) frame indexes, or a slice
+                  (e.g. slice(-10, None) for the last ten frames, or
+                  slice(None, None, 100) for every 100th frame)
+           @param fields The keys to get (default: all keys)
+           @return a dictionary with the same format as get_fields()
+        """
+        if fields is None:
+            fields = self.get_keys()
+        if isinstance(frames, slice):
+            frames = range(self.get_number_of_frames())[frames]
+        outdict = dict((field, []) for field in fields)
+        if self.isrmf:
+            rh = RMF.open_rmf_file_read_only(self.filename)
+            for i in frames:
+                IMP.rmf.load_frame(rh, RMF.FrameID(i))
+                for field in fields:
+                    outdict[field].append(rh.get_root_node().get_value(
+                                               self.rmf_names_keys[field]))
+        elif self.isstat3:
+            rows = self._get_stat3_rows()[list(frames)]
+            for field in fields:
+                col = rows[self.invstat3_dict[field]]
+                if col.dtype.char == 'S':
+                    col = np.char.decode(col, 'utf-8')
+                outdict[field] = col.tolist()
+        else:
+            first = 1 if self.isstat2 else 0
+            for line in self.get_index().get_lines([i + first
+                                                    for i in frames]):
+                d = ast.literal_eval(line)
+                for field in fields:
+                    if self.isstat2:
+                        outdict[field].append(d[self.invstat2_dict[field]])
+                    else:
+                        outdict[field].append(d[field])
+        return outdict
+
+    def get_column(self, field):
+        """Get all values of a single field as a NumPy array.
+           This is only supported for binary stat3 files, and reads only
+           the requested column from disk."""
+        if not self.isstat3:
+            raise TypeError("ProcessOutput.get_column: only supported "
+                            "for stat3 files")
+        col = self._get_stat3_rows()[self.invstat3_dict[field]]
+        if col.dtype.char == 'S':
+            return np.char.decode(col, 'utf-8')
+        else:
+            return np.array(col)
+
     def get_fields(self, fields, filtertuple=None, filterout=None, get_every=1,
                    statistics=None):
         '''
@@ -879,6 +1706,14 @@ class ProcessOutput(object):
                 for field in fields:
                     outdict[field].append(rh.get_root_node().get_value(self.rmf_names_keys[field]))
 
+        elif self.isstat3:
+            self._get_stat3_fields(outdict, fields, filtertuple, filterout,
+                                   get_every, statistics)
+
+        elif filterout is None and get_every > 1:
+            self._get_indexed_fields(outdict, fields, filtertuple, get_every,
+                                     statistics)
+
         else:
             f = open(self.filename, "r")
             line_number = 0
@@ -905,39 +1740,194 @@ class ProcessOutput(object):
                     print("# Warning: skipped line number " + str(line_number) + " not a valid line")
                     continue
 
-                if self.isstat1:
-
-                    if not filtertuple is None:
-                        keytobefiltered = filtertuple[0]
-                        relationship = filtertuple[1]
-                        value = filtertuple[2]
-                        datavalue=d[keytobefiltered]
-                        if self.isfiltered(datavalue, relationship, value): continue
-
-                    statistics.passed_filtertuple += 1
-                    [outdict[field].append(d[field]) for field in fields]
-
-                elif self.isstat2:
-                    if line_number == 1:
-                        statistics.total -= 1
-                        statistics.passed_filterout -= 1
-                        statistics.passed_get_every -= 1
-                        continue
-
-                    if not filtertuple is None:
-                        keytobefiltered = filtertuple[0]
-                        relationship = filtertuple[1]
-                        value = filtertuple[2]
-                        datavalue=d[self.invstat2_dict[keytobefiltered]]
-                        if self.isfiltered(datavalue, relationship, value): continue
-
-                    statistics.passed_filtertuple += 1
-                    [outdict[field].append(d[self.invstat2_dict[field]]) for field in fields]
+                if self.isstat2 and line_number == 1:
+                    statistics.total -= 1
+                    statistics.passed_filterout -= 1
+                    statistics.passed_get_every -= 1
+                    continue
+                self._add_parsed_frame(d, outdict, fields, filtertuple,
+                                       statistics)
 
             f.close()
 
         return outdict
 
+    def get_best_fields(self, fields, score_key, number_of_frames,
+                        score_threshold=None, get_every=1, statistics=None):
+        """Get the desired fields for only the best scoring frames.
+           Only the score is read for every frame; a bounded heap keeps
+           the best number_of_frames of them, and the other fields are
+           then read for those frames alone, so memory use does not
+           depend on the length of the file.
+           @param fields (list of strings) queried keys in the stat file
+           @param score_key the key used for the ranking (lower is better)
+           @param number_of_frames the number of frames to keep
+           @param score_threshold if given, only consider frames with
+                  score below this value (as for filtertuple in
+                  get_fields())
+           @param get_every only consider every Nth line of the file
+           @param statistics if provided, accumulate statistics in an
+                  OutputStatistics object, with the same counts as
+                  get_fields() would give
+           @return a dictionary with the same format as get_fields(),
+                   with frames sorted by score (ties are broken by
+                   frame order)
+        """
+        if statistics is None:
+            statistics = OutputStatistics()
+        if self.isstat3:
+            frames = self._get_best_stat3_frames(score_key, number_of_frames,
+                                                 score_threshold, get_every,
+                                                 statistics)
+        else:
+            # max-heap (via negated keys) of the best frames seen so far
+            heap = []
+            for frame, score in self._get_scores(score_key, get_every,
+                                                 statistics):
+                if (score_threshold is not None
+                    and self.isfiltered(score, "<", score_threshold)):
+                    continue
+                statistics.passed_filtertuple += 1
+                item = (-float(score), -frame)
+                if len(heap) < number_of_frames:
+                    heapq.heappush(heap, item)
+                elif number_of_frames > 0 and item > heap[0]:
+                    heapq.heapreplace(heap, item)
+            frames = [-frame for score, frame in sorted(heap, reverse=True)]
+        return self.get_frames(frames, fields)
+
+    def _get_scores(self, score_key, get_every, statistics):
+        """Yield (frame index, score) for every frame of an rmf or ascii
+           file that passes get_every, one at a time"""
+        if self.isrmf:
+            rh = RMF.open_rmf_file_read_only(self.filename)
+            key = self.rmf_names_keys[score_key]
+            for i in range(rh.get_number_of_frames()):
+                statistics.total += 1
+                # "get_every" not enforced for RMF
+                statistics.passed_get_every += 1
+                statistics.passed_filterout += 1
+                IMP.rmf.load_frame(rh, RMF.FrameID(i))
+                yield i, rh.get_root_node().get_value(key)
+            return
+        if self.isstat2:
+            key = self.invstat2_dict[score_key]
+        else:
+            key = score_key
+        with open(self.filename, "r") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.endswith("\n"):
+                    # incomplete line at the end of the file; skip it, as
+                    # the line index used by get_frames() does
+                    break
+                if self.isstat2 and line_number == 1:
+                    continue
+                statistics.total += 1
+                statistics.passed_filterout += 1
+                if line_number % get_every != 0:
+                    continue
+                statistics.passed_get_every += 1
+                try:
+                    d = ast.literal_eval(line)
+                except:
+                    print("# Warning: skipped line number " + str(line_number) + " not a valid line")
+                    continue
+                frame = line_number - 2 if self.isstat2 else line_number - 1
+                yield frame, d[key]
+
+    def _get_best_stat3_frames(self, score_key, number_of_frames,
+                               score_threshold, get_every, statistics):
+        nrows = len(self._get_stat3_rows())
+        statistics.total += nrows
+        statistics.passed_filterout += nrows
+        mask = (np.arange(nrows) + 2) % get_every == 0
+        statistics.passed_get_every += int(np.count_nonzero(mask))
+        scores = self.get_column(score_key).astype(float)
+        if score_threshold is not None:
+            mask &= scores < score_threshold
+        statistics.passed_filtertuple += int(np.count_nonzero(mask))
+        frames = np.flatnonzero(mask)
+        # stable sort, so that ties are broken by frame order
+        order = np.argsort(scores[frames], kind='mergesort')
+        return frames[order[:number_of_frames]].tolist()
+
+    def _add_parsed_frame(self, d, outdict, fields, filtertuple, statistics):
+        """Add the fields of a parsed ascii frame to outdict, if it
+           passes the filter"""
+        if self.isstat2:
+            keymap = self.invstat2_dict
+        else:
+            keymap = dict((field, field) for field in fields)
+            if filtertuple is not None:
+                keymap[filtertuple[0]] = filtertuple[0]
+        if not filtertuple is None:
+            keytobefiltered = filtertuple[0]
+            relationship = filtertuple[1]
+            value = filtertuple[2]
+            datavalue=d[keymap[keytobefiltered]]
+            if self.isfiltered(datavalue, relationship, value):
+                return
+
+        statistics.passed_filtertuple += 1
+        for field in fields:
+            outdict[field].append(d[keymap[field]])
+
+    def _get_indexed_fields(self, outdict, fields, filtertuple, get_every,
+                            statistics):
+        """Read only every get_every-th line of an ascii file, using the
+           line index to skip the others without reading them"""
+        index = self.get_index()
+        nlines = len(index)
+        ndata = nlines - 1 if self.isstat2 else nlines
+        statistics.total += max(ndata, 0)
+        statistics.passed_filterout += max(ndata, 0)
+        # line numbers (counting from 1, and including any stat2 header)
+        # that pass get_every, as in the non-indexed reader
+        line_numbers = range(get_every, nlines + 1, get_every)
+        for line_number, line in zip(line_numbers, index.get_lines(
+                                     [n - 1 for n in line_numbers])):
+            statistics.passed_get_every += 1
+            try:
+                d = ast.literal_eval(line)
+            except:
+                print("# Warning: skipped line number " + str(line_number) + " not a valid line")
+                continue
+            self._add_parsed_frame(d, outdict, fields, filtertuple,
+                                   statistics)
+
+    def _get_stat3_fields(self, outdict, fields, filtertuple, filterout,
+                          get_every, statistics):
+        rows = self._get_stat3_rows()
+        nrows = len(rows)
+        statistics.total += nrows
+        passed = np.ones(nrows, dtype=bool)
+        if filterout is not None:
+            # as for text files, skip frames containing filterout; only
+            # string values are searched, as numbers are not stored as text
+            search = filterout.encode('utf-8')
+            for name in rows.dtype.names:
+                if rows.dtype[name].char == 'S':
+                    passed &= np.char.find(rows[name], search) < 0
+        passed = np.flatnonzero(passed)
+        statistics.passed_filterout += len(passed)
+        # select the same frames as the stat2 reader, which counts the
+        # header as the first line
+        mask = np.zeros(nrows, dtype=bool)
+        mask[passed[(np.arange(len(passed)) + 2) % get_every == 0]] = True
+        statistics.passed_get_every += int(np.count_nonzero(mask))
+        if filtertuple is not None:
+            keytobefiltered, relationship, value = filtertuple
+            col = self.get_column(keytobefiltered).astype(float)
+            if relationship == "<":
+                mask &= col < value
+            elif relationship == ">":
+                mask &= col > value
+            elif relationship == "==":
+                mask &= col == value
+        statistics.passed_filtertuple += int(np.count_nonzero(mask))
+        for field in fields:
+            outdict[field] = self.get_column(field)[mask].tolist()
+
     def isfiltered(self,datavalue,relationship,refvalue):
         dofilter=False
         try:
@@ -1023,59 +2013,192 @@ class RMFHierarchyHandler(IMP.atom.Hierarchy):
             for nframe in list(range(len(self)))[slice_key]:
                 yield self[nframe]
 
+def _get_model_table(model, internal=False):
+    """Get a writable NumPy view of the coordinates (or, if internal is
+       True, the internal coordinates) of all particles in the model,
+       indexed by particle index, or None if IMP was built without NumPy"""
+    try:
+        if internal:
+            return model.get_internal_coordinates_numpy()
+        else:
+            return model.get_spheres_numpy()
+    except (AttributeError, NotImplementedError):
+        return None
+
+
 class CacheHierarchyCoordinates(object):
-    def __init__(self,StatHierarchyHandler):
-        self.xyzs=[]
-        self.nrms=[]
-        self.rbs=[]
-        self.nrm_coors={}
-        self.xyz_coors={}
-        self.rb_trans={}
+    """Cache the coordinates of frames visited by a StatHierarchyHandler.
+
+       Each frame is stored as a single packed NumPy block holding the
+       rigid body quaternions and translations, the internal coordinates
+       of nonrigid members, and the coordinates of all other particles,
+       so that a frame is stored and restored in bulk. When the cache
+       grows beyond max_bytes, the least recently used frames are dropped
+       (and read again from the RMF file when needed) or, if file_name is
+       given, moved to a memory-mapped file on disk.
+    """
+    def __init__(self, StatHierarchyHandler, max_bytes=2**30,
+                 file_name=None):
+        """
+        @param StatHierarchyHandler the handler whose frames are cached
+        @param max_bytes the most memory to use for cached frames
+        @param file_name if given, frames that do not fit in memory are
+               stored in this file
+        """
         self.current_index=None
         self.rmfh=StatHierarchyHandler
+        self.max_bytes=max_bytes
+        self.file_name=file_name
         rbs,xyzs=IMP.pmi.tools.get_rbs_and_beads([self.rmfh])
         self.model=self.rmfh.get_model()
         self.rbs=rbs
+        self.nrms=[]
+        self.xyzs=[]
         for xyz in xyzs:
             if IMP.core.NonRigidMember.get_is_setup(xyz):
-                nrm=IMP.core.NonRigidMember(xyz)
-                self.nrms.append(nrm)
+                self.nrms.append(IMP.core.NonRigidMember(xyz))
             else:
-                fb=IMP.core.XYZ(xyz)
-                self.xyzs.append(fb)
+                self.xyzs.append(IMP.core.XYZ(xyz))
+        self._nrm_indexes=np.array([p.get_particle_index().get_index()
+                                    for p in self.nrms], dtype=int)
+        self._xyz_indexes=np.array([p.get_particle_index().get_index()
+                                    for p in self.xyzs], dtype=int)
+        # layout of each block: 7 values (quaternion, translation) per
+        # rigid body, then 3 per nonrigid member and 3 per free particle
+        self._nrm_start=7*len(self.rbs)
+        self._xyz_start=self._nrm_start+3*len(self.nrms)
+        self._block_size=self._xyz_start+3*len(self.xyzs)
+        # the memory used by each cached frame
+        self.frame_bytes=self._block_size*8
+        self._frames=collections.OrderedDict()
+        self._spill_slots={}
+        self._spill=None
+
+    def _get_block(self):
+        block=np.empty(self._block_size)
+        rbdata=block[:self._nrm_start].reshape(-1, 7)
+        for n,rb in enumerate(self.rbs):
+            tr=rb.get_reference_frame().get_transformation_to()
+            rbdata[n,:4]=tr.get_rotation().get_quaternion()
+            rbdata[n,4:]=tr.get_translation()
+        nrmdata=block[self._nrm_start:self._xyz_start].reshape(-1, 3)
+        table=_get_model_table(self.model, internal=True)
+        if table is not None:
+            nrmdata[:]=table[self._nrm_indexes,:3]
+        else:
+            for n,nrm in enumerate(self.nrms):
+                nrmdata[n]=nrm.get_internal_coordinates()
+        xyzdata=block[self._xyz_start:].reshape(-1, 3)
+        table=_get_model_table(self.model)
+        if table is not None:
+            xyzdata[:]=table[self._xyz_indexes,:3]
+        else:
+            for n,xyz in enumerate(self.xyzs):
+                xyzdata[n]=xyz.get_coordinates()
+        return block
+
+    def _set_block(self, block):
+        rbdata=block[:self._nrm_start].reshape(-1, 7)
+        for rb,d in zip(self.rbs, rbdata):
+            tr=IMP.algebra.Transformation3D(
+                   IMP.algebra.Rotation3D(IMP.algebra.Vector4D(*d[:4])),
+                   IMP.algebra.Vector3D(*d[4:]))
+            rb.set_reference_frame(IMP.algebra.ReferenceFrame3D(tr))
+        nrmdata=block[self._nrm_start:self._xyz_start].reshape(-1, 3)
+        table=_get_model_table(self.model, internal=True)
+        if table is not None:
+            table[self._nrm_indexes,:3]=nrmdata
+        else:
+            for nrm,d in zip(self.nrms, nrmdata):
+                nrm.set_internal_coordinates(IMP.algebra.Vector3D(*d))
+        xyzdata=block[self._xyz_start:].reshape(-1, 3)
+        table=_get_model_table(self.model)
+        if table is not None:
+            table[self._xyz_indexes,:3]=xyzdata
+        else:
+            for xyz,d in zip(self.xyzs, xyzdata):
+                xyz.set_coordinates(IMP.algebra.Vector3D(*d))
+
+    def _get_memory_used(self):
+        return len(self._frames)*self.frame_bytes
+
+    def _add_frame(self, index, block):
+        """Add a frame to the in-memory cache, evicting others if needed"""
+        self._frames[index]=block
+        while len(self._frames)>1 and self._get_memory_used()>self.max_bytes:
+            old_index,old_block=self._frames.popitem(last=False)
+            if self.file_name is not None:
+                self._spill_frame(old_index, old_block)
+
+    def _spill_frame(self, index, block):
+        """Write a frame to the memory-mapped file"""
+        if self._block_size==0:
+            return
+        slot=self._spill_slots.get(index)
+        if slot is None:
+            slot=len(self._spill_slots)
+            if self._spill is None or slot>=len(self._spill):
+                self._grow_spill_file(max(16, 2*slot))
+            self._spill_slots[index]=slot
+        self._spill[slot]=block
+
+    def _grow_spill_file(self, nframes):
+        if self._spill is None:
+            mode='w+'
+        else:
+            self._spill.flush()
+            self._spill=None
+            with open(self.file_name, 'r+b') as fh:
+                fh.truncate(nframes*self.frame_bytes)
+            mode='r+'
+        self._spill=np.memmap(self.file_name, dtype=np.float64, mode=mode,
+                              shape=(nframes, self._block_size))
+
+    def _get_frame(self, index):
+        """Get the block for a frame, or None if it is not cached"""
+        block=self._frames.get(index)
+        if block is not None:
+            # mark as most recently used
+            del self._frames[index]
+            self._frames[index]=block
+            return block
+        slot=self._spill_slots.get(index)
+        if slot is not None:
+            block=np.array(self._spill[slot])
+            self._add_frame(index, block)
+            return block
 
     def do_store(self,index):
-        self.rb_trans[index]={}
-        self.nrm_coors[index]={}
-        self.xyz_coors[index]={}
-        for rb in self.rbs:
-            self.rb_trans[index][rb]=rb.get_reference_frame()
-        for nrm in self.nrms:
-            self.nrm_coors[index][nrm]=nrm.get_internal_coordinates()
-        for xyz in self.xyzs:
-            self.xyz_coors[index][xyz]=xyz.get_coordinates()
+        self._frames.pop(index, None)
+        self._add_frame(index, self._get_block())
+        if index in self._spill_slots:
+            self._spill[self._spill_slots[index]]=self._frames[index]
         self.current_index=index
 
     def do_update(self,index):
         if self.current_index!=index:
-            for rb in self.rbs:
-                rb.set_reference_frame(self.rb_trans[index][rb])
-            for nrm in self.nrms:
-                nrm.set_internal_coordinates(self.nrm_coors[index][nrm])
-            for xyz in self.xyzs:
-                xyz.set_coordinates(self.xyz_coors[index][xyz])
+            self._set_block(self._get_frame(index))
             self.current_index=index
             self.model.update()
 
+    def do_touch(self,index):
+        """Mark a frame as recently used, so that it is not evicted
+           before frames that were used less recently"""
+        self._get_frame(index)
+
+    def get_capacity(self):
+        """Get the number of frames that can be cached without dropping
+           any, or None if there is no limit"""
+        if self.file_name is not None:
+            return None
+        return max(1, self.max_bytes//max(1, self.frame_bytes))
+
     def get_number_of_frames(self):
-        return len(self.rb_trans.keys())
+        return len(set(self._frames.keys()) | set(self._spill_slots.keys()))
 
     def __getitem__(self,index):
         if type(index) is int:
-            if index in self.rb_trans.keys():
-                return True
-            else:
-                return False
+            return index in self._frames or index in self._spill_slots
         else:
             raise TypeError("Unknown Type")
 
@@ -1083,11 +2206,10 @@ class CacheHierarchyCoordinates(object):
         return self.get_number_of_frames()
 
 
-
-
 class StatHierarchyHandler(RMFHierarchyHandler):
     """ class to link stat files to several rmf files """
-    def __init__(self,model=None,stat_file=None,number_best_scoring_models=None,score_key=None,StatHierarchyHandler=None,cache=None):
+    def __init__(self,model=None,stat_file=None,number_best_scoring_models=None,score_key=None,StatHierarchyHandler=None,cache=None,
+                 cache_max_bytes=None,cache_file_name=None):
         """
 
         @param model: IMP.Model()
@@ -1095,7 +2217,14 @@ class StatHierarchyHandler(RMFHierarchyHandler):
             stat file name as key and a list of frames as values
         @param number_best_scoring_models:
         @param StatHierarchyHandler: copy constructor input object
-        @param cache: cache coordinates and rigid body transformations.
+        @param cache: cache coordinates and rigid body transformations
+               (see CacheHierarchyCoordinates).
+        @param cache_max_bytes: the most memory to use for cached frames
+               (by default 1 GiB, or the same as the copied handler)
+        @param cache_file_name: if given, frames that do not fit in
+               memory are stored in this file. A copy of a handler that
+               uses a file stores its frames in the same file name plus
+               ".copy", unless another file name is given.
         """
 
         if not StatHierarchyHandler is None:
@@ -1110,12 +2239,16 @@ class StatHierarchyHandler(RMFHierarchyHandler):
             self.current_index=None
             self.score_threshold=StatHierarchyHandler.score_threshold
             self.score_key=StatHierarchyHandler.score_key
-            self.cache=StatHierarchyHandler.cache
+            self.cache=StatHierarchyHandler.cache is not None
+            if cache_max_bytes is None:
+                cache_max_bytes=StatHierarchyHandler.cache_max_bytes
+            if (cache_file_name is None
+                    and StatHierarchyHandler.cache_file_name is not None):
+                cache_file_name=StatHierarchyHandler.cache_file_name+".copy"
+            self.cache_max_bytes=cache_max_bytes
+            self.cache_file_name=cache_file_name
             RMFHierarchyHandler.__init__(self, self.model,self.current_rmf)
-            if self.cache:
-                self.cache=CacheHierarchyCoordinates(self)
-            else:
-                self.cache=None
+            self.cache=self._create_cache()
             self.set_frame(0)
 
         else:
@@ -1124,6 +2257,10 @@ class StatHierarchyHandler(RMFHierarchyHandler):
             self.data=[]
             self.number_best_scoring_models=number_best_scoring_models
             self.cache=cache
+            if cache_max_bytes is None:
+                cache_max_bytes=2**30
+            self.cache_max_bytes=cache_max_bytes
+            self.cache_file_name=cache_file_name
 
             if score_key is None:
                 self.score_key="Total_Score"
@@ -1192,15 +2329,20 @@ class StatHierarchyHandler(RMFHierarchyHandler):
 
         if not self.is_setup:
             RMFHierarchyHandler.__init__(self, self.model,self.get_rmf_names()[0])
-            if self.cache:
-                self.cache=CacheHierarchyCoordinates(self)
-            else:
-                self.cache=None
+            self.cache=self._create_cache()
             self.is_setup=True
             self.current_rmf=self.get_rmf_names()[0]
 
         self.set_frame(0)
 
+    def _create_cache(self):
+        """Make the coordinate cache, if caching was requested"""
+        if self.cache:
+            return CacheHierarchyCoordinates(self, self.cache_max_bytes,
+                                             self.cache_file_name)
+        else:
+            return None
+
     def save_data(self,filename='data.pkl'):
         try:
             import cPickle as pickle
@@ -1237,6 +2379,8 @@ class StatHierarchyHandler(RMFHierarchyHandler):
     def set_frame(self,index):
         if self.cache is not None and self.cache[index]:
             self.cache.do_update(index)
+            # the hierarchy no longer matches the last frame read from file
+            self.current_frame=-1
         else:
             nm=self.data[index].rmf_name
             fidx=self.data[index].rmf_index
@@ -1252,6 +2396,70 @@ class StatHierarchyHandler(RMFHierarchyHandler):
 
         self.current_index = index
 
+    def get_access_plan(self,indexes):
+        """Get the order in which to read the given frames from disk.
+           Frames that are already cached are skipped, and the rest are
+           grouped by RMF file (starting with the current one) and sorted
+           by frame, so that each file is linked once and read forwards.
+           @param indexes frame indexes, in any order (e.g. cluster.members)
+        """
+        todo=set(i for i in indexes if self.cache is None or not self.cache[i])
+        def key(i):
+            d=self.data[i]
+            return (d.rmf_name!=self.current_rmf, d.rmf_name, d.rmf_index)
+        return sorted(todo, key=key)
+
+    def prefetch(self,indexes):
+        """Read the given frames into the coordinate cache, in the order
+           given by get_access_plan(). The cache should be able to hold
+           all of them (see iter_frames() for a bounded version).
+           The hierarchy is left at the last frame read.
+        """
+        if self.cache is None:
+            raise ValueError("StatHierarchyHandler: prefetch needs cache=True")
+        # keep frames that are already cached from being evicted
+        for index in indexes:
+            self.cache.do_touch(index)
+        for index in self.get_access_plan(indexes):
+            self.set_frame(index)
+
+    def iter_frames(self,indexes,read_ahead=None):
+        """Iterate over the given frames, loading each in turn and yielding
+           (index, DataEntry) pairs. Frames are served in the order given, but if coordinates are
+           cached they are first read from disk read_ahead frames at a
+           time in the order given by get_access_plan(), so that RMF files
+           are not relinked every time indexes jumps between files (as
+           cluster members usually do).
+           @param indexes frame indexes, e.g. cluster.members
+           @param read_ahead the most distinct frames to read ahead;
+                  by default, as many as fit in the cache
+        """
+        indexes=list(indexes)
+        if self.cache is None:
+            for index in indexes:
+                self.set_frame(index)
+                yield index, self.data[index]
+            return
+        capacity=self.cache.get_capacity()
+        if read_ahead is None:
+            read_ahead=capacity
+        elif capacity is not None:
+            read_ahead=min(read_ahead,capacity)
+        start=0
+        while start<len(indexes):
+            window=set()
+            end=start
+            while end<len(indexes) and (read_ahead is None
+                                        or len(window)<read_ahead
+                                        or indexes[end] in window):
+                window.add(indexes[end])
+                end+=1
+            self.prefetch(window)
+            for index in indexes[start:end]:
+                self.set_frame(index)
+                yield index, self.data[index]
+            start=end
+
     def __getitem__(self,int_slice_adaptor):
         if type(int_slice_adaptor) is int:
             self.set_frame(int_slice_adaptor)
@@ -34,6 +34,11 @@ p.add_argument('--head', action="store_true", dest="print_header",
                help="print the fields contained in the file (only stat2)")
 p.add_argument('-n', action="store", dest="print_raw_number",
                help="print the selected raw")
+p.add_argument('--index', action="store_true", dest="use_index_file",
+               default=False,
+               help="With -n, save the position of each line to a file "
+                    "named after the input file with a .idx extension, so "
+                    "that later lookups in the same file are faster")
 p.add_argument('--soft', action="store_true", dest="soft_match", default=False,
                help="Soft match. Closest matching field will be printed, "
                     "e.g. S will give Step_Number, En will give energy, etc. ")
@@ -207,29 +212,17 @@ if (not result.search_field is None) and (not result.search_value is None):
     f.close()
 
 if not result.print_raw_number is None:
-    # check whether the fields exist and convert them to best maching existing
-    # field names
-    f = open(result.filename, "r")
-    line_number = 0
-    for line in f.readlines():
-        line_number += 1
-        if isstat1:
-            if (line_number == int(result.print_raw_number)):
-                try:
-                    d = eval(line)
-                except:
-                    print("# Warning: skipped line number " + str(line_number) + " not a valid line")
-                    break
-                for key in klist:
-                    print(key, d[key])
-
-        elif isstat2:
-            if (line_number == int(result.print_raw_number) + 1):
-                try:
-                    d = eval(line)
-                except:
-                    print("# Warning: skipped line number " + str(line_number) + " not a valid line")
-                    break
-                for key in klist:
-                    print(key, d[invstat2_dict[key]])
-    f.close()
+    # use the line index (optionally saved) to jump straight to the
+    # requested frame, rather than reading the file from the start
+    import IMP.pmi.output
+    po = IMP.pmi.output.ProcessOutput(result.filename,
+                                      use_index_file=result.use_index_file)
+    nframe = int(result.print_raw_number) - 1
+    if 0 <= nframe < po.get_number_of_frames():
+        try:
+            frame = po.get_frames([nframe], klist)
+        except (SyntaxError, ValueError):
+            print("# Warning: skipped line number " + str(result.print_raw_number) + " not a valid line")
+        else:
+            for key in klist:
+                print(key, frame[key][0])
@@ -103,6 +103,9 @@ class CrossLinkingMassSpectrometryRestraint(IMP.pmi.restraints.RestraintBase):
         self.sigma_dictionary={}
         self.xl_list=[]
         self.outputlevel = "low"
+        self.crosslink_output_every = 1
+        self._noutput = 0
+        self._xl_arrays = None
 
         restraints = []
 
@@ -112,6 +115,7 @@ class CrossLinkingMassSpectrometryRestraint(IMP.pmi.restraints.RestraintBase):
 
         # if PMI2, first add all the molecule copies as clones to the database
         if use_pmi2:
+            residue_index = IMP.pmi.tools.get_residue_particle_index(root_hier)
             copies_to_add = defaultdict(int)
             print('gathering copies')
             for xlid in self.CrossLinkDataBase.xlid_iterator():
@@ -123,11 +127,9 @@ class CrossLinkingMassSpectrometryRestraint(IMP.pmi.restraints.RestraintBase):
                     for c,r in ((c1,r1),(c2,r2)):
                         if c in copies_to_add:
                             continue
-                        sel = IMP.atom.Selection(root_hier,
-                                                 state_index=0,
-                                                 molecule=c,
-                                                 residue_index=r,
-                                                 resolution=resolution).get_selected_particles()
+                        sel = residue_index.get_particles(c, r,
+                                                 resolution=resolution,
+                                                 state_index=0)
                         if len(sel)>0:
                             copies_to_add[c] = len(sel)-1
             print(copies_to_add)
@@ -177,18 +179,14 @@ class CrossLinkingMassSpectrometryRestraint(IMP.pmi.restraints.RestraintBase):
                             name1,copy1 = c1.split('.')
                         if '.' in c2:
                             name2,copy2 = c2.split('.')
-                        ps1 = IMP.atom.Selection(root_hier,
+                        ps1 = residue_index.get_particles(name1, r1,
+                                                 resolution=resolution,
                                                  state_index=nstate,
-                                                 molecule=name1,
-                                                 copy_index=int(copy1),
-                                                 residue_index=r1,
-                                                 resolution=resolution).get_selected_particles()
-                        ps2 = IMP.atom.Selection(root_hier,
+                                                 copy_index=int(copy1))
+                        ps2 = residue_index.get_particles(name2, r2,
+                                                 resolution=resolution,
                                                  state_index=nstate,
-                                                 molecule=name2,
-                                                 copy_index=int(copy2),
-                                                 residue_index=r2,
-                                                 resolution=resolution).get_selected_particles()
+                                                 copy_index=int(copy2))
 
                         ps1 = [IMP.atom.Hierarchy(p) for p in ps1]
                         ps2 = [IMP.atom.Hierarchy(p) for p in ps2]
@@ -348,6 +346,43 @@ class CrossLinkingMassSpectrometryRestraint(IMP.pmi.restraints.RestraintBase):
         """ Set the output level of the output """
         self.outputlevel = level
 
+    def set_crosslink_output_every(self, nframes):
+        """ Only output per-crosslink scores and distances every
+        nframes calls to get_output(); in other frames they are output as
+        "None". The total score and nuisances are always output.
+        (Usually get_output() is called once per frame; see
+        IMP.pmi.output.Output.set_output_cache_key())"""
+        self.crosslink_output_every = nframes
+        self._noutput = 0
+
+    def _get_xl_arrays(self):
+        """Get the particle indexes of each cross-link, and the index of
+        its restraint in self.xl_restraints (computed only once)"""
+        if self._xl_arrays is None:
+            rindex = dict((id(r), n) for n, r in enumerate(self.xl_restraints))
+            p1s = [xl["Particle1"].get_particle_index() for xl in self.xl_list]
+            p2s = [xl["Particle2"].get_particle_index() for xl in self.xl_list]
+            rs = [rindex[id(xl["Restraint"])] for xl in self.xl_list]
+            self._xl_arrays = (p1s, p2s, rs)
+        return self._xl_arrays
+
+    def get_crosslink_distances_and_scores(self):
+        """ Get the distance and score of every cross-link in xl_list.
+        Coordinates are read in bulk, and each (possibly ambiguous)
+        restraint is evaluated only once.
+        @return a tuple of two NumPy arrays: the distance between the
+                particles of each cross-link, and -log(probability) of
+                the restraint the cross-link contributes to
+        """
+        import numpy as np
+        p1s, p2s, rs = self._get_xl_arrays()
+        rscores = np.array([-log(r.unprotected_evaluate(None))
+                            for r in self.xl_restraints])
+        xyz1 = IMP.pmi.tools.get_coordinates_array(self.model, p1s)
+        xyz2 = IMP.pmi.tools.get_coordinates_array(self.model, p2s)
+        dists = np.sqrt(np.sum((xyz1 - xyz2) ** 2, axis=1))
+        return dists, rscores[rs]
+
     def set_psi_is_sampled(self, is_sampled=True):
         """ Switch on/off the sampling of psi particles """
         self.psi_is_sampled = is_sampled
@@ -419,19 +454,20 @@ class CrossLinkingMassSpectrometryRestraint(IMP.pmi.restraints.RestraintBase):
         """ Get the output of the restraint to be used by the IMP.pmi.output object"""
         output = super(CrossLinkingMassSpectrometryRestraint, self).get_output()
 
-        for xl in self.xl_list:
+        if self._noutput % self.crosslink_output_every == 0:
+            dists, scores = self.get_crosslink_distances_and_scores()
+            dists = [str(x) for x in dists.tolist()]
+            scores = [str(x) for x in scores.tolist()]
+        else:
+            dists = scores = ["None"] * len(self.xl_list)
+        self._noutput += 1
 
+        for xl, dist, score in zip(self.xl_list, dists, scores):
             xl_label=xl["ShortLabel"]
-            ln = xl["Restraint"]
-            p0 = xl["Particle1"]
-            p1 = xl["Particle2"]
             output["CrossLinkingMassSpectrometryRestraint_Score_" +
-                   xl_label] = str(-log(ln.unprotected_evaluate(None)))
-
-            d0 = IMP.core.XYZ(p0)
-            d1 = IMP.core.XYZ(p1)
+                   xl_label] = score
             output["CrossLinkingMassSpectrometryRestraint_Distance_" +
-                   xl_label] = str(IMP.core.get_distance(d0, d1))
+                   xl_label] = dist
 
 
         for psiname in self.psi_dictionary:
@@ -603,6 +639,7 @@ class AtomicCrossLinkMSRestraint(IMP.pmi.restraints.RestraintBase):
 
         ### create all the XLs
         xlrs=[]
+        residue_index = IMP.pmi.tools.get_residue_particle_index(self.root)
         for xlid in self.xldb.xlid_iterator():
             # create restraint for this data point
             if one_psi:
@@ -617,7 +654,7 @@ class AtomicCrossLinkMSRestraint(IMP.pmi.restraints.RestraintBase):
             num_contributions=0
 
             # add a contribution for each XL ambiguity option within each state
-            for nstate in self.nstates:
+            for nstate in range(self.nstates):
                 for xl in self.xldb[xlid]:
                     r1 = xl[self.xldb.residue1_key]
                     c1 = xl[self.xldb.protein1_key].strip()
@@ -625,16 +662,12 @@ class AtomicCrossLinkMSRestraint(IMP.pmi.restraints.RestraintBase):
                     c2 = xl[self.xldb.protein2_key].strip()
 
                     # perform selection. these may contain multiples if Copies are used
-                    ps1 = IMP.atom.Selection(self.root,
+                    ps1 = residue_index.get_particles(c1, r1,
                                              state_index=nstate,
-                                             atom_type = IMP.atom.AtomType(self.atom_type),
-                                             molecule=c1,
-                                             residue_index=r1).get_selected_particles()
-                    ps2 = IMP.atom.Selection(self.root,
+                                             atom_type=self.atom_type)
+                    ps2 = residue_index.get_particles(c2, r2,
                                              state_index=nstate,
-                                             atom_type = IMP.atom.AtomType(self.atom_type),
-                                             molecule=c2,
-                                             residue_index=r2).get_selected_particles()
+                                             atom_type=self.atom_type)
                     if len(ps1) == 0:
                         print("AtomicXLRestraint: WARNING> residue %d of chain %s is not there" % (r1, c1))
                         if filelabel is not None:
@@ -1541,6 +1541,189 @@ def get_rbs_and_beads(hiers):
             beads.append(p)
     return rbs_ordered,beads
 
+def get_coordinates_array(model, particle_indexes):
+    """Get the coordinates of many particles as an (N,3) NumPy array.
+       @param model The IMP.Model containing the particles
+       @param particle_indexes List of IMP.ParticleIndex (or int) objects
+
+       The coordinates are read in bulk with IMP.Model.get_spheres_numpy()
+       if IMP was built with NumPy support; otherwise each particle is
+       read in turn.
+    """
+    import numpy as np
+    inds = [pi if isinstance(pi, int) else pi.get_index()
+            for pi in particle_indexes]
+    try:
+        spheres = model.get_spheres_numpy()
+    except (AttributeError, NotImplementedError):
+        spheres = None
+    if spheres is not None:
+        return np.array(spheres[inds, :3], dtype=float)
+    xyzs = np.empty((len(inds), 3))
+    for n, i in enumerate(inds):
+        xyzs[n] = IMP.core.XYZ(model, IMP.ParticleIndex(i)).get_coordinates()
+    return xyzs
+
+def get_best_assignment(cost):
+    """Solve the assignment problem, using the Hungarian algorithm.
+       @param cost square matrix (list of lists or NumPy array) where
+              cost[i][j] is the cost of assigning row i to column j
+       @return a list giving the column assigned to each row, such that
+               the total cost is as small as possible
+
+       This takes O(N^3) time, rather than the O(N!) needed to try
+       every permutation.
+    """
+    n = len(cost)
+    inf = float('inf')
+    # potentials for rows and columns; column 0 is a sentinel
+    u = [0.] * (n + 1)
+    v = [0.] * (n + 1)
+    # row assigned to each column (rows and columns are numbered from 1)
+    p = [0] * (n + 1)
+    way = [0] * (n + 1)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (n + 1)
+        used = [False] * (n + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            row = cost[i0 - 1]
+            delta = inf
+            j1 = 0
+            for j in range(1, n + 1):
+                if not used[j]:
+                    cur = row[j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(n + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        # follow the augmenting path back to the sentinel
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    assignment = [0] * n
+    for j in range(1, n + 1):
+        assignment[p[j] - 1] = j - 1
+    return assignment
+
+class ResidueParticleIndex(object):
+    """Look up the particles that represent given residues of a hierarchy.
+       This gives the same particles as
+       IMP.atom.Selection(hier, state_index=..., molecule=...,
+       copy_index=..., residue_index=..., resolution=...), but the
+       hierarchy is only walked once for each resolution, rather than
+       once for each query. It is intended for restraints that make many
+       residue selections, such as cross-link restraints.
+
+       Entries are keyed by (state, molecule, copy, residue) and hold
+       particle indexes; the state or copy is None for molecules outside
+       a State or without a Copy decorator.
+       @note The index is not updated if the hierarchy changes after
+             it is built.
+    """
+
+    def __init__(self, hier):
+        """Constructor.
+           @param hier The (usually PMI2 root) hierarchy to index
+        """
+        self.hier = hier
+        self.model = hier.get_model()
+        self._molecules = []
+        self._find_molecules(IMP.atom.Hierarchy(hier), None)
+        self._maps = {}
+
+    def _find_molecules(self, h, state):
+        if IMP.atom.State.get_is_setup(h):
+            state = IMP.atom.State(h).get_state_index()
+        if IMP.atom.Molecule.get_is_setup(h):
+            copy = None
+            if IMP.atom.Copy.get_is_setup(h):
+                copy = IMP.atom.Copy(h).get_copy_index()
+            self._molecules.append((state, h.get_name(), copy, h))
+            return
+        for child in h.get_children():
+            self._find_molecules(child, state)
+
+    def _get_map(self, resolution, atom_type):
+        key = (resolution, atom_type)
+        if key not in self._maps:
+            kwargs = {}
+            if resolution is not None:
+                kwargs['resolution'] = resolution
+            if atom_type is not None:
+                kwargs['atom_type'] = IMP.atom.AtomType(atom_type)
+            residue_map = defaultdict(list)
+            for state, name, copy, mol in self._molecules:
+                sel = IMP.atom.Selection(mol, **kwargs)
+                for p in sel.get_selected_particles():
+                    pi = p.get_index()
+                    for r in get_residue_indexes(p):
+                        residue_map[(name, r)].append((state, copy, pi))
+            self._maps[key] = residue_map
+        return self._maps[key]
+
+    def get_entries(self, molecule, residue_index, resolution=None,
+                    state_index=None, copy_index=None, atom_type=None):
+        """Get the particles representing a residue, with their
+           state and copy indexes.
+           @param molecule The molecule name
+           @param residue_index The residue index
+           @param resolution The representation resolution, as for
+                  IMP.atom.Selection (None for the Selection default)
+           @param state_index Only return particles in this state
+                  (None for all states)
+           @param copy_index Only return particles in this copy
+                  (None for all copies)
+           @param atom_type Only return atoms of this type (e.g. "CA")
+           @return a list of (state index, copy index, IMP.Particle)
+        """
+        residue_map = self._get_map(resolution, atom_type)
+        return [(state, copy, self.model.get_particle(pi))
+                for state, copy, pi in residue_map.get((molecule,
+                                                        residue_index), [])
+                if (state_index is None or state == state_index)
+                and (copy_index is None or copy == copy_index)]
+
+    def get_particles(self, molecule, residue_index, resolution=None,
+                      state_index=None, copy_index=None, atom_type=None):
+        """Get the particles representing a residue.
+           See get_entries() for the parameters.
+           @return a list of IMP.Particle
+        """
+        return [p for state, copy, p in self.get_entries(
+                       molecule, residue_index, resolution=resolution,
+                       state_index=state_index, copy_index=copy_index,
+                       atom_type=atom_type)]
+
+def get_residue_particle_index(hier):
+    """Get the ResidueParticleIndex for a hierarchy.
+       For the root of a PMI2 System the index is cached on the System
+       (see IMP.pmi.topology.System.get_residue_particle_index()),
+       otherwise it is cached on the hierarchy object itself, so
+       subsequent calls return the same index.
+    """
+    system = _get_system_for_hier(hier)
+    if system is not None:
+        return system.get_residue_particle_index()
+    if not hasattr(hier, '_pmi_residue_particle_index'):
+        hier._pmi_residue_particle_index = ResidueParticleIndex(hier)
+    return hier._pmi_residue_particle_index
+
 def get_molecules(input_objects):
     "This function returns the parent molecule hierarchies of given objects"
     stuff=input_adaptor(input_objects, pmi_resolution='all',flatten=True)
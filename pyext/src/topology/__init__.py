@@ -111,6 +111,7 @@ class System(_SystemBase):
         self._protocol_output = []
         self.states = []
         self.built=False
+        self._residue_particle_index = None
 
         # the root hierarchy node
         self.hier=self._create_hierarchy()
@@ -137,6 +138,19 @@ class System(_SystemBase):
     def get_hierarchy(self):
         return self.hier
 
+    def get_residue_particle_index(self):
+        """Get an IMP.pmi.tools.ResidueParticleIndex for fast lookup
+        of the particles representing each residue in all states.
+        The index is built on first use after the System is built,
+        and cached; before that, a new index is returned every time.
+        """
+        if not self.built:
+            return IMP.pmi.tools.ResidueParticleIndex(self.hier)
+        if self._residue_particle_index is None:
+            self._residue_particle_index = \
+                IMP.pmi.tools.ResidueParticleIndex(self.hier)
+        return self._residue_particle_index
+
     def build(self,**kwargs):
         """Build all states"""
         if not self.built:
@@ -229,6 +243,13 @@ class State(_SystemBase):
     def get_number_of_copies(self,molname):
         return len(self.molecules[molname])
 
+    def get_residue_particle_index(self):
+        """Get an IMP.pmi.tools.ResidueParticleIndex for this State.
+        The index is shared with the System, and so covers all states;
+        pass state_index to its lookup functions to restrict it to this one.
+        """
+        return self.system.get_residue_particle_index()
+
     def _register_copy(self,molecule):
         molname = molecule.get_hierarchy().get_name()
         self.molecules[molname].append(molecule)
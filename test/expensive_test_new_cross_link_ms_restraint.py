@@ -456,6 +456,40 @@ class Tests(IMP.test.TestCase):
                        'included.None.xl.db', 'missing.None.xl.db']:
             os.unlink(output)
 
+    def test_batched_output(self):
+        """Test batched per-crosslink output"""
+        m = IMP.Model()
+        hier, dof = self.init_representation_beads_pmi2(m)
+        xlbeads, cldb = self.setup_crosslinks_beads(root_hier=hier,
+                                                    mode="single_category")
+        IMP.pmi.tools.shuffle_configuration(hier, max_translation=10)
+        dists, scores = xlbeads.get_crosslink_distances_and_scores()
+        self.assertEqual(len(dists), len(xlbeads.xl_list))
+        output = xlbeads.get_output()
+        for n, xl in enumerate(xlbeads.xl_list):
+            d0 = IMP.core.XYZ(xl["Particle1"])
+            d1 = IMP.core.XYZ(xl["Particle2"])
+            self.assertAlmostEqual(dists[n], IMP.core.get_distance(d0, d1),
+                                   delta=1e-6)
+            score = -log(xl["Restraint"].unprotected_evaluate(None))
+            self.assertAlmostEqual(scores[n], score, delta=1e-6)
+            label = xl["ShortLabel"]
+            self.assertAlmostEqual(float(output[
+                "CrossLinkingMassSpectrometryRestraint_Distance_" + label]),
+                dists[n], delta=1e-6)
+        # per-crosslink data should only be output every 3 frames
+        xlbeads.set_crosslink_output_every(3)
+        key = ("CrossLinkingMassSpectrometryRestraint_Distance_"
+               + xlbeads.xl_list[0]["ShortLabel"])
+        outputs = [xlbeads.get_output() for i in range(4)]
+        self.assertEqual([o[key] == "None" for o in outputs],
+                         [False, True, True, False])
+        for o in outputs:
+            self.assertNotEqual(o["_TotalScore"], "None")
+        for output in ['excluded.None.xl.db',
+                       'included.None.xl.db', 'missing.None.xl.db']:
+            os.unlink(output)
+
 
 if __name__ == '__main__':
     IMP.test.main()
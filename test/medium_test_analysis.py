@@ -5,6 +5,7 @@ import IMP.rmf
 import os
 from math import sqrt
 import random
+import numpy
 try:
     import scipy
 except ImportError:
@@ -177,6 +178,39 @@ class AnalysisTest(IMP.test.TestCase):
         ali=IMP.pmi.analysis.Alignment(coord_dict_0,coord_dict_1)
         self.assertAlmostEqual(ali.get_rmsd(),1.0/sqrt(3.0))
 
+    def test_alignment_many_copies(self):
+        """Test alignment assigns many copies of the same protein"""
+        if scipy is None:
+            self.skipTest("no scipy module")
+        random.seed(42)
+        bb = IMP.algebra.BoundingBox3D(IMP.algebra.Vector3D(-20, -20, -20),
+                                       IMP.algebra.Vector3D(20, 20, 20))
+        names = ["prot1"] + ["prot2..%d" % i for i in range(1, 9)]
+        template = dict((n, [IMP.algebra.get_random_vector_in(bb)
+                             for i in range(3)]) for n in names)
+        copies = names[1:]
+        shuffled = copies[:]
+        random.shuffle(shuffled)
+        tr = IMP.algebra.Transformation3D(
+                   IMP.algebra.get_random_rotation_3d(),
+                   IMP.algebra.get_random_vector_in(bb))
+        query = dict((n, [tr.get_transformed(v) for v in template[n]])
+                     for n in names)
+        query.update(dict((n, query[m]) for n, m in zip(copies, shuffled)))
+
+        ali = IMP.pmi.analysis.Alignment(template, query)
+        rmsd, transformation = ali.align()
+        self.assertAlmostEqual(rmsd, 0.0, delta=1e-6)
+        for n, m in zip(copies, shuffled):
+            v = transformation.get_transformed(query[n][0])
+            self.assertLess(IMP.algebra.get_distance(v, template[m][0]), 1e-4)
+
+        # without alignment, only the copies are swapped
+        query = dict((n, template[m]) for n, m in zip(copies, shuffled))
+        query["prot1"] = template["prot1"]
+        ali = IMP.pmi.analysis.Alignment(template, query)
+        self.assertAlmostEqual(ali.get_rmsd(), 0.0, delta=1e-6)
+
 
     def test_alignment_rmsd_with_weights(self):
         """Test rmsd of already aligned particles,
@@ -228,6 +262,49 @@ class AnalysisTest(IMP.test.TestCase):
         self.assertTrue(IMP.em.get_bounding_box(mdens.get_density('med2')).get_contains(bbox2))
         self.assertTrue(IMP.em.get_bounding_box(mdens.get_density('med16')).get_contains(bbox16))
 
+    def test_get_model_density_batches(self):
+        """Test GetModelDensity gives the same maps with batches and workers"""
+        if scipy is None:
+            self.skipTest("no scipy module")
+        custom_ranges={'med2':[(1,100,'med2')],
+                       'med16':['med16']}
+        mdens1 = IMP.pmi.analysis.GetModelDensity(custom_ranges, batch_size=1)
+        mdens3 = IMP.pmi.analysis.GetModelDensity(custom_ranges, batch_size=3,
+                                                  nproc=2)
+        rmf_file=self.get_input_file_name('output/rmfs/2.rmf3')
+        rh = RMF.open_rmf_file_read_only(rmf_file)
+        prots = IMP.rmf.create_hierarchies(rh,self.model)
+        for i in range(4):
+            IMP.rmf.load_frame(rh,RMF.FrameID(i))
+            mdens1.add_subunits_density(prots[0])
+            mdens3.add_subunits_density(prots[0])
+        for name in custom_ranges:
+            d1 = mdens1.get_density(name)
+            d3 = mdens3.get_density(name)
+            self.assertEqual(d1.get_number_of_voxels(),
+                             d3.get_number_of_voxels())
+            total = 0.
+            for i in range(d1.get_number_of_voxels()):
+                self.assertAlmostEqual(d1.get_value(i), d3.get_value(i),
+                                       delta=1e-6)
+                total += d1.get_value(i)
+            self.assertGreater(total, 0.)
+        # maps are written directly from the grids, scaled by the
+        # number of frames
+        path = os.path.dirname(self.get_tmp_file_name('med2.test.mrc'))
+        mdens3.write_mrc(path=path, suffix='test')
+        for name in custom_ranges:
+            d3 = mdens3.get_density(name)
+            m = IMP.em.read_map(os.path.join(path, name + '.test.mrc'),
+                                IMP.em.MRCReaderWriter())
+            self.assertEqual(m.get_number_of_voxels(),
+                             d3.get_number_of_voxels())
+            self.assertLess(IMP.algebra.get_distance(m.get_origin(),
+                                                     d3.get_origin()), 1e-4)
+            for i in range(0, m.get_number_of_voxels(), 7):
+                self.assertAlmostEqual(m.get_value(i), d3.get_value(i) / 4.,
+                                       delta=1e-6)
+
     def test_analysis_macro(self):
         """Test the analysis macro does everything correctly"""
         pass
@@ -270,6 +347,177 @@ class ClusteringTest(IMP.test.TestCase):
         self.assertAlmostEqual(d[0,0],0.0)
         self.assertAlmostEqual(d[1,0],sqrt(10.0/21.0))
         self.assertAlmostEqual(d[2,0],0.0)
+        # the full matrix is cached until the distances change
+        self.assertIs(clu.get_dist_matrix(), d)
+        clu.distance_matrix.set_row(0, [5.0, 6.0])
+        d = clu.get_dist_matrix()
+        self.assertAlmostEqual(d[2,0],6.0)
+        self.assertEqual(sorted(clu.transformation_distance_dict.keys()),
+                         [(0,1), (0,2), (1,0), (1,2), (2,0), (2,1)])
+
+    def test_dist_matrix_file(self):
+        """Test the distance matrix can be stored in files and resumed"""
+        if scipy is None:
+            self.skipTest("no scipy module")
+        random.seed(42)
+        names = ["prot1", "prot2..1", "prot2..2"]
+        bb = IMP.algebra.BoundingBox3D(IMP.algebra.Vector3D(-10, -10, -10),
+                                       IMP.algebra.Vector3D(10, 10, 10))
+        clu = IMP.pmi.analysis.Clustering()
+        for m in range(5):
+            clu.fill(m, dict((n, [IMP.algebra.get_random_vector_in(bb)
+                                  for i in range(3)]) for n in names))
+        clu.set_template(clu.all_coords[0])
+        fn = self.get_tmp_file_name('test_dist_matrix')
+        clu.dist_matrix(file_name=fn, block_size=2)
+        d = clu.get_dist_matrix()
+        # the transformations should align each model onto the first
+        ali = IMP.pmi.analysis.Alignment(clu.all_coords[0],
+                                         clu.all_coords[3])
+        rmsd, tr = ali.align()
+        tr2 = clu.distance_matrix.get_transformation(0, 3)
+        for v in clu.all_coords[3]["prot1"]:
+            self.assertLess(IMP.algebra.get_distance(
+                tr.get_transformed(v), tr2.get_transformed(v)), 1e-4)
+
+        # mark some rows as incomplete; only these should be recalculated
+        clu.distance_matrix = None
+        rows = numpy.load(fn + ".rows.npy")
+        self.assertEqual(list(rows), [1, 1, 1, 1, 0])
+        rows[1] = 0
+        numpy.save(fn + ".rows.npy", rows)
+        distances = numpy.load(fn + ".npy")
+        distances[:] = -1.
+        numpy.save(fn + ".npy", distances)
+        clu.dist_matrix(file_name=fn)
+        d2 = clu.get_dist_matrix()
+        self.assertAlmostEqual(d2[1, 3], d[1, 3], delta=1e-6)
+        self.assertAlmostEqual(d2[0, 3], -1., delta=1e-6)
+
+        clu.structure_cluster_ids = [0, 1, 1, 0, 1]
+        clu.save_distance_matrix_file(fn)
+        clu2 = IMP.pmi.analysis.Clustering()
+        clu2.load_distance_matrix_file(fn)
+        self.assertEqual(clu2.get_cluster_label_names(1), [1, 2, 4])
+        self.assertAlmostEqual(clu2.get_dist_matrix()[3, 1], d[1, 3],
+                               delta=1e-6)
+        self.assertAlmostEqual(clu2.get_cluster_label_average_rmsd(0), -1.,
+                               delta=1e-6)
+
+    def test_clustering_algorithms(self):
+        """Test clustering algorithms that do not need the full matrix"""
+        if scipy is None:
+            self.skipTest("no scipy module")
+        random.seed(42)
+        names = ["prot1", "prot2..1", "prot2..2"]
+        bb = IMP.algebra.BoundingBox3D(IMP.algebra.Vector3D(-20, -20, -20),
+                                       IMP.algebra.Vector3D(20, 20, 20))
+        centers = [dict((n, [IMP.algebra.get_random_vector_in(bb)
+                             for i in range(3)]) for n in names)
+                   for c in range(3)]
+        clu = IMP.pmi.analysis.Clustering()
+        expected = []
+        for m in range(12):
+            c = m % 3
+            expected.append(c)
+            clu.fill(m, dict((n, [v + IMP.algebra.Vector3D(random.random(),
+                                                           random.random(),
+                                                           random.random())
+                                  for v in centers[c][n]]) for n in names))
+
+        def check_clusters(clusters):
+            self.assertEqual(len(clusters), 3)
+            for cl in clusters:
+                self.assertIsInstance(cl, IMP.pmi.output.Cluster)
+                self.assertEqual(len(set(expected[m] for m in cl.members)),
+                                 1)
+                self.assertIn(cl.center_index, cl.members)
+            self.assertEqual(clu.get_number_of_clusters(), 3)
+            self.assertEqual(len(clu.get_cluster_label_names(0)), 4)
+
+        clusters = clu.cluster(IMP.pmi.analysis.LeaderClustering(5.))
+        check_clusters(clusters)
+        self.assertEqual([cl.center_index for cl in clusters], [0, 1, 2])
+        check_clusters(clu.cluster(IMP.pmi.analysis.MiniBatchKMedoids(
+                                          3, batch_size=6, seed=42)))
+        clu.dist_matrix()
+        check_clusters(clu.cluster(
+                          IMP.pmi.analysis.HierarchicalClustering(3)))
+        check_clusters(clu.cluster(
+                   IMP.pmi.analysis.HierarchicalClustering(rmsd_cutoff=5.)))
+
+    def test_model_coordinates(self):
+        """Test vectorized RMSDs match those from Alignment"""
+        if scipy is None:
+            self.skipTest("no scipy module")
+        random.seed(42)
+        names = ["prot1", "prot2..1", "prot2..2"]
+        bb = IMP.algebra.BoundingBox3D(IMP.algebra.Vector3D(-10, -10, -10),
+                                       IMP.algebra.Vector3D(10, 10, 10))
+        ref = dict((n, [IMP.algebra.get_random_vector_in(bb)
+                        for i in range(4)]) for n in names)
+        all_coords = {}
+        for m in range(4):
+            tr = IMP.algebra.Transformation3D(
+                       IMP.algebra.get_random_rotation_3d(),
+                       IMP.algebra.get_random_vector_in(bb))
+            swap = {"prot2..1": "prot2..2", "prot2..2": "prot2..1"}
+            all_coords[m] = dict(
+                (n, [tr.get_transformed(v + IMP.algebra.Vector3D(
+                                 random.random(), random.random(), 0.))
+                     for v in ref[swap.get(n, n) if m % 2 else n]])
+                for n in names)
+        weights = dict((n, [1.0, 2.0, 3.0, 4.0]) for n in names)
+        coords = IMP.pmi.analysis.ModelCoordinates(all_coords, [0, 1, 2, 3],
+                                                   weights)
+        rmsds, rot, trans = coords.get_rmsds(0, [1, 2, 3])
+        self.assertIsNone(rot)
+        for n, m in enumerate([1, 2, 3]):
+            ali = IMP.pmi.analysis.Alignment(all_coords[0], all_coords[m],
+                                             weights)
+            self.assertAlmostEqual(rmsds[n], ali.get_rmsd(), delta=1e-6)
+
+        coords = IMP.pmi.analysis.ModelCoordinates(all_coords, [0, 1, 2, 3],
+                                    alignment_protein_names=names)
+        rmsds, rot, trans = coords.get_rmsds(0, [1, 2, 3])
+        for n, m in enumerate([1, 2, 3]):
+            ali = IMP.pmi.analysis.Alignment(all_coords[0], all_coords[m])
+            rmsd, tr = ali.align()
+            self.assertAlmostEqual(rmsds[n], rmsd, delta=1e-5)
+            for v in all_coords[m]["prot1"]:
+                self.assertLess(IMP.algebra.get_distance(
+                    tr.get_transformed(v),
+                    IMP.algebra.Vector3D(*(rot[n].dot(list(v)) + trans[n]))),
+                    1e-4)
+        matrix = coords.get_rmsd_matrix(block_size=2)
+        self.assertAlmostEqual(matrix[2, 0], rmsds[1], delta=1e-6)
+
+    def test_coordinate_accumulator(self):
+        """Test single-pass coordinate statistics"""
+        if scipy is None:
+            self.skipTest("no scipy module")
+        frames = [[[random.uniform(-5, 5) + 10 * i for j in range(3)]
+                   for i in range(6)] for n in range(20)]
+        acc = IMP.pmi.analysis.CoordinateAccumulator()
+        acc1 = IMP.pmi.analysis.CoordinateAccumulator()
+        acc2 = IMP.pmi.analysis.CoordinateAccumulator()
+        for n, frame in enumerate(frames):
+            acc.add(frame, frame=n)
+            (acc1 if n < 7 else acc2).add(frame, frame=n)
+        acc1.merge(acc2)
+        xyz = numpy.array(frames)
+        mean = xyz.mean(axis=0)
+        rmsf = numpy.sqrt(((xyz - mean) ** 2).sum(axis=2).mean(axis=0))
+        msds = [((xyz[i] - xyz[j]) ** 2).sum(axis=1).mean()
+                for i in range(20) for j in range(20) if i != j]
+        for a in (acc, acc1):
+            self.assertEqual(len(a), 20)
+            self.assertLess(numpy.abs(a.get_mean() - mean).max(), 1e-6)
+            self.assertLess(numpy.abs(a.get_rmsf() - rmsf).max(), 1e-6)
+            self.assertAlmostEqual(a.get_precision(),
+                                   sqrt(sum(msds) / len(msds)), delta=1e-6)
+            self.assertIn(a.get_centroid(), range(20))
+        self.assertRaises(ValueError, acc.add, frames[0][:5])
 
 class PrecisionTest(IMP.test.TestCase):
     """ The precision class reads some structures and checks
@@ -286,12 +534,8 @@ class PrecisionTest(IMP.test.TestCase):
                 total+=(d0-d1)**2
                 ct+=1
         return sqrt(total/ct)
-    def test_precision(self):
-        if scipy is None:
-            self.skipTest("no scipy module")
-        mdl = IMP.Model()
-
-        # create some frames and store in RMF
+    def make_rmf(self, mdl):
+        """Store some random frames of a 4-particle molecule in an RMF file"""
         root = IMP.atom.Hierarchy.setup_particle(IMP.Particle(mdl))
         h = IMP.atom.Molecule.setup_particle(IMP.Particle(mdl))
         h.set_name("testmol")
@@ -325,6 +569,13 @@ class PrecisionTest(IMP.test.TestCase):
             IMP.rmf.save_frame(f)
             all_coords.append(tmp_coords)
         del f
+        return fn, all_coords
+
+    def test_precision(self):
+        if scipy is None:
+            self.skipTest("no scipy module")
+        mdl = IMP.Model()
+        fn, all_coords = self.make_rmf(mdl)
 
         # calculate av distance between all pairs of the two sets
         dist=self.get_drms(all_coords[0],all_coords[2])
@@ -343,6 +594,52 @@ class PrecisionTest(IMP.test.TestCase):
             pdist = float(inf.readline().strip().split()[-1])
         self.assertAlmostEqual(dist,pdist,places=2)
 
+    def test_precision_styles(self):
+        """Test precision with each style, using several threads"""
+        if scipy is None:
+            self.skipTest("no scipy module")
+        mdl = IMP.Model()
+        fn, all_coords = self.make_rmf(mdl)
+        vs = [[IMP.algebra.Vector3D(c) for c in coords]
+              for coords in all_coords]
+        metrics = {'pairwise_rmsd': IMP.algebra.get_rmsd,
+                   'pairwise_drmsd_k': IMP.atom.get_drmsd,
+                   'pairwise_drms_k': IMP.atom.get_drms,
+                   'pairwise_drmsd_Q': lambda c0, c1:
+                                         IMP.atom.get_drmsd_Q(c0, c1, 10.0)}
+        ofn = self.get_tmp_file_name('test_precision_styles.out')
+        pr = IMP.pmi.analysis.Precision(mdl,resolution=1,number_of_threads=3)
+        pr.set_threshold(10.0)
+        pr.add_structures([[fn,i] for i in range(4)],'set0')
+        for style, metric in metrics.items():
+            pr.set_precision_style(style)
+            matrix = [[metric(v0, v1) for v1 in vs] for v0 in vs]
+            centroid = pr.get_precision('set0','set0',outfile=ofn)
+            average = [sum(row)/4. for row in matrix]
+            self.assertAlmostEqual(average[centroid], min(average), delta=1e-4)
+            with open(ofn) as inf:
+                lines = inf.readlines()
+            self.assertAlmostEqual(float(lines[0].split()[-1]),
+                                   average[centroid], delta=1e-4)
+            self.assertAlmostEqual(float(lines[-1].split()[-1]),
+                                   sum(average)/4., delta=1e-4)
+
+    def test_precision_single_precision(self):
+        """Test precision with distances stored as 32-bit floats"""
+        if scipy is None:
+            self.skipTest("no scipy module")
+        mdl = IMP.Model()
+        fn, all_coords = self.make_rmf(mdl)
+        dist=sum(self.get_drms(c0,c1) for c0 in all_coords
+                                       for c1 in all_coords)/16.
+        ofn = self.get_tmp_file_name('test_precision_single.out')
+        pr = IMP.pmi.analysis.Precision(mdl,resolution=1,single_precision=True)
+        pr.add_structures([[fn,i] for i in range(4)],'set0')
+        pr.get_precision('set0','set0',outfile=ofn)
+        with open(ofn) as inf:
+            pdist = float(inf.readlines()[-1].split()[-1])
+        self.assertAlmostEqual(dist,pdist,delta=1e-4)
+
 
 if __name__ == '__main__':
     IMP.test.main()
@@ -68,6 +68,64 @@ class Tests(IMP.test.TestCase):
         # read clusters
         are.load_clusters("clusters.pkl")
 
+    def _get_pairwise_rmsf(self, are, cluster, molecule):
+        """Average distance from the reference, one pair at a time,
+           realigning each member onto each reference member"""
+        if cluster.center_index is not None:
+            members0 = [cluster.center_index]
+        else:
+            members0 = cluster.members
+        s0 = IMP.atom.Selection(are.stath0, molecule=molecule, resolution=1,
+                                copy_index=0, state_index=0)
+        ps0 = s0.get_selected_particles()
+        residue_indexes = list(IMP.pmi.tools.OrderedSet(
+                  [IMP.pmi.tools.get_residue_indexes(p)[0] for p in ps0]))
+        rmsf = {}
+        npairs = 0
+        for n0 in members0:
+            d0 = are.stath0[n0]
+            for n1 in cluster.members:
+                if n0 == n1:
+                    continue
+                are.apply_molecular_assignments(n1)
+                s1 = IMP.atom.Selection(are.stath1, molecule=molecule,
+                                        residue_indexes=residue_indexes,
+                                        resolution=1, copy_index=0,
+                                        state_index=0)
+                ps1 = s1.get_selected_particles()
+                are.align()
+                for n, (p0, p1) in enumerate(zip(ps0, ps1)):
+                    r = residue_indexes[n]
+                    rmsf[r] = rmsf.get(r, 0.) + IMP.core.get_distance(
+                                        IMP.core.XYZ(p0), IMP.core.XYZ(p1))
+                npairs += 1
+                are.undo_apply_molecular_assignments(n1)
+        return dict((r, v / npairs) for r, v in rmsf.items())
+
+    def test_rmsf_alignment(self):
+        """Test rmsf realigns the members onto each reference member"""
+        if IMP.get_check_level() >= IMP.USAGE_AND_INTERNAL:
+            self.skipTest("test too slow to run in debug mode")
+        model=IMP.Model()
+        sts=sorted(glob.glob(self.get_input_file_name("output_test/stat.0.out").replace(".0.",".*.")))
+        are=IMP.pmi.macros.AnalysisReplicaExchange(model,sts,10)
+        are.set_alignment_selection(molecule="Rpb4")
+        self.assertTrue(are.alignment)
+        # several reference members, and then a cluster center
+        cluster = IMP.pmi.output.Cluster(0)
+        for n in (0, 3, 6):
+            cluster.add_member(n)
+        for center_index in (None, 3):
+            cluster.center_index = center_index
+            # leave stath0 at a frame that is not a reference member
+            d0 = are.stath0[9]
+            expected = self._get_pairwise_rmsf(are, cluster, "Rpb7")
+            d0 = are.stath0[9]
+            rmsf = are.rmsf(cluster, "Rpb7")
+            self.assertEqual(sorted(rmsf.keys()), sorted(expected.keys()))
+            for r in expected:
+                self.assertAlmostEqual(rmsf[r], expected[r], delta=1e-4)
+
 
 if __name__ == '__main__':
     IMP.test.main()
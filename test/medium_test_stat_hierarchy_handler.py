@@ -172,6 +172,70 @@ class Tests(IMP.test.TestCase):
             self._check_data_identity(d,stath_read[n])
             self._check_coordinate_identity(lvs, lvs_read)
 
+    def test_cache(self):
+        """Test the frame coordinate cache, with a small memory budget"""
+        import glob
+        m=IMP.Model()
+        stat_names=glob.glob(self.get_input_file_name("output_test/stat.0.out").replace("stat.0.out","stat.*.out"))
+        stath=IMP.pmi.output.StatHierarchyHandler(m,stat_names,10)
+        frame_bytes=IMP.pmi.output.StatHierarchyHandler(
+                        m,stat_names,10,cache=True).cache.frame_bytes
+        lvs=IMP.atom.get_leaves(stath)
+        spill_file=self.get_tmp_file_name("cache.dat")
+        for file_name in (None, spill_file):
+            stath_cached=IMP.pmi.output.StatHierarchyHandler(
+                        m,stat_names,10,cache=True,
+                        cache_max_bytes=3*frame_bytes,
+                        cache_file_name=file_name)
+            lvs_cached=IMP.atom.get_leaves(stath_cached)
+            cache=stath_cached.cache
+            self.assertEqual(cache.max_bytes,3*frame_bytes)
+            self.assertEqual(cache.file_name,file_name)
+            # copies use the same budget, and their own file
+            stathcopy=IMP.pmi.output.StatHierarchyHandler(
+                        StatHierarchyHandler=stath_cached)
+            self.assertEqual(stathcopy.cache.max_bytes,3*frame_bytes)
+            self.assertEqual(stathcopy.cache.file_name,
+                             None if file_name is None
+                             else file_name+".copy")
+            for n in list(range(10))+[9,0,5,2,8,8,1]:
+                stath[n]
+                stath_cached[n]
+                for p1,p2 in zip(lvs,lvs_cached):
+                    self.assertLess(IMP.core.get_distance(IMP.core.XYZ(p1),
+                                                          IMP.core.XYZ(p2)),
+                                    1e-4)
+            self.assertEqual(len(cache._frames),3)
+            self.assertEqual(len(cache),3 if file_name is None else 10)
+
+    def test_iter_frames(self):
+        """Test reading frames ahead in file order"""
+        import glob
+        m=IMP.Model()
+        stat_names=glob.glob(self.get_input_file_name("output_test/stat.0.out").replace("stat.0.out","stat.*.out"))
+        stath=IMP.pmi.output.StatHierarchyHandler(m,stat_names,10)
+        stath_cached=IMP.pmi.output.StatHierarchyHandler(m,stat_names,10,cache=True)
+        lvs=IMP.atom.get_leaves(stath)
+        lvs_cached=IMP.atom.get_leaves(stath_cached)
+        plan=stath_cached.get_access_plan(range(10))
+        keys=[(stath_cached.data[i].rmf_name!=stath_cached.current_rmf,
+               stath_cached.data[i].rmf_name,stath_cached.data[i].rmf_index)
+              for i in plan]
+        self.assertEqual(keys,sorted(keys))
+        self.assertEqual(sorted(plan),[i for i in range(10)
+                                       if not stath_cached.cache[i]])
+        indexes=[7,2,9,0,2,5,3,8,1,6,4,7]
+        for read_ahead in (2,None):
+            served=[]
+            for n,d in stath_cached.iter_frames(indexes,read_ahead=read_ahead):
+                served.append(n)
+                self._check_data_identity(d,stath[n])
+                for p1,p2 in zip(lvs,lvs_cached):
+                    self.assertLess(IMP.core.get_distance(IMP.core.XYZ(p1),
+                                                          IMP.core.XYZ(p2)),
+                                    1e-4)
+            self.assertEqual(served,indexes)
+
 
 if __name__ == '__main__':
     IMP.test.main()
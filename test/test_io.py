@@ -61,5 +61,23 @@ class Tests(IMP.test.TestCase):
         self.assertEqual(rmf_frames, [0,0,0])
         self.assertEqual([int(x) for x in scores], [10, 20, 999])
 
+    def test_get_best_models_parallel(self):
+        """Test get_best_models() with worker processes and top-N"""
+        stat_files = [self.get_input_file_name('ministat.out')] * 3
+        score_key = "SimplifiedModel_Total_Score_None"
+
+        serial = IMP.pmi.io.get_best_models(stat_files, score_key=score_key)
+        parallel = IMP.pmi.io.get_best_models(stat_files, score_key=score_key,
+                                              nproc=2)
+        self.assertEqual(serial[:3], parallel[:3])
+        self.assertEqual([int(x) for x in serial[2]], [10, 20, 999] * 3)
+
+        (rmfs, rmf_frames, scores, features) = IMP.pmi.io.get_best_models(
+                         stat_files, score_key=score_key,
+                         number_of_best_scoring_models=4, nproc=2)
+        self.assertEqual([int(x) for x in scores], [10, 10, 10, 20])
+        self.assertEqual(len(rmfs), 4)
+        self.assertEqual(features[score_key], scores)
+
 if __name__ == '__main__':
     IMP.test.main()
@@ -7,6 +7,7 @@ import IMP.atom
 import IMP.container
 
 import IMP.pmi.io.crosslink
+import operator
 
 class Tests(IMP.test.TestCase):
 
@@ -344,6 +345,36 @@ class Tests(IMP.test.TestCase):
         nentry=len([xl for xl in cldb if (xl[cldb.protein1_key]=="AAA")])
         self.assertEqual(len(cldb1),nentry)
 
+        # the filtered database shares cross-links with the original one
+        for xl in cldb1:
+            xl["sample"]="filtered"
+        nfiltered=len([xl for xl in cldb if xl["sample"]=="filtered"])
+        self.assertEqual(nfiltered,nentry)
+
+    def test_compile_FilterOperator(self):
+        import operator
+        from IMP.pmi.io.crosslink import FilterOperator as FO
+        cldb=self.setup_cldb("xl_dataset_test.dat")
+        rows=cldb._get_rows()
+        fo_aaa=FO(cldb.protein1_key,operator.eq,"AAA")
+        fo_res=FO(cldb.residue1_key,operator.gt,30)
+        # shared subexpressions, both as the same objects and as
+        # equivalent objects
+        fos=[fo_aaa|fo_res,
+             ~(fo_aaa&fo_res)|(fo_aaa&fo_res),
+             FO(fo_aaa&FO(cldb.residue1_key,operator.gt,30),operator.xor,fo_res),
+             (FO(cldb.protein2_key,operator.eq,"BBB")&fo_aaa)|~fo_res]
+        for fo in fos:
+            mask=fo.compile()(cldb._table,rows)
+            self.assertEqual(list(mask),[bool(fo.evaluate(xl)) for xl in cldb])
+            self.assertIs(fo.compile(),fo.compile())
+
+        # keys that are missing are only an error if they must be checked
+        fo=fo_aaa&FO("missing",operator.eq,1)
+        self.assertRaises(KeyError,fo.compile(),cldb._table,rows)
+        fo=FO(cldb.protein1_key,operator.eq,"XXX")&FO("missing",operator.eq,1)
+        self.assertEqual(len(cldb.filter(fo)),0)
+
     def test_clone_protein(self):
         cldb=self.setup_cldb("xl_dataset_test.dat")
         expected_crosslinks=[]
@@ -411,6 +442,93 @@ class Tests(IMP.test.TestCase):
                     self.assertEqual(xl[key],cldb.data_base[xlid][n][key])
 
 
+    def test_data_base_view(self):
+        """Test the dictionary-like view of the cross-link storage"""
+        cldb=self.setup_cldb("xl_dataset_test.dat")
+        self.assertEqual(len(cldb),len([xl for xl in cldb]))
+        # changes made through a cross-link are stored
+        xl=cldb['1'][0]
+        xl['Distance']=12.5
+        self.assertEqual(cldb['1'][0]['Distance'],12.5)
+        self.assertIn('Distance',cldb['1'][0])
+        self.assertNotIn('Distance',cldb['1'][1])
+        del xl['Distance']
+        self.assertNotIn('Distance',cldb['1'][0])
+        # values of another type than the key's are kept as they are
+        xl[cldb.id_score_key]='None'
+        self.assertEqual(cldb['1'][0][cldb.id_score_key],'None')
+        self.assertEqual(cldb['1'][1][cldb.id_score_key],9.0)
+        # unique IDs can be replaced or added with lists of dictionaries
+        nxlid=cldb.get_number_of_xlid()
+        cldb.data_base['80']=[{cldb.protein1_key:'AAA',cldb.protein2_key:'CCC',
+                              cldb.residue1_key:3,cldb.residue2_key:7}]
+        cldb._update()
+        self.assertEqual(cldb.get_number_of_xlid(),nxlid+1)
+        self.assertEqual(cldb['80'][0][cldb.unique_sub_id_key],'80.1')
+        self.assertEqual(cldb['80'][0][cldb.redundancy_key],1)
+        self.assertEqual(cldb['80'][0][cldb.residue2_links_number_key],1)
+        # redundant cross-links are found in either direction
+        cldb.data_base['90']=[{cldb.protein1_key:'CCC',cldb.protein2_key:'AAA',
+                              cldb.residue1_key:7,cldb.residue2_key:3}]
+        cldb._update()
+        self.assertEqual(cldb['80'][0][cldb.redundancy_list_key],['80.1','90.1'])
+        self.assertEqual(cldb['90'][0][cldb.redundancy_key],2)
+        self.assertEqual(dict(cldb['90'][0])[cldb.residue1_key],7)
+        # the lists of cross-links can also be changed in place
+        cldb.data_base['80'].append({cldb.protein1_key:'AAA',
+                                     cldb.protein2_key:'DDD',
+                                     cldb.residue1_key:4,
+                                     cldb.residue2_key:9})
+        cldb._update()
+        self.assertEqual(len(cldb['80']),2)
+        self.assertEqual(cldb['80'][1][cldb.unique_sub_id_key],'80.2')
+        self.assertEqual(cldb['80'][1][cldb.protein2_key],'DDD')
+        cldb.data_base['80'][0]=cldb['90'][0]
+        self.assertEqual(cldb['80'][0][cldb.residue1_key],7)
+        cldb.data_base['80'].remove(cldb['80'][0])
+        cldb._update()
+        self.assertEqual(len(cldb['80']),1)
+        self.assertEqual(cldb['80'][0][cldb.protein2_key],'DDD')
+        self.assertEqual(cldb['80'][0][cldb.unique_sub_id_key],'80.1')
+        self.assertEqual(cldb['80'],[dict(cldb['80'][0])])
+        self.assertRaises(KeyError,cldb.data_base.__getitem__,'999')
+
+    def test_dump_load(self):
+        """Test saving and loading a database"""
+        cldb=self.setup_cldb("xl_dataset_test.dat")
+        xl=next(iter(cldb))
+        xl["mixed"]=[1,2]
+        cldb.set_value("sample","mouse",
+                       IMP.pmi.io.crosslink.FilterOperator(cldb.id_score_key,operator.gt,10.0))
+        expected=[(xlid,[dict(xl) for xl in cldb[xlid]])
+                  for xlid in cldb.xlid_iterator()]
+
+        json_file=self.get_tmp_file_name("test_dump_load.json")
+        cldb.dump(json_file)
+        cldb_json=IMP.pmi.io.crosslink.CrossLinkDataBase(cldb.cldbkc)
+        cldb_json.load(json_file)
+        binary_file=self.get_tmp_file_name("test_dump_load.dat")
+        cldb.dump_binary(binary_file)
+        cldb_binary=IMP.pmi.io.crosslink.CrossLinkDataBase(cldb.cldbkc)
+        cldb_binary.load_binary(binary_file)
+        for new_cldb in (cldb_json,cldb_binary):
+            self.assertEqual([(xlid,[dict(xl) for xl in new_cldb[xlid]])
+                              for xlid in new_cldb.xlid_iterator()],expected)
+        self.assertRaises(ValueError,cldb_binary.load_binary,
+                          self.get_input_file_name("xl_dataset_test.dat"))
+
+        # reading in small chunks gives the same database
+        cldb_chunks=IMP.pmi.io.crosslink.CrossLinkDataBase(cldb.cldbkc)
+        cldb_chunks._create_set_from_csv(
+                     self.get_input_file_name("xl_dataset_test.dat"),chunk_size=3)
+        cldb_chunks._update()
+        cldb=self.setup_cldb("xl_dataset_test.dat")
+        self.assertEqual([(xlid,[dict(xl) for xl in cldb_chunks[xlid]])
+                          for xlid in cldb_chunks.xlid_iterator()],
+                         [(xlid,[dict(xl) for xl in cldb[xlid]])
+                          for xlid in cldb.xlid_iterator()])
+        self.assertEqual(type(next(iter(cldb_chunks))[cldb.residue1_key]),int)
+
     def test_redundancy(self):
         cldb=self.setup_cldb("xl_dataset_test.dat")
         pass
@@ -520,6 +638,73 @@ class Tests(IMP.test.TestCase):
         for prot_name, amount in calc_non_matched.items():
             self.assertEqual(amount, exp_non_matched[prot_name])
 
+    def test_lazy_update(self):
+        """Test that derived fields are only recomputed when needed"""
+        import operator
+        from IMP.pmi.io.crosslink import FilterOperator as FO
+        seqs = IMP.pmi.topology.Sequences(self.get_input_file_name("proteasome.fasta"))
+        cldbkc = IMP.pmi.io.crosslink.CrossLinkDataBaseKeywordsConverter()
+        cldbkc.set_unique_id_key("linkage ID")
+        cldbkc.set_protein1_key("Linked protein 1")
+        cldbkc.set_protein2_key("Linked protein 2")
+        cldbkc.set_residue1_key("linked resid 1")
+        cldbkc.set_residue2_key("linked resid 2")
+        cldb = IMP.pmi.io.crosslink.CrossLinkDataBase(cldbkc, fasta_seq=seqs)
+        ncheck = []
+        check = cldb.check_cross_link_consistency
+        def count_check():
+            ncheck.append(1)
+            return check()
+        cldb.check_cross_link_consistency = count_check
+        cldb.create_set_from_file(self.get_input_file_name("proteasome_xlinks.csv"))
+        self.assertEqual(len(ncheck), 1)
+        xl = next(iter(cldb))
+        self.assertEqual(xl[cldb.redundancy_key], 1)
+
+        # changing keys the derived fields do not depend on
+        # does not trigger any update
+        nupdate = []
+        update = cldb.update_cross_link_redundancy
+        def count_update():
+            nupdate.append(1)
+            return update()
+        cldb.update_cross_link_redundancy = count_update
+        cldb.create_new_keyword("Foo")
+        cldb.set_value("Foo", 42)
+        self.assertEqual(xl["Foo"], 42)
+        self.assertEqual(len(ncheck), 1)
+        self.assertEqual(len(nupdate), 0)
+
+        # changing the cross-linked sites does
+        cldb.set_value(cldb.residue1_key, 1)
+        cldb.set_value(cldb.residue2_key, 2)
+        cldb.set_value(cldb.protein1_key, "RPN3")
+        cldb.set_value(cldb.protein2_key, "RPN3")
+        self.assertEqual(len(ncheck), 5)
+        self.assertEqual(len(nupdate), 0)
+        self.assertEqual(xl[cldb.redundancy_key], len(cldb))
+        self.assertEqual(len(nupdate), 1)
+        self.assertEqual(xl[cldb.residue1_links_number_key], 1)
+
+        # as do edits made through a cross-link
+        xl[cldb.residue1_key] = 3
+        self.assertEqual(xl[cldb.redundancy_key], 1)
+        self.assertEqual(len(nupdate), 2)
+        self.assertEqual(xl[cldb.residue1_links_number_key], 1)
+        self.assertEqual(xl[cldb.residue2_links_number_key], 2)
+
+    def test_lazy_update_shared(self):
+        """Test derived fields of databases sharing storage"""
+        from IMP.pmi.io.crosslink import FilterOperator as FO
+        cldb=self.setup_cldb("xl_dataset_test.dat")
+        expected=[(xl[cldb.ambiguity_key],xl[cldb.redundancy_key]) for xl in cldb]
+        self.assertIn((3,2),expected)
+        cldb_filtered=cldb.filter(FO(cldb.id_score_key,operator.gt,9.5))
+        self.assertTrue(len(cldb_filtered)<len(cldb))
+        cldb.set_value("note","x")
+        self.assertEqual([(xl[cldb.ambiguity_key],xl[cldb.redundancy_key])
+                          for xl in cldb],expected)
+
     def test_map_crosslink_database(self):
         model=IMP.Model()
 
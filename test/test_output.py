@@ -110,6 +110,278 @@ class Tests(IMP.test.TestCase):
         self.assertEqual(stats.passed_get_every, 5)
         self.assertEqual(stats.passed_filtertuple, 3)
 
+    def test_convert_stat2_to_stat3(self):
+        """Test conversion of a stat2 file to binary stat3"""
+        fname = self.get_input_file_name("./output1/stat.0.out")
+        IMP.pmi.output.convert_stat2_to_stat3(fname, "test_stat3.out")
+        po2 = IMP.pmi.output.ProcessOutput(fname)
+        po3 = IMP.pmi.output.ProcessOutput("test_stat3.out")
+        self.assertTrue(po3.isstat3)
+        self.assertEqual(po3.get_keys(), po2.get_keys())
+        col = po3.get_column("AtomicXLRestraint")
+        vals = po2.get_fields(["AtomicXLRestraint"])["AtomicXLRestraint"]
+        self.assertEqual(len(col), len(vals))
+        for a, b in zip(col, vals):
+            self.assertAlmostEqual(a, float(b), delta=1e-6)
+        f3 = po3.get_fields(["rmf_file"])["rmf_file"]
+        f2 = po2.get_fields(["rmf_file"])["rmf_file"]
+        self.assertEqual(f3, f2)
+        # Filters and statistics should match the stat2 reader
+        stats2 = IMP.pmi.output.OutputStatistics()
+        stats3 = IMP.pmi.output.OutputStatistics()
+        v2 = po2.get_fields(["AtomicXLRestraint"], get_every=3,
+                            filtertuple=("AtomicXLRestraint", "<", 10.0),
+                            statistics=stats2)
+        v3 = po3.get_fields(["AtomicXLRestraint"], get_every=3,
+                            filtertuple=("AtomicXLRestraint", "<", 10.0),
+                            statistics=stats3)
+        self.assertEqual(len(v2["AtomicXLRestraint"]),
+                         len(v3["AtomicXLRestraint"]))
+        for attr in ('total', 'passed_filterout', 'passed_get_every',
+                     'passed_filtertuple'):
+            self.assertEqual(getattr(stats2, attr), getattr(stats3, attr))
+        os.unlink("test_stat3.out")
+
+    def test_write_stat3(self):
+        """Test writing a stat3 file"""
+        class DummyOutput(object):
+            def __init__(self):
+                self.score = 0.
+            def get_output(self):
+                return {"Dummy_Score": str(self.score), "Dummy_Int": 4,
+                        "Dummy_Name": "foo", "_Private": 1}
+        d = DummyOutput()
+        output = IMP.pmi.output.Output()
+        output.init_stat3("test_stat3.out", [d], extralabels=["rmf_file"])
+        for i in range(5):
+            d.score = float(i)
+            output.set_output_entry("rmf_file", "%d.rmf3" % i)
+            output.write_stat3("test_stat3.out")
+        po = IMP.pmi.output.ProcessOutput("test_stat3.out")
+        self.assertEqual(sorted(po.get_keys()),
+                         ['Dummy_Int', 'Dummy_Name', 'Dummy_Score',
+                          'rmf_file'])
+        self.assertEqual(list(po.get_column("Dummy_Score")),
+                         [0., 1., 2., 3., 4.])
+        self.assertEqual(list(po.get_column("rmf_file")),
+                         ["%d.rmf3" % i for i in range(5)])
+        fields = po.get_fields(["Dummy_Int", "Dummy_Name"])
+        self.assertEqual(fields["Dummy_Int"], [4] * 5)
+        self.assertEqual(fields["Dummy_Name"], ["foo"] * 5)
+        os.unlink("test_stat3.out")
+
+    def test_write_stat3_widen(self):
+        """Test stat3 columns that change type after the first frame"""
+        class DummyOutput(object):
+            def __init__(self):
+                self.label = "None"
+                self.count = 1
+            def get_output(self):
+                return {"Dummy_Label": self.label, "Dummy_Count": self.count,
+                        "Dummy_Score": "1.5"}
+        d = DummyOutput()
+        output = IMP.pmi.output.Output()
+        output.init_stat3("test_stat3.out", [d], string_width=8)
+        labels = ["None", "model_A", "a_much_longer_model_name", "model_B"]
+        counts = [1, 2, 2.5, 3]
+        for label, count in zip(labels, counts):
+            d.label = label
+            d.count = count
+            output.write_stat3("test_stat3.out")
+        output.close_stats()
+        po = IMP.pmi.output.ProcessOutput("test_stat3.out")
+        self.assertEqual(list(po.get_column("Dummy_Label")), labels)
+        self.assertEqual(list(po.get_column("Dummy_Count")), counts)
+        self.assertEqual(list(po.get_column("Dummy_Score")), [1.5] * 4)
+        # filterout applies to the string values
+        stats = IMP.pmi.output.OutputStatistics()
+        fields = po.get_fields(["Dummy_Count"], filterout="model",
+                               statistics=stats)
+        self.assertEqual(fields["Dummy_Count"], [1.])
+        self.assertEqual(stats.total, 4)
+        self.assertEqual(stats.passed_filterout, 1)
+        os.unlink("test_stat3.out")
+
+    def test_stat_flush(self):
+        """Test buffered writing of stat files"""
+        class DummyOutput(object):
+            def get_output(self):
+                return {"Dummy_Score": "1.0"}
+        def count_lines():
+            with open("test_stat_flush.out") as fh:
+                return len(fh.readlines())
+        output = IMP.pmi.output.Output(stat_flush_frames=3)
+        output.init_stat2("test_stat_flush.out", [DummyOutput()])
+        self.assertEqual(count_lines(), 1)
+        output.write_stat2("test_stat_flush.out")
+        output.write_stat2("test_stat_flush.out")
+        # Frames should be buffered until the third is written
+        self.assertEqual(count_lines(), 1)
+        output.write_stat2("test_stat_flush.out")
+        self.assertEqual(count_lines(), 4)
+        output.write_stat2("test_stat_flush.out")
+        self.assertEqual(count_lines(), 4)
+        output.close_stats()
+        self.assertEqual(count_lines(), 5)
+        # Writing after close should reopen the file
+        output.write_stat2("test_stat_flush.out")
+        output.close_stats()
+        self.assertEqual(count_lines(), 6)
+        os.unlink("test_stat_flush.out")
+
+    def test_output_cache(self):
+        """Test sharing of get_output() results within a frame"""
+        class DummyOutput(object):
+            def __init__(self):
+                self.ncalls = 0
+            def get_output(self):
+                self.ncalls += 1
+                return {"Dummy_Score": str(self.ncalls)}
+        d = DummyOutput()
+        output = IMP.pmi.output.Output()
+        output.init_stat2("test_cache1.out", [d])
+        output.init_stat2("test_cache2.out", [d])
+        self.assertEqual(d.ncalls, 2)
+        output.set_output_cache_key(0)
+        output.write_stat2("test_cache1.out")
+        output.write_stat2("test_cache2.out")
+        self.assertEqual(d.ncalls, 3)
+        output.set_output_cache_key(1)
+        output.write_stat2("test_cache1.out")
+        output.write_stat2("test_cache2.out")
+        self.assertEqual(d.ncalls, 4)
+        # No caching if the key is None
+        output.set_output_cache_key(None)
+        output.write_stat2("test_cache1.out")
+        output.write_stat2("test_cache2.out")
+        self.assertEqual(d.ncalls, 6)
+        output.close_stats()
+        for fname in ("test_cache1.out", "test_cache2.out"):
+            po = IMP.pmi.output.ProcessOutput(fname)
+            self.assertEqual(po.get_fields(["Dummy_Score"])["Dummy_Score"],
+                             ['3', '4', '5' if fname == "test_cache1.out"
+                                        else '6'])
+            os.unlink(fname)
+
+    def test_shared_best_scores(self):
+        """Test best scoring PDBs shared between replicas"""
+        class DummyOutput(IMP.pmi.output.Output):
+            def _init_dictchain(self, name, prot):
+                pass
+            def _get_pdb_coordinates(self, name):
+                return None, self.score
+            def _write_pdb_file(self, name, appendmode, plan, xyzs, center):
+                with open(name, 'w') as fh:
+                    fh.write(str(xyzs))
+        replicas = [DummyOutput(), DummyOutput()]
+        for output in replicas:
+            output.init_pdb_best_scoring("test_shared", None, 3,
+                                         replica_exchange=True)
+        for n, score in enumerate([5., 3., 8., 1., 9., 2., 7., 0.5]):
+            output = replicas[n % 2]
+            output.score = score
+            output.write_pdb_best_scoring(score)
+        self.assertEqual(replicas[1].best_score_list, [0.5, 1., 2.])
+        for i, score in enumerate([0.5, 1., 2.]):
+            with open("test_shared.%d.pdb" % i) as fh:
+                self.assertEqual(fh.read(), str(score))
+            os.unlink("test_shared.%d.pdb" % i)
+        os.unlink(replicas[0].best_score_file_name)
+
+    def test_background_writer(self):
+        """Test writing stat and PDB files in a background thread"""
+        class DummyOutput(object):
+            def __init__(self):
+                self.score = 0.
+            def get_output(self):
+                return {"Dummy_Score": self.score}
+        class DummyPDBOutput(IMP.pmi.output.Output):
+            def _init_dictchain(self, name, prot):
+                pass
+            def _get_pdb_coordinates(self, name):
+                return None, self.score
+            def _write_pdb_file(self, name, appendmode, plan, xyzs, center):
+                with open(name, 'w') as fh:
+                    fh.write(str(xyzs))
+        d = DummyOutput()
+        contents = []
+        for background in (False, True):
+            output = DummyPDBOutput()
+            output.init_stat2("test_background.out", [d])
+            output.init_pdb_best_scoring("test_background", None, 2)
+            if background:
+                output.start_background_writer(max_queued_frames=2)
+            for score in range(20, 0, -1):
+                d.score = output.score = float(score)
+                output.write_stat2("test_background.out")
+                output.write_pdb_best_scoring(score)
+            output.stop_background_writer()
+            output.close_stats()
+            po = IMP.pmi.output.ProcessOutput("test_background.out")
+            fields = po.get_fields(["Dummy_Score"])
+            self.assertEqual(len(fields["Dummy_Score"]), 20)
+            pdbs = []
+            for i in range(2):
+                with open("test_background.%d.pdb" % i) as fh:
+                    pdbs.append(fh.read())
+                os.unlink("test_background.%d.pdb" % i)
+            contents.append((fields, pdbs))
+            os.unlink("test_background.out")
+        self.assertEqual(contents[0], contents[1])
+        self.assertEqual(contents[1][1], ['1.0', '2.0'])
+
+    def test_stat_file_index(self):
+        """Test indexed access to frames of a stat file"""
+        import shutil
+        fname = self.get_input_file_name("./output1/stat.0.out")
+        shutil.copy(fname, "test_index.out")
+        po = IMP.pmi.output.ProcessOutput("test_index.out",
+                                          use_index_file=True)
+        self.assertEqual(po.get_number_of_frames(), 16)
+        self.assertTrue(os.path.exists("test_index.out.idx"))
+        keys = ["AtomicXLRestraint", "rmf_frame_index"]
+        allf = po.get_fields(keys)
+        tail = po.get_frames(slice(-3, None), keys)
+        some = po.get_frames([0, 5, 7], keys)
+        for k in keys:
+            self.assertEqual(tail[k], allf[k][-3:])
+            self.assertEqual(some[k], [allf[k][0], allf[k][5], allf[k][7]])
+        # Indexed get_every should match the sequential reader
+        stats1 = IMP.pmi.output.OutputStatistics()
+        stats2 = IMP.pmi.output.OutputStatistics()
+        f1 = po.get_fields(keys, get_every=3, statistics=stats1)
+        f2 = po.get_fields(keys, get_every=3, filterout="not in the file",
+                           statistics=stats2)
+        self.assertEqual(f1, f2)
+        self.assertEqual(stats1.total, stats2.total)
+        self.assertEqual(stats1.passed_get_every, stats2.passed_get_every)
+        # The index should be extended as the file grows, and partially
+        # written frames ignored
+        with open("test_index.out") as fh:
+            lines = fh.readlines()
+        with open("test_index.out", "a") as fh:
+            fh.write(lines[1])
+            fh.write(lines[2][:10])
+        po = IMP.pmi.output.ProcessOutput("test_index.out",
+                                          use_index_file=True)
+        self.assertEqual(po.get_number_of_frames(), 17)
+        self.assertEqual(po.get_frames([16], keys)["rmf_frame_index"],
+                         [allf["rmf_frame_index"][0]])
+        # If the file is rewritten (even with more data) the saved index
+        # should not be used
+        with open("test_index.out", "w") as fh:
+            fh.write(lines[0])
+            for line in lines[1:]:
+                fh.write(line.replace(" ", "  "))
+            fh.write(lines[1])
+        po = IMP.pmi.output.ProcessOutput("test_index.out",
+                                          use_index_file=True)
+        self.assertEqual(po.get_number_of_frames(), 17)
+        self.assertEqual(po.get_frames([16], keys)["rmf_frame_index"],
+                         [allf["rmf_frame_index"][0]])
+        os.unlink("test_index.out")
+        os.unlink("test_index.out.idx")
+
     def _check_coordinate_identity(self,ps1,ps2):
         for n,p in enumerate(ps1):
             d1=IMP.core.XYZ(p)
@@ -158,6 +430,27 @@ class Tests(IMP.test.TestCase):
         self.assertEqual(tp.get_number_of_runs(), 2)
         self.assertEqual(tp.get_number_of_frames(), 33)
 
+    def test_get_best_fields(self):
+        """Test ProcessOutput.get_best_fields()"""
+        stat = self.get_input_file_name("./output1/stat.0.out")
+        po = IMP.pmi.output.ProcessOutput(stat)
+        keys = ['AtomicXLRestraint', 'rmf_frame_index']
+        for get_every, threshold in ((1, None), (2, 10.0)):
+            s1 = IMP.pmi.output.OutputStatistics()
+            filtertuple = None if threshold is None \
+                          else ('AtomicXLRestraint', '<', threshold)
+            allf = po.get_fields(keys, get_every=get_every,
+                                 filtertuple=filtertuple, statistics=s1)
+            order = sorted(range(len(allf['AtomicXLRestraint'])),
+                           key=lambda i: float(allf['AtomicXLRestraint'][i]))
+            s2 = IMP.pmi.output.OutputStatistics()
+            best = po.get_best_fields(keys, 'AtomicXLRestraint', 5,
+                                      score_threshold=threshold,
+                                      get_every=get_every, statistics=s2)
+            for k in keys:
+                self.assertEqual(best[k], [allf[k][i] for i in order[:5]])
+            self.assertEqual(s1.__dict__, s2.__dict__)
+
     def test_RMFHierarchyHandler(self):
 
         m=IMP.Model()
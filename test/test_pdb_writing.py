@@ -85,6 +85,42 @@ ENDMDL'''.split("\n")
             os.unlink('test_pdb_writing.'+str(i)+'.pdb')
         os.unlink('test_pdb_writing.pdb')
 
+    def test_pdb_coordinates_update(self):
+        """Test that PDB frames reflect the current coordinates"""
+        mdl = IMP.Model()
+        pdb_file = self.get_input_file_name("mini.pdb")
+        fasta_file = self.get_input_file_name("mini.fasta")
+
+        seqs = IMP.pmi.topology.Sequences(fasta_file)
+        s = IMP.pmi.topology.System(mdl)
+        st = s.create_state()
+        molA = st.create_molecule("P1",seqs[0],chain_id='A')
+        aresA = molA.add_structure(pdb_file,chain_id='A',soft_check=True)
+        molA.add_representation(aresA,[1])
+        molA.add_representation(molA[:]-aresA,20)
+        root_hier = s.build()
+
+        output = IMP.pmi.output.Output(atomistic=True)
+        output.init_pdb("test_pdb_update.pdb", root_hier)
+        output.write_pdbs()
+        for p in IMP.atom.get_leaves(root_hier):
+            d = IMP.core.XYZ(p)
+            d.set_coordinates(d.get_coordinates()
+                              + IMP.algebra.Vector3D(10., 0., 0.))
+        output.write_pdbs()
+
+        with open("test_pdb_update.pdb") as f:
+            models = f.read().split("ENDMDL\n")[:2]
+        lines = [m.rstrip("\n").split("\n") for m in models]
+        self.assertEqual(len(lines[0]), len(lines[1]))
+        self.assertGreater(len(lines[0]), 0)
+        for l0, l1 in zip(*lines):
+            self.assertEqual(l0[:30], l1[:30])
+            self.assertAlmostEqual(float(l1[30:38]) - float(l0[30:38]),
+                                   10., delta=0.002)
+            self.assertEqual(l0[38:], l1[38:])
+        os.unlink('test_pdb_update.pdb')
+
     def test_pdb_from_rex(self):
         """Test PDB writing in PMI2 from replica exchange"""
         mdl = IMP.Model()
@@ -867,6 +867,69 @@ class Tests(IMP.test.TestCase):
         self.assertEqual(IMP.pmi.tools.flatten_list(inp),
                          ['a', 'b', 'c', 'd', 'e'])
 
+    def test_get_best_assignment(self):
+        """Test get_best_assignment()"""
+        import itertools
+        import random
+        self.assertEqual(IMP.pmi.tools.get_best_assignment([]), [])
+        self.assertEqual(IMP.pmi.tools.get_best_assignment(
+                            [[4., 1., 3.], [2., 0., 5.], [3., 2., 2.]]),
+                         [1, 0, 2])
+        random.seed(42)
+        for n in range(1, 7):
+            cost = [[random.randint(0, 5) + random.random() for j in range(n)]
+                    for i in range(n)]
+            best = min(sum(cost[i][p[i]] for i in range(n))
+                       for p in itertools.permutations(range(n)))
+            order = IMP.pmi.tools.get_best_assignment(cost)
+            self.assertEqual(sorted(order), list(range(n)))
+            self.assertAlmostEqual(sum(cost[i][order[i]] for i in range(n)),
+                                   best, delta=1e-8)
+
+    def test_residue_particle_index(self):
+        """Test ResidueParticleIndex matches IMP.atom.Selection"""
+        mdl = IMP.Model()
+        pdb_file = self.get_input_file_name("mini.pdb")
+        fasta_file = self.get_input_file_name("mini.fasta")
+        seqs = IMP.pmi.topology.Sequences(fasta_file)
+        s = IMP.pmi.topology.System(mdl)
+        for nstate in range(2):
+            st = s.create_state()
+            molA = st.create_molecule("P1", seqs[0], chain_id='A')
+            aresA = molA.add_structure(pdb_file, chain_id='A',
+                                       soft_check=True)
+            molA.add_representation(aresA, [0, 1, 10])
+            molA.add_representation(molA[:]-aresA, 2)
+            molB = st.create_molecule("P2", seqs[1], chain_id='B')
+            molB.add_representation(molB, [1])
+            molC = molB.create_copy(chain_id='C')
+            molC.add_representation(molC, [1, 3])
+        root_hier = s.build()
+
+        index = IMP.pmi.tools.get_residue_particle_index(root_hier)
+        self.assertIs(index, s.get_residue_particle_index())
+        self.assertIs(index, s.get_states()[1].get_residue_particle_index())
+        for molecule, nres in (("P1", len(seqs[0])), ("P2", len(seqs[1]))):
+            for r in range(0, nres + 2):
+                for kwargs in ({'resolution': 1},
+                               {'resolution': 10, 'state_index': 1},
+                               {'resolution': 3, 'copy_index': 1},
+                               {'state_index': 0, 'atom_type': 'CA'}):
+                    skw = dict(kwargs)
+                    if 'atom_type' in skw:
+                        skw['atom_type'] = IMP.atom.AtomType(skw['atom_type'])
+                    sel = IMP.atom.Selection(root_hier, molecule=molecule,
+                                             residue_index=r, **skw)
+                    ps = index.get_particles(molecule, r, **kwargs)
+                    sel_ps = sel.get_selected_particles()
+                    self.assertEqual(len(ps), len(sel_ps))
+                    self.assertEqual(set(ps), set(sel_ps))
+        for state, copy, p in index.get_entries("P2", 2, resolution=1):
+            h = IMP.atom.Hierarchy(p)
+            self.assertEqual(IMP.atom.get_state_index(h), state)
+            self.assertEqual(IMP.atom.get_copy_index(h), copy)
+        self.assertEqual(index.get_particles("P3", 1, resolution=1), [])
+
     def test_color_change(self):
         """Test ColorChange class"""
         cc = IMP.pmi.tools.ColorChange()